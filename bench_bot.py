@@ -0,0 +1,471 @@
+"""
+Офлайн-бенчмарк бота: синтетические апдейты через Dispatcher.feed_update.
+
+Telegram заменён заглушкой сессии, все источники курсов — локальным
+aiohttp-сервером (с задержками и сбоями по заказу), так что живой бот и сеть
+не нужны. Отчёт: апдейтов в секунду, p50/p99 задержки, аллокации и рост памяти.
+
+    python bench_bot.py --updates 20000 --concurrency 64
+    python bench_bot.py --scenario flow --memory --json bench_output.txt
+    python bench_bot.py --upstream-fail-rate 0.3 --upstream-slow-rate 0.1
+    python bench_bot.py --parse 2000
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import statistics
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.methods import SendMessage, EditMessageText
+from aiogram.types import Update, Message, Chat, User, CallbackQuery
+
+import bot_tg
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              ЗАГЛУШКИ
+# ══════════════════════════════════════════════════════════════════════════════
+
+class StubSession(BaseSession):
+    """Сессия Bot API без сети: отвечает сразу (или с задержкой latency)"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message(
+                message_id=getattr(method, "message_id", None) or self.calls,
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text,
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def stub_catalog(size: int, seed: int = 1) -> list[dict]:
+    """Список монет как у /coins/list: встроенные, случайные тикеры (с совпадениями) и тёзки фиата"""
+    rng = random.Random(seed)
+    coins = [{"id": info[2], "symbol": code.lower(), "name": info[0]} for code, info in bot_tg.CRYPTO.items()]
+    coins += [{"id": "bitcoin-clone", "symbol": "btc", "name": "Bitcoin Clone"},
+              {"id": "usd-coin-fake", "symbol": "usd", "name": "Fake USD"}]
+    letters = "abcdefghijklmnop"  # Узкий алфавит, чтобы тикеры совпадали
+    for n in range(size):
+        symbol = "".join(rng.choice(letters) for _ in range(rng.choice((3, 3, 4))))
+        coins.append({"id": f"coin-{n}-{symbol}", "symbol": symbol, "name": f"{symbol.title()} Coin {n}"})
+    return coins
+
+
+async def start_stub_upstream(port: int, latency: float, fail_rate: float = 0.0,
+                              slow_rate: float = 0.0, catalog_size: int = 0) -> web.AppRunner:
+    """Локальные заглушки всех источников курсов с правдоподобными ответами.
+
+    fail_rate — доля ответов 500, slow_rate — доля ответов в 20 раз медленнее
+    обычного (хвост задержек, на который рассчитаны хеджированные запросы).
+    catalog_size — сколько случайных монет отдать в каталоге CoinGecko.
+    """
+    # Базовый курс у всех источников общий, каждый ответ отличается от него на доли процента
+    base = {code: random.uniform(0.1, 70000) for code in bot_tg.CRYPTO}
+    base.update({code: random.uniform(0.5, 500) for code in bot_tg.FIAT})
+
+    def price(code: str) -> float:
+        if code not in base:
+            base[code] = random.uniform(0.0001, 100)  # Монета каталога
+        return round(base[code] * random.uniform(0.995, 1.005), 6)
+
+    def fiat_rates() -> dict[str, float]:
+        return {code: price(code) for code in bot_tg.FIAT if code != "USD"}
+
+    def stub(respond):
+        async def handler(request: web.Request) -> web.Response:
+            roll = random.random()
+            await asyncio.sleep(latency * 20 if roll < slow_rate else latency)
+            if random.random() < fail_rate:
+                return web.Response(status=500)
+            return web.json_response(respond(request))
+        return handler
+
+    ids = {info[2]: code for code, info in bot_tg.CRYPTO.items()}
+    app = web.Application()
+    app.router.add_get("/coingecko/simple/price", stub(lambda r: {
+        i: {"usd": price(ids.get(i, i))} for i in r.query.get("ids", "").split(",") if i}))
+    app.router.add_get("/cryptocompare/pricemulti", stub(lambda r: {
+        c: {"USD": price(c)} for c in r.query.get("fsyms", "").split(",") if c}))
+    app.router.add_get("/binance/ticker/price", stub(lambda r: [
+        {"symbol": s, "price": str(price(s[:-4]))} for s in json.loads(r.query.get("symbols", "[]"))]))
+    app.router.add_get("/frankfurter/latest", stub(lambda r: {"base": "USD", "rates": fiat_rates()}))
+    app.router.add_get("/open_er_api/latest/USD", stub(lambda r: {
+        "result": "success", "rates": {"USD": 1, **fiat_rates()}}))
+
+    coins = stub_catalog(catalog_size)
+    app.router.add_get("/coingecko/coins/list", stub(lambda r: coins))
+    app.router.add_get("/coingecko/coins/markets", stub(lambda r: [
+        {"id": c["id"], "symbol": c["symbol"], "current_price": price(ids.get(c["id"], c["id"]))}
+        for c in coins[:int(r.query.get("per_page", 100))]]))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              АПДЕЙТЫ
+# ══════════════════════════════════════════════════════════════════════════════
+
+class UpdateFactory:
+    """Генератор синтетических апдейтов от множества пользователей"""
+
+    def __init__(self, users: int, seed: int = 1):
+        self.users = users
+        self.rng = random.Random(seed)
+        self.update_id = 0
+        self.coins = sorted(bot_tg.catalog.by_symbol)
+
+    def _next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def message(self, user_id: int, text: str) -> Update:
+        uid = self._next_id()
+        return Update(update_id=uid, message=Message(
+            message_id=uid, date=datetime.now(), text=text,
+            chat=Chat(id=user_id, type="private"),
+            from_user=User(id=user_id, is_bot=False, first_name="bench"),
+        ))
+
+    def callback(self, user_id: int, data: str) -> Update:
+        uid = self._next_id()
+        user = User(id=user_id, is_bot=False, first_name="bench")
+        message = Message(message_id=user_id, date=datetime.now(), text="…",
+                          chat=Chat(id=user_id, type="private"), from_user=user)
+        return Update(update_id=uid, callback_query=CallbackQuery(
+            id=str(uid), from_user=user, chat_instance="bench", message=message, data=data,
+        ))
+
+    def flow(self, user_id: int) -> list[Update]:
+        """Полный путь через меню: валюта -> валюта -> сумма -> ещё сумма текстом"""
+        codes = list(bot_tg.FIAT)
+        f, t = self.rng.sample(codes, 2)
+        amount = self.rng.choice([1, 10, 100, 1000, 10000, 100000])
+        return [
+            self.callback(user_id, "convert"),
+            self.callback(user_id, f"c:from:{f}"),
+            self.callback(user_id, f"c:to:{f}:{t}"),
+            self.callback(user_id, bot_tg.ConvCallback("a", f, t, amount).pack()),
+            self.message(user_id, str(self.rng.randint(1, 5000))),
+        ]
+
+    def quick(self, user_id: int) -> list[Update]:
+        # Каждый пятый запрос — про монету из каталога, её цену бот подтянет лениво
+        codes = self.coins if self.coins and self.rng.random() < 0.2 else list(bot_tg.ALL_CURRENCIES)
+        f, t = self.rng.sample(codes, 2)
+        return [self.message(user_id, f"{self.rng.randint(1, 10000)} {f} {t}")]
+
+    def command(self, user_id: int) -> list[Update]:
+        return [self.message(user_id, self.rng.choice(["/btc", "/eth", "/ton"]))]
+
+    def rates(self, user_id: int) -> list[Update]:
+        return [self.callback(user_id, self.rng.choice(["rates:crypto", "rates:fiat"]))]
+
+    def hammer(self, user_id: int) -> list[Update]:
+        """Нетерпеливый пользователь: жмёт «Обновить» и кнопку суммы по несколько раз подряд"""
+        f, t = self.rng.sample(list(bot_tg.FIAT), 2)
+        presses = (["rates:crypto"] * self.rng.randint(2, 5)
+                   + [bot_tg.ConvCallback("a", f, t, 100).pack()] * self.rng.randint(2, 5))
+        return [self.callback(user_id, data) for data in presses]
+
+    def build(self, scenario: str, count: int) -> list[list[Update]]:
+        """Цепочки апдейтов; внутри цепочки порядок важен (FSM), цепочки независимы"""
+        makers = {
+            "flow": [self.flow],
+            "quick": [self.quick],
+            "btc": [self.command],
+            "hammer": [self.hammer],
+            "mixed": [self.flow, self.quick, self.quick, self.command, self.rates],
+        }[scenario]
+
+        chains, total = [], 0
+        while total < count:
+            chain = self.rng.choice(makers)(self.rng.randint(1, self.users))
+            chains.append(chain)
+            total += len(chain)
+        return chains
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              РАЗБОР ВВОДА
+# ══════════════════════════════════════════════════════════════════════════════
+
+# Как пишут пользователи: коды, псевдонимы, разделители, множители, опечатки и просто текст
+PARSE_CORPUS = [
+    "100 USD RUB", "100 usd rub", "0.5 BTC EUR", "1000 RUB TON", "100 USD", "250", "1,5",
+    "1.5k BTC", "2m rub to usd", "1 000 000 руб в долларах", "100usd to rub", "$100", "€ 50 rub",
+    "1,000 USD", "1.234,5 eur", "100 баксов в рублях", "5 ₿ $", "70 000 тенге в евро",
+    "2 млн тенге to eur", "300 гривен", "10 эфира в рублях", "100 USD/RUB", "100 USD -> EUR",
+    "1,5к руб", "100 xyz", "привет", "сколько стоит биткоин?", "/start", "100 USD RUB EUR",
+    "1.2.3,4.5 usd", "-5 usd", "ok", "спасибо!", "12 р", "0,0005 btc usdt",
+]
+
+_LEGACY_QUICK_RE = re.compile(r"^([\d\s,\.]+?)\s*([A-Za-z]{2,6})(?:\s+([A-Za-z]{2,6}))?$")
+
+
+def legacy_parse(text: str):
+    """Прежний разбор (regexp + float в try), для сравнения"""
+    m = _LEGACY_QUICK_RE.match(text.strip())
+    if not m:
+        return None
+    try:
+        amount = float(m[1].replace(",", ".").replace(" ", ""))
+    except ValueError:
+        return None
+    from_c, to_c = m[2].upper(), m[3].upper() if m[3] else None
+    if amount <= 0 or from_c not in bot_tg.ALL_CURRENCIES or (to_c and to_c not in bot_tg.ALL_CURRENCIES):
+        return None
+    return amount, from_c, to_c
+
+
+def bench_parse(rounds: int) -> dict:
+    """Микробенчмарк разбора быстрого ввода на PARSE_CORPUS"""
+    def measure(parse) -> float:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for text in PARSE_CORPUS:
+                parse(text)
+        return (time.perf_counter() - started) / (rounds * len(PARSE_CORPUS)) * 1e9
+
+    async def measure_filter(call) -> float:
+        """Цена фильтра в диспетчере: синхронный aiogram вызывает через asyncio.to_thread"""
+        count = max(1, rounds // 20) * len(PARSE_CORPUS)
+        started = time.perf_counter()
+        for i in range(count):
+            await call(PARSE_CORPUS[i % len(PARSE_CORPUS)])
+        return (time.perf_counter() - started) / count * 1e9
+
+    async def tokenizer_filter(text: str):
+        return bot_tg.tokenize_quick(text)
+
+    tokenize = bot_tg.tokenize_quick.__wrapped__  # Без lru_cache: честная цена разбора
+    return {
+        "corpus": len(PARSE_CORPUS),
+        "legacy_ns": round(measure(legacy_parse)),
+        "tokenizer_ns": round(measure(tokenize)),
+        "tokenizer_cached_ns": round(measure(bot_tg.tokenize_quick)),
+        "legacy_filter_ns": round(asyncio.run(measure_filter(lambda t: asyncio.to_thread(legacy_parse, t)))),
+        "tokenizer_filter_ns": round(asyncio.run(measure_filter(tokenizer_filter))),
+        "legacy_accepted": sum(legacy_parse(t) is not None for t in PARSE_CORPUS),
+        "tokenizer_accepted": sum(tokenize(t).error is None for t in PARSE_CORPUS),
+        "errors": ", ".join(sorted({tokenize(t).error for t in PARSE_CORPUS} - {None})),
+    }
+
+
+def bench_shared(rounds: int, coins: int = 500) -> dict:
+    """Микробенчмарк общего среза курсов (SharedRates) для режима с воркерами"""
+    rng = random.Random(1)
+    crypto = {code: rng.uniform(0.1, 70000) for code in bot_tg.CRYPTO}
+    fiat = {code: rng.uniform(0.5, 500) for code in bot_tg.FIAT if code != "USD"}
+    extra = {f"C{n}X": rng.uniform(0.001, 100) for n in range(coins)}
+    snapshot = bot_tg.RateSnapshot.build(1, crypto, fiat, time.time(), coins=extra)
+
+    writer = bot_tg.SharedRates.create(1)
+    reader = bot_tg.SharedRates.attach(writer.shm.name, 1)
+    saved = bot_tg.CurrencyAPI.snapshot
+    try:
+        def measure(call, count: int) -> float:
+            started = time.perf_counter()
+            for _ in range(count):
+                call()
+            return (time.perf_counter() - started) / count * 1e9
+
+        publish_ns = measure(lambda: writer.publish(snapshot), rounds)
+
+        def read_new():
+            bot_tg.CurrencyAPI.snapshot = None
+            return reader.read()
+
+        read_new_ns = measure(read_new, max(1, rounds // 10))
+        bot_tg.CurrencyAPI.snapshot = read_new()
+        read_same_ns = measure(reader.read, rounds)
+
+        async def measure_get(shared) -> float:
+            bot_tg.CurrencyAPI.shared = shared
+            try:
+                started = time.perf_counter()
+                for _ in range(rounds):
+                    await bot_tg.CurrencyAPI.get_snapshot()
+                return (time.perf_counter() - started) / rounds * 1e9
+            finally:
+                bot_tg.CurrencyAPI.shared = None
+
+        bot_tg.cache.update({kind: bot_tg.CachedRates(data={}, fetched_at=time.time())
+                             for kind in bot_tg.REQUIRED_RATE_KINDS if kind not in bot_tg.cache})
+        return {
+            "codes": len(snapshot.codes),
+            "publish_ns": round(publish_ns),
+            "read_new_version_ns": round(read_new_ns),
+            "read_same_version_ns": round(read_same_ns),
+            "get_snapshot_local_ns": round(asyncio.run(measure_get(None))),
+            "get_snapshot_shared_ns": round(asyncio.run(measure_get(reader))),
+            "matrix_matches": bool(np.array_equal(bot_tg.CurrencyAPI.snapshot.matrix, snapshot.matrix,
+                                                  equal_nan=True)),
+        }
+    finally:
+        bot_tg.CurrencyAPI.snapshot = saved
+        reader.close()
+        writer.close(unlink=True)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              ПРОГОН
+# ══════════════════════════════════════════════════════════════════════════════
+
+def upstream_counter(name: str) -> int:
+    return int(sum(v for (n, _), v in bot_tg.metrics._counters.items() if n == name))
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run(args) -> dict:
+    upstream = await start_stub_upstream(args.port, args.upstream_latency,
+                                         args.upstream_fail_rate, args.upstream_slow_rate, args.catalog)
+    base = f"http://127.0.0.1:{args.port}"
+    bot_tg.COINGECKO_API = f"{base}/coingecko"
+    bot_tg.CRYPTOCOMPARE_API = f"{base}/cryptocompare"
+    bot_tg.BINANCE_API = f"{base}/binance"
+    bot_tg.FRANKFURTER_API = f"{base}/frankfurter"
+    bot_tg.OPEN_ER_API = f"{base}/open_er_api"
+    bot_tg.catalog.path = None  # Каталог заглушки на диск не пишем
+    await bot_tg.catalog.reload()
+
+    session = StubSession(latency=args.telegram_latency)
+    bot = Bot(token="42:BENCH", session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    if args.send_queue:
+        bot.session.middleware(bot_tg.send_queue)
+    dp = bot_tg.TracingDispatcher(storage=bot_tg.TTLMemoryStorage())
+    dp.include_router(bot_tg.router)
+    dp.update.outer_middleware(bot_tg.callback_guard)
+
+    await bot_tg.refresher.start()
+    chains = UpdateFactory(args.users, args.seed).build(args.scenario, args.updates)
+    updates_total = sum(len(c) for c in chains)
+
+    # Прогрев: первый снимок курсов и ленивые кэши
+    for chain in chains[:10]:
+        for update in chain:
+            await dp.feed_update(bot, update)
+
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def play(chain: list[Update]):
+        async with semaphore:
+            for update in chain:
+                started = time.perf_counter()
+                await dp.feed_update(bot, update)
+                latencies.append(time.perf_counter() - started)
+
+    # tracemalloc сильно замедляет интерпретатор, поэтому память меряется отдельным прогоном
+    if args.memory:
+        tracemalloc.start()
+        mem_before, _ = tracemalloc.get_traced_memory()
+        snap_before = tracemalloc.take_snapshot()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(play(chain) for chain in chains))
+    elapsed = time.perf_counter() - started
+
+    memory = {}
+    if args.memory:
+        mem_after, mem_peak = tracemalloc.get_traced_memory()
+        stats = tracemalloc.take_snapshot().compare_to(snap_before, "filename")
+        tracemalloc.stop()
+        memory = {
+            "live_allocations": sum(max(s.count_diff, 0) for s in stats),
+            "memory_growth_kb": round((mem_after - mem_before) / 1024, 1),
+            "memory_peak_kb": round(mem_peak / 1024, 1),
+        }
+
+    await bot_tg.refresher.stop()
+    await bot_tg.CurrencyAPI.close()
+    await upstream.cleanup()
+
+    return {
+        "scenario": args.scenario,
+        "updates": updates_total,
+        "concurrency": args.concurrency,
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+        "telegram_calls": session.calls,
+        "upstream_hedges": upstream_counter("bot_upstream_hedges_total"),
+        "upstream_outliers": upstream_counter("bot_upstream_outliers_total"),
+        "updates_dropped": upstream_counter("bot_updates_dropped_total"),
+        **memory,
+        "fsm_entries": dp.storage.stats()["entries"],
+        "coins_tracked": bot_tg.catalog.stats()["tracked"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк Currency Converter Bot")
+    parser.add_argument("--scenario", choices=["mixed", "flow", "quick", "btc", "hammer"], default="mixed")
+    parser.add_argument("--updates", type=int, default=10000, help="сколько апдейтов прогнать")
+    parser.add_argument("--users", type=int, default=2000, help="сколько разных пользователей")
+    parser.add_argument("--concurrency", type=int, default=64, help="цепочек апдейтов одновременно")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка заглушки Bot API, с")
+    parser.add_argument("--upstream-latency", type=float, default=0.05, help="задержка заглушки API курсов, с")
+    parser.add_argument("--upstream-fail-rate", type=float, default=0.0, help="доля ответов 500 от API курсов")
+    parser.add_argument("--upstream-slow-rate", type=float, default=0.0, help="доля ответов API курсов в 20 раз медленнее")
+    parser.add_argument("--catalog", type=int, default=3000, help="монет в заглушке каталога CoinGecko")
+    parser.add_argument("--send-queue", action="store_true", help="включить лимиты SendQueue")
+    parser.add_argument("--memory", action="store_true", help="замерить аллокации и рост памяти (медленнее)")
+    parser.add_argument("--port", type=int, default=18931, help="порт заглушки API курсов")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--parse", type=int, metavar="ROUNDS", help="только микробенчмарк разбора ввода")
+    parser.add_argument("--shared", type=int, metavar="ROUNDS", help="только микробенчмарк общего среза курсов")
+    parser.add_argument("--json", metavar="FILE", help="дописать результат строкой JSON в файл")
+    args = parser.parse_args()
+
+    if args.parse:
+        result = bench_parse(args.parse)
+    elif args.shared:
+        result = bench_shared(args.shared)
+    else:
+        result = asyncio.run(run(args))
+
+    width = max(map(len, result))
+    for key, value in result.items():
+        print(f"{key:<{width}}  {value}")
+
+    if args.json:
+        with open(args.json, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": time.strftime("%Y-%m-%d %H:%M:%S"), **result}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,53 @@
 import asyncio
+import bisect
+import cProfile
+import heapq
+import hmac
+import html
+import inspect
+import io
 import logging
+import multiprocessing
+import os
+import pstats
+import queue
 import re
-from typing import Optional
+import signal
+import sqlite3
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from dataclasses import asdict
+from functools import lru_cache, wraps
+from multiprocessing.shared_memory import SharedMemory
+from types import MappingProxyType
+from urllib.parse import urlsplit
+from typing import Optional, Mapping, NamedTuple, Union
 from dataclasses import dataclass
 
 import aiohttp
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.filters import CommandStart, Command
+import numpy as np
+from aiohttp import web
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
+from aiogram.types import (Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
+                           InlineQuery, InlineQueryResultArticle, InputTextMessageContent, Update)
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.dispatcher.event.bases import SkipHandler, UNHANDLED
+from aiogram.dispatcher.flags import get_flag
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from cachetools import TTLCache
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import EditMessageText, EditMessageReplyMarkup
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from cachetools import LRUCache, TTLCache
 
 # ══════════════════════════════════════════════════════════════════════════════
 #                              КОНФИГУРАЦИЯ
@@ -23,7 +57,145 @@ BOT_TOKEN = "8330328134:AAGddNy1kYjdVZ3_JX7HUS3V6m2gJSgKNu8"  # Получите
 
 # API эндпоинты (бесплатные, без ключей)
 COINGECKO_API = "https://api.coingecko.com/api/v3"
+CRYPTOCOMPARE_API = "https://min-api.cryptocompare.com/data"
+BINANCE_API = "https://api.binance.com/api/v3"
 FRANKFURTER_API = "https://api.frankfurter.app"
+OPEN_ER_API = "https://open.er-api.com/v6"
+
+# Источники курсов по типам, в порядке приоритета
+RATE_PROVIDERS = {
+    "crypto": ("coingecko", "cryptocompare", "binance"),
+    "fiat": ("frankfurter", "open_er_api"),
+}
+HEDGE_PERCENTILE = 0.9       # Запасной запрос уходит, если основной медленнее 90% своих прошлых ответов
+HEDGE_MIN_DELAY = 0.25       # Не раньше, чем через столько секунд
+HEDGE_DEFAULT_DELAY = 1.0    # Пока статистики мало
+HEDGE_WINDOW = 50            # По скольким последним ответам считать перцентиль
+BREAKER_FAILURES = 3         # Ошибок подряд, после которых источник отключается
+BREAKER_COOLDOWN = 60        # Через сколько секунд попробовать его снова
+BREAKER_MAX_COOLDOWN = 15 * 60
+SANITY_EVERY = 5             # Каждое N-е обновление опрашивает все источники сразу для сверки
+SANITY_MAX_DEVIATION = 0.05  # Курс дальше 5% от медианы источников считается выбросом
+SOURCE_MAX_AGE = 10 * 60     # Ответы других источников старше этого в сверке не участвуют
+
+# Режим приёма апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")                 # Публичный адрес: https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")           # Сверяется с X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "64"))  # Апдейтов в обработке одновременно
+WEBHOOK_MAX_CONNECTIONS = 40                               # Соединений от Telegram (1-100)
+
+# Несколько процессов: координатор получает апдейты и курсы, воркеры обрабатывают апдейты
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))  # 1 — всё в одном процессе
+POLL_TIMEOUT = 30                # Long polling координатора, секунд
+SHARED_RATES_CAPACITY = 4096     # Валют в общем срезе курсов (встроенные + монеты каталога)
+SHARED_CODES_BYTES = 64 * 1024   # Место под список кодов среза
+SHARED_WAIT = 5                  # Сколько воркер ждёт курс монеты, запрошенный у координатора
+SHARED_MISS_TTL = 300            # Столько не ждать монету, которую координатор не смог оценить
+WORKER_BATCH = 256               # Апдейтов, забираемых из очереди воркера за раз
+WORKER_STOP_TIMEOUT = 10         # Сколько ждать, пока воркер доделает начатые апдейты
+
+# Защита от перегрузки
+CALLBACK_DEBOUNCE = 1.0      # Повторное нажатие той же кнопки в течение стольких секунд отбрасывается
+LOOP_LAG_INTERVAL = 0.25     # Как часто замерять задержку цикла событий, секунд
+LOOP_LAG_SHED = 0.5          # При задержке больше этой второстепенные апдейты отбрасываются
+
+# Диагностика
+SLOW_UPDATE = 1.0            # Апдейт дольше этого (секунд) пишется в лог с разбивкой по этапам
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(",", " ").split()}  # Кому доступен /profile
+PROFILE_DIR = "profiles"     # Куда сохранять результаты /profile и SIGUSR1
+PROFILE_SECONDS = 30         # Длительность профилирования по умолчанию
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP = 15             # Самых затратных функций в ответе /profile
+
+# Фоновое обновление курсов
+RATES_TTL = 60               # Через сколько секунд курс считается устаревшим
+REFRESH_MIN_INTERVAL = 15    # Самый частый интервал обновления (пиковая нагрузка)
+REFRESH_MAX_INTERVAL = 300   # Самый редкий интервал (ботом никто не пользуется)
+DEMAND_SCALE = 5             # Запросов курса в минуту, при которых интервал сокращается вдвое
+RATE_KINDS = ("crypto", "fiat", "coins")  # coins — монеты каталога сверх встроенных
+REQUIRED_RATE_KINDS = ("crypto", "fiat")  # Без них срез курсов не собрать
+API_CALLS_PER_MIN = {        # Бюджет обновлений в минуту (с запасом от лимитов основного источника)
+    "crypto": 10,            # CoinGecko
+    "fiat": 10,              # Frankfurter
+    "coins": 4,              # CoinGecko: страница популярных + чанки запрошенных монет
+}
+
+# Каталог монет CoinGecko
+COINS_FILE = "coins.json"    # Кэш списка монет на диске (None — не сохранять)
+COINS_TTL = 24 * 60 * 60     # Как часто перечитывать список монет
+COINS_TOP = 250              # Сколько крупнейших монет считать популярными (одна страница /coins/markets)
+COINS_TRACKED_MAX = 500      # Сколько запрошенных монет обновлять вместе с популярными
+COINS_URL_MAX = 1800         # Предел длины URL одного запроса цен
+COINS_FETCH_CONCURRENCY = 4  # Чанков цен одновременно
+COINS_PAGE_SIZE = 20         # Кнопок валют на странице клавиатуры
+COINS_SEARCH_LIMIT = 12      # Результатов поиска монеты
+
+# Последние удачные курсы на диске (тёплый старт и запасной вариант при сбоях API)
+RATES_DB = "rates.db"
+RATES_STALE_AFTER = 15 * 60  # После скольких секунд курс помечается как устаревший
+
+# FSM-хранилище
+FSM_TTL = 30 * 60            # Через сколько секунд простоя состояние пользователя удаляется
+FSM_MAX_ENTRIES = 100_000    # Максимум пользователей в хранилище
+FSM_SNAPSHOT = "fsm.json"    # Файл для сохранения незавершённых диалогов (None — не сохранять)
+
+# Кэш готовых текстов
+RENDER_CACHE_SIZE = 4096     # Отрисованных текстов (ключ: вид, параметры, версия курсов)
+SENT_CACHE_SIZE = 10000      # Последних текстов отправленных сообщений (для пропуска пустых правок)
+
+# Пакетная конвертация (несколько строк «100 USD RUB» в одном сообщении)
+BATCH_MAX_LINES = 50
+
+# Inline-режим (@bot 100 USD RUB)
+INLINE_TARGETS = ("USD", "EUR", "RUB", "USDT", "BTC")  # Популярные валюты для дополнительных карточек
+INLINE_CACHE_SIZE = 2048     # Готовых ответов в LRU
+INLINE_CACHE_TIME = 30       # Сколько секунд Telegram может кэшировать ответ у себя
+
+# Уведомления о курсе (/alert BTC > 70000)
+ALERTS_PER_USER = 20
+ALERT_HYSTERESIS = 0.01      # Повторно сработает, только когда курс отойдёт от порога на 1%
+
+# Сводки курсов по расписанию (/digest daily BTC/USD USD/RUB)
+DIGEST_PERIODS = {           # период: (шаг, сдвиг от полуночи UTC, сколько после срока ещё можно слать), секунд
+    "hourly": (3600, 0, 15 * 60),
+    "daily": (86400, 6 * 3600, 3 * 3600),  # 09:00 по Москве
+}
+DIGEST_MAX_PAIRS = 10        # Пар в одной сводке
+DIGEST_BATCH = 25            # Сообщений в одной пачке рассылки
+DIGEST_RATE = 20             # Сообщений в секунду (остаток TG_GLOBAL_RATE — ответам пользователям)
+DIGEST_LOG_EVERY = 30        # Как часто писать в лог ход рассылки, секунд
+
+# История курсов (/history BTC 24h)
+HISTORY_FILE = "history.npz"
+HISTORY_SAVE_INTERVAL = 300  # Как часто сохранять историю на диск, секунд
+HISTORY_TIERS = (            # (название, шаг в секундах, число точек)
+    ("minute", 60, 24 * 60),     # сутки поминутно
+    ("hour", 3600, 30 * 24),     # 30 дней по часам
+    ("day", 86400, 2 * 365),     # 2 года по дням
+)
+
+# Метрики Prometheus (http://METRICS_HOST:METRICS_PORT/metrics; порт 0 — выключено)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Например, 9464; по умолчанию выключено
+
+# Исходящие сообщения (лимиты Telegram)
+TG_GLOBAL_RATE = 30          # Сообщений в секунду на всего бота
+TG_CHAT_RATE = 1             # Сообщений в секунду в один личный чат
+TG_GROUP_RATE = 20 / 60      # Сообщений в секунду в одну группу
+TG_CHAT_BURST = 3            # Сколько сообщений в чат можно отправить подряд без паузы
+TG_MAX_RETRIES = 3           # Повторов после 429 Too Many Requests
+
+# HTTP клиент для API курсов
+HTTP_POOL_SIZE = 20          # Всего соединений в пуле
+HTTP_POOL_PER_HOST = 8       # Соединений на один хост
+HTTP_DNS_TTL = 300           # Кэш DNS, секунд
+HTTP_KEEPALIVE = 30          # Сколько держать простаивающее соединение, секунд
+HTTP_CONNECT_TIMEOUT = 3     # Таймаут на установку соединения
+HTTP_READ_TIMEOUT = 7        # Таймаут на чтение ответа
 
 # Фиатные валюты
 FIAT = {
@@ -60,11 +232,271 @@ CRYPTO = {
 ALL_CURRENCIES = {**{k: (v[0], v[1]) for k, v in FIAT.items()},
                   **{k: (v[0], v[1]) for k, v in CRYPTO.items()}}
 
+CURRENCY_GROUPS = {"fiat": FIAT, "crypto": CRYPTO}
+
+# Как ещё пишут валюты в быстром вводе (регистр не важен, коды валют распознаются и так)
+CURRENCY_ALIASES = {
+    "USD": ("$", "доллар", "доллара", "долларов", "долларах", "долл", "бакс", "бакса", "баксов", "баксы"),
+    "EUR": ("€", "евро"),
+    "RUB": ("₽", "руб", "рубль", "рубля", "рублей", "рублях", "р"),
+    "UAH": ("₴", "грн", "гривна", "гривны", "гривен", "гривнах"),
+    "KZT": ("₸", "тенге"),
+    "BYN": ("br", "белруб"),
+    "GBP": ("£", "фунт", "фунта", "фунтов"),
+    "CNY": ("¥", "юань", "юаня", "юаней", "rmb"),
+    "TRY": ("₺", "лира", "лиры", "лир"),
+    "GEL": ("₾", "лари"),
+    "PLN": ("zł", "zl", "злотый", "злотых"),
+    "CHF": ("франк", "франка", "франков"),
+    "BTC": ("₿", "биткоин", "биткоина", "биткоинов", "биток", "битка", "битков", "xbt"),
+    "ETH": ("эфир", "эфира", "эфиров", "ether"),
+    "USDT": ("тезер", "юсдт"),
+    "TON": ("тон", "тона", "тонкоин"),
+    "DOGE": ("доге", "дог"),
+    "SOL": ("солана", "соланы"),
+    "LTC": ("лайткоин",),
+    "MATIC": ("pol",),
+}
+
+# Популярные пары
+POPULAR_PAIRS = [("BTC", "USD"), ("ETH", "USD"), ("USD", "RUB"), ("BTC", "RUB"),
+                 ("EUR", "USD"), ("TON", "USD"), ("USD", "UAH"), ("SOL", "USD")]
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              МЕТРИКИ
+# ══════════════════════════════════════════════════════════════════════════════
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами (как в Prometheus)"""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Счётчики и гистограммы в памяти, отдаются в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._histograms: dict[tuple[str, tuple], Histogram] = {}
+        self._help: dict[str, str] = {}
+        self.gauges: list = []  # Функции -> [(имя, метки, значение)], вызываются при сборе
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        key = (name, labels)
+        hist = self._histograms.get(key)
+        if hist is None:
+            hist = self._histograms[key] = Histogram()
+        hist.observe(value)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def _header(self, lines: list[str], seen: set, name: str, kind: str):
+        if name not in seen:
+            seen.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    def render(self) -> str:
+        lines, seen = [], set()
+
+        for (name, labels), value in sorted(self._counters.items()):
+            self._header(lines, seen, name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+
+        for (name, labels), hist in sorted(self._histograms.items(), key=lambda kv: kv[0]):
+            self._header(lines, seen, name, "histogram")
+            cumulative = 0
+            for bound, count in zip((*hist.buckets, "+Inf"), hist.counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{name}_bucket{self._labels(labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist.count}")
+
+        for collect in self.gauges:
+            try:
+                samples = collect()
+            except Exception as e:
+                logging.error(f"Metrics gauge error: {e}")
+                continue
+            for name, labels, value in samples:
+                self._header(lines, seen, name, "gauge")
+                lines.append(f"{name}{self._labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "Время обработки апдейта хендлером")
+metrics.describe("bot_rate_cache_total", "Обращения к кэшу курсов: hit / stale / miss")
+metrics.describe("bot_upstream_seconds", "Время запросов к API курсов")
+metrics.describe("bot_upstream_errors_total", "Ошибки запросов к API курсов")
+metrics.describe("bot_upstream_hedges_total", "Запасные запросы к другому источнику: slow / failover")
+metrics.describe("bot_upstream_outliers_total", "Курсы, отброшенные сверкой с медианой источников")
+metrics.describe("bot_telegram_seconds", "Время запросов к Telegram Bot API")
+metrics.describe("bot_telegram_errors_total", "Ошибки запросов к Telegram Bot API")
+metrics.describe("bot_loop_lag_seconds", "Задержка цикла событий")
+metrics.describe("bot_updates_dropped_total", "Отброшенные апдейты: debounce / superseded / shed")
+metrics.describe("bot_digest_messages_total", "Сообщения рассылки сводок: sent / failed / gone / empty")
+metrics.describe("bot_digest_rate", "Скорость последней рассылки сводок, сообщений в секунду")
+metrics.describe("bot_digest_subscribers", "Подписчики сводок")
+metrics.describe("bot_slow_updates_total", "Апдейты дольше SLOW_UPDATE")
+
+
+class UpdateTrace:
+    """Время одного апдейта по этапам: fsm, rates, render, send_queue, telegram"""
+    __slots__ = ("stages", "handler")
+
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self.handler = ""
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+update_trace: ContextVar[Optional[UpdateTrace]] = ContextVar("update_trace", default=None)
+
+
+def traced(stage: str):
+    """Декоратор: время вызова засчитывается в этап stage апдейта, который сейчас обрабатывается"""
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                trace = update_trace.get()
+                if trace is None:
+                    return await func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    trace.add(stage, time.perf_counter() - started)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                trace = update_trace.get()
+                if trace is None:
+                    return func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    trace.add(stage, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(port: Optional[int] = None) -> Optional[web.AppRunner]:
+    """Локальный HTTP-эндпоинт /metrics для Prometheus"""
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError as e:
+        # Занятый порт не должен мешать самому боту
+        logging.error(f"Metrics server on {METRICS_HOST}:{port} not started: {e}")
+        await runner.cleanup()
+        return None
+    print(f"📊 Метрики: http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 #                              API СЕРВИС
 # ══════════════════════════════════════════════════════════════════════════════
 
-cache = TTLCache(maxsize=100, ttl=60)  # Кэш на 60 секунд
+@dataclass
+class CachedRates:
+    """Последние удачно полученные курсы"""
+    data: dict[str, float]
+    fetched_at: float
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+
+cache: dict[str, CachedRates] = {}  # "crypto" / "fiat" -> последние курсы
+
+
+class RateStore:
+    """Хранилище последних удачных курсов в SQLite"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+
+    def open(self):
+        self._db = sqlite3.connect(self.path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rates (kind TEXT PRIMARY KEY, fetched_at REAL, payload TEXT)"
+        )
+        self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def load(self) -> dict[str, CachedRates]:
+        """Прочитать сохранённые курсы"""
+        if self._db is None:
+            return {}
+        rows = self._db.execute("SELECT kind, fetched_at, payload FROM rates").fetchall()
+        return {kind: CachedRates(data=json.loads(payload), fetched_at=fetched_at)
+                for kind, fetched_at, payload in rows}
+
+    def save(self, kind: str, entry: CachedRates):
+        """Сохранить курсы одного типа"""
+        if self._db is None:
+            return
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO rates VALUES (?, ?, ?)",
+                (kind, entry.fetched_at, json.dumps(entry.data, separators=(",", ":")))
+            )
+            self._db.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Rate store error: {e}")
+
+
+rate_store = RateStore(RATES_DB)
 
 
 @dataclass
@@ -79,91 +511,1023 @@ class ConversionResult:
     to_usd: float
 
 
+@dataclass(frozen=True)
+class RateSnapshot:
+    """Неизменяемый срез курсов с готовой матрицей кросс-курсов для ALL_CURRENCIES.
+
+    Монет каталога могут быть тысячи: квадратная матрица на них стоила бы десятки мегабайт
+    и миллисекунд на каждую пересборку, поэтому их курсы считаются на лету из usd.
+    """
+    version: int
+    fetched_at: float              # Время самых старых обязательных курсов (crypto, fiat) в срезе
+    codes: tuple[str, ...]
+    index: Mapping[str, int]
+    usd: np.ndarray                # usd[i] — цена 1 codes[i] в USD (nan, если курса нет)
+    matrix: np.ndarray             # matrix[i, j] — сколько codes[j] дают за 1 codes[i], i, j < len(ALL_CURRENCIES)
+
+    @staticmethod
+    def build(version: int, crypto: dict[str, float], fiat: dict[str, float],
+              fetched_at: float, coins: Optional[dict[str, float]] = None) -> "RateSnapshot":
+        """Собрать срез: сначала все ALL_CURRENCIES (в том же порядке), за ними монеты каталога"""
+        coins = coins or {}
+        codes = tuple(ALL_CURRENCIES) + tuple(sorted(c for c in coins if c not in ALL_CURRENCIES))
+        usd = np.full(len(codes), np.nan)
+
+        for i, code in enumerate(codes):
+            if code in crypto:
+                usd[i] = crypto[code]
+            elif code == "USD":
+                usd[i] = 1.0
+            elif fiat.get(code):
+                usd[i] = 1.0 / fiat[code]
+            elif code in coins:
+                usd[i] = coins[code]
+
+        return RateSnapshot.from_usd(version, fetched_at, codes, usd)
+
+    @staticmethod
+    def from_usd(version: int, fetched_at: float, codes: tuple[str, ...], usd: np.ndarray) -> "RateSnapshot":
+        """Срез из готовых цен в USD (usd становится частью среза и больше не меняется).
+
+        codes начинаются с ALL_CURRENCIES в том же порядке, как их раскладывает build.
+        """
+        n = min(len(codes), len(ALL_CURRENCIES))
+        matrix = usd[:n, None] / usd[None, :n]
+        usd.flags.writeable = False
+        matrix.flags.writeable = False
+
+        return RateSnapshot(
+            version=version,
+            fetched_at=fetched_at,
+            codes=codes,
+            index=MappingProxyType({code: i for i, code in enumerate(codes)}),
+            usd=usd,
+            matrix=matrix,
+        )
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+    def usd_price(self, code: str) -> Optional[float]:
+        i = self.index.get(code)
+        if i is None or np.isnan(self.usd[i]):
+            return None
+        return float(self.usd[i])
+
+    def convert_many(self, amounts: np.ndarray, from_codes: list[str], to_codes: list[str]) -> np.ndarray:
+        """Векторная конвертация пачки (сумма, из, в); nan — курса нет"""
+        rows = np.fromiter((self.index.get(c, -1) for c in from_codes), dtype=np.intp, count=len(from_codes))
+        cols = np.fromiter((self.index.get(c, -1) for c in to_codes), dtype=np.intp, count=len(to_codes))
+        result = amounts * (self.usd[rows] / self.usd[cols])
+        result[(rows < 0) | (cols < 0)] = np.nan  # Монеты без цены в срезе
+        return result
+
+    def convert_all(self, amount: float, from_code: str) -> Optional[np.ndarray]:
+        """Сумма во всех валютах среза разом: amount * usd[from] / usd"""
+        i = self.index.get(from_code)
+        if i is None or np.isnan(self.usd[i]):
+            return None
+        return amount * self.usd[i] / self.usd
+
+    def rate(self, from_code: str, to_code: str) -> Optional[float]:
+        """Кросс-курс: выборка из матрицы, для монет каталога — usd[i] / usd[j]"""
+        i, j = self.index.get(from_code), self.index.get(to_code)
+        if i is None or j is None:
+            return None
+        n = len(self.matrix)
+        rate = float(self.matrix[i, j] if i < n and j < n else self.usd[i] / self.usd[j])
+        return None if np.isnan(rate) else rate
+
+    def convert(self, amount: float, from_code: str, to_code: str) -> Optional[ConversionResult]:
+        """Конвертация без сетевых запросов"""
+        rate = self.rate(from_code, to_code)
+        if rate is None:
+            return None
+
+        return ConversionResult(
+            amount=amount,
+            from_code=from_code,
+            to_code=to_code,
+            result=amount * rate,
+            rate=rate,
+            from_usd=float(self.usd[self.index[from_code]]),
+            to_usd=float(self.usd[self.index[to_code]])
+        )
+
+
+class CircuitBreaker:
+    """Размыкатель цепи: после серии ошибок источник отдыхает, затем одна пробная попытка"""
+    __slots__ = ("failures", "opened_at", "cooldown", "probing")
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.cooldown: float = BREAKER_COOLDOWN
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.probing else "open"
+
+    def allow(self) -> bool:
+        """Можно ли сейчас обращаться к источнику"""
+        if self.opened_at is None:
+            return True
+        if not self.probing and time.time() - self.opened_at >= self.cooldown:
+            self.probing = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.cooldown = BREAKER_COOLDOWN
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing:
+            # Пробная попытка не удалась — отдыхаем вдвое дольше
+            self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+            self.opened_at = time.time()
+            self.probing = False
+        elif self.opened_at is None and self.failures >= BREAKER_FAILURES:
+            self.opened_at = time.time()
+
+    def cancel(self):
+        """Запрос отменён (проиграл гонку) — не считается ни успехом, ни ошибкой"""
+        self.probing = False
+
+
+class RateProvider(ABC):
+    """Источник курсов: URL запроса и разбор ответа в {код: значение}"""
+    name = ""
+    kind = ""
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.latencies: deque[float] = deque(maxlen=HEDGE_WINDOW)
+        self.last: Optional[CachedRates] = None  # Последний удачный ответ (для сверки)
+
+    @abstractmethod
+    def url(self) -> str:
+        ...
+
+    @abstractmethod
+    def parse(self, data) -> Optional[dict[str, float]]:
+        ...
+
+    def hedge_delay(self) -> float:
+        """Сколько ждать ответа, прежде чем спросить следующий источник"""
+        if len(self.latencies) < 5:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(self.latencies)
+        value = ordered[min(len(ordered) - 1, int(HEDGE_PERCENTILE * len(ordered)))]
+        return max(HEDGE_MIN_DELAY, min(value, HTTP_READ_TIMEOUT))
+
+    async def load(self) -> Optional[dict[str, float]]:
+        started = time.perf_counter()
+        try:
+            data = await CurrencyAPI._fetch(self.url())
+        except asyncio.CancelledError:
+            # Проигравший запрос всё равно даёт нижнюю оценку задержки
+            self.latencies.append(time.perf_counter() - started)
+            self.breaker.cancel()
+            raise
+        self.latencies.append(time.perf_counter() - started)
+
+        try:
+            rates = self.parse(data) if data else None
+        except Exception as e:  # Ответ любой формы не должен ронять пул источников
+            logging.error(f"Provider {self.name} bad response: {e!r}")
+            rates = None
+
+        if not rates:
+            self.breaker.failure()
+            return None
+        self.breaker.success()
+        self.last = CachedRates(data=rates, fetched_at=time.time())
+        return rates
+
+
+class CoinGeckoProvider(RateProvider):
+    name, kind = "coingecko", "crypto"
+
+    def url(self) -> str:
+        ids = ",".join(v[2] for v in CRYPTO.values())
+        return f"{COINGECKO_API}/simple/price?ids={ids}&vs_currencies=usd"
+
+    def parse(self, data) -> Optional[dict[str, float]]:
+        return {code: float(data[info[2]]["usd"]) for code, info in CRYPTO.items() if info[2] in data}
+
+
+class CryptoCompareProvider(RateProvider):
+    name, kind = "cryptocompare", "crypto"
+
+    def url(self) -> str:
+        return f"{CRYPTOCOMPARE_API}/pricemulti?fsyms={','.join(CRYPTO)}&tsyms=USD"
+
+    def parse(self, data) -> Optional[dict[str, float]]:
+        return {code: float(data[code]["USD"]) for code in CRYPTO if code in data}
+
+
+class BinanceProvider(RateProvider):
+    """Цены к USDT считаются ценами к USD; расхождение при депеге поймает сверка"""
+    name, kind = "binance", "crypto"
+    SKIP = {"USDT", "MATIC"}  # Нет пары к USDT (неизвестный символ ломает весь запрос)
+
+    def url(self) -> str:
+        symbols = ",".join(f'"{code}USDT"' for code in CRYPTO if code not in self.SKIP)
+        return f"{BINANCE_API}/ticker/price?symbols=[{symbols}]"
+
+    def parse(self, data) -> Optional[dict[str, float]]:
+        return {item["symbol"][:-4]: float(item["price"]) for item in data if item["symbol"].endswith("USDT")}
+
+
+class FrankfurterProvider(RateProvider):
+    name, kind = "frankfurter", "fiat"
+
+    def url(self) -> str:
+        return f"{FRANKFURTER_API}/latest?from=USD"
+
+    def parse(self, data) -> Optional[dict[str, float]]:
+        if "rates" not in data:
+            return None
+        return {**data["rates"], "USD": 1.0}
+
+
+class OpenERProvider(RateProvider):
+    name, kind = "open_er_api", "fiat"
+
+    def url(self) -> str:
+        return f"{OPEN_ER_API}/latest/USD"
+
+    def parse(self, data) -> Optional[dict[str, float]]:
+        if data.get("result") != "success":
+            return None
+        return {code: data["rates"][code] for code in FIAT if code in data["rates"]}
+
+
+PROVIDER_TYPES = {cls.name: cls for cls in (CoinGeckoProvider, CryptoCompareProvider, BinanceProvider,
+                                             FrankfurterProvider, OpenERProvider)}
+
+
+class ProviderPool:
+    """Несколько источников одного типа: хеджированные запросы, размыкатели и сверка по медиане"""
+
+    def __init__(self, kind: str, names: tuple[str, ...]):
+        self.kind = kind
+        self.providers: list[RateProvider] = [PROVIDER_TYPES[name]() for name in names]
+        self._rounds = 0
+
+    async def load(self) -> Optional[dict[str, float]]:
+        """Курсы от первого ответившего источника, сверенные с остальными"""
+        candidates = [p for p in self.providers if p.breaker.allow()]
+        if not candidates:
+            logging.warning(f"All {self.kind} providers are switched off by circuit breakers")
+            return None
+
+        self._rounds += 1
+        if self._rounds % SANITY_EVERY == 0 and len(candidates) > 1:
+            winner, data = await self._all(candidates)
+        else:
+            winner, data = await self._hedged(candidates)
+
+        if data is None:
+            return None
+        return self._sanity_check(winner, data)
+
+    async def _hedged(self, candidates: list[RateProvider]) -> tuple[Optional[RateProvider], Optional[dict]]:
+        """Основной источник; если он медлит дольше обычного или упал — параллельно следующий"""
+        waiting = list(candidates)
+        pending: dict[asyncio.Task, RateProvider] = {}
+        reason = None
+        try:
+            while waiting or pending:
+                timeout = None
+                if waiting:
+                    provider = waiting.pop(0)
+                    if reason:
+                        metrics.inc("bot_upstream_hedges_total", (("kind", self.kind), ("reason", reason)))
+                    pending[asyncio.create_task(provider.load())] = provider
+                    timeout = provider.hedge_delay() if waiting else None
+
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                reason = "failover" if done else "slow"
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.result():
+                        return provider, task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        return None, None
+
+    async def _all(self, candidates: list[RateProvider]) -> tuple[Optional[RateProvider], Optional[dict]]:
+        """Опросить все источники разом; результатом служит самый приоритетный из ответивших"""
+        results = await asyncio.gather(*(p.load() for p in candidates))
+        for provider, data in zip(candidates, results):
+            if data:
+                return provider, data
+        return None, None
+
+    def _sanity_check(self, winner: RateProvider, data: dict[str, float]) -> dict[str, float]:
+        """Заменить выбросы медианой источников и дополнить недостающие коды.
+
+        Голосуют только свежие ответы других источников: прошлый результат
+        пула — это в основном прежний ответ того же победителя, и он не
+        должен ни перевешивать других, ни тянуть за собой давно пропавшие коды.
+        """
+        now = time.time()
+        others = [p.last.data for p in self.providers
+                  if p is not winner and p.last is not None and now - p.last.fetched_at < SOURCE_MAX_AGE]
+        if not others:
+            return data
+
+        checked = dict(data)
+        for other in others:
+            for code, value in other.items():
+                checked.setdefault(code, value)
+
+        for code, value in data.items():
+            votes = [value] + [o[code] for o in others if o.get(code)]
+            if len(votes) < 3:
+                continue  # Из двух значений не понять, какое неверное
+            median = float(np.median(votes))
+            if median and abs(value / median - 1) > SANITY_MAX_DEVIATION:
+                logging.warning(f"Outlier from {winner.name}: {code}={value} (median {median:.6g})")
+                metrics.inc("bot_upstream_outliers_total", (("provider", winner.name),))
+                checked[code] = median
+        return checked
+
+    def stats(self) -> list[tuple[str, tuple, float]]:
+        samples = []
+        for p in self.providers:
+            labels = (("provider", p.name),)
+            samples.append(("bot_upstream_breaker_open", labels, int(p.breaker.state != "closed")))
+            samples.append(("bot_upstream_hedge_delay_seconds", labels, p.hedge_delay()))
+        return samples
+
+
+providers = {kind: ProviderPool(kind, names) for kind, names in RATE_PROVIDERS.items()}
+
+
 class CurrencyAPI:
     """Работа с API курсов валют"""
 
+    _session: Optional[aiohttp.ClientSession] = None
+    _inflight: dict[str, asyncio.Task] = {}  # Запросы в полёте (single-flight)
+    coalesced = 0                            # Сколько вызовов дождались чужого запроса
+    snapshot: Optional[RateSnapshot] = None  # Текущий срез курсов
+    listeners: list = []                     # Вызываются с каждым новым срезом
+    shared: Optional["SharedRates"] = None   # В процессе-воркере: срез приходит от координатора
+
+    @staticmethod
+    def session() -> aiohttp.ClientSession:
+        """Общая HTTP-сессия с пулом соединений (создаётся при первом обращении)"""
+        if CurrencyAPI._session is None or CurrencyAPI._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE,
+                limit_per_host=HTTP_POOL_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT,
+                connect=HTTP_CONNECT_TIMEOUT,
+                sock_read=HTTP_READ_TIMEOUT,
+            )
+            CurrencyAPI._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return CurrencyAPI._session
+
+    @staticmethod
+    async def close():
+        """Закрыть HTTP-сессию при остановке бота"""
+        if CurrencyAPI._session is not None and not CurrencyAPI._session.closed:
+            await CurrencyAPI._session.close()
+        CurrencyAPI._session = None
+
     @staticmethod
     async def _fetch(url: str) -> Optional[dict]:
         """HTTP GET запрос"""
+        labels = (("api", urlsplit(url).hostname),)
+        started = time.perf_counter()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as r:
-                    return await r.json() if r.status == 200 else None
+            async with CurrencyAPI.session().get(url) as r:
+                data = await r.json() if r.status == 200 else None
+            if data is None:
+                metrics.inc("bot_upstream_errors_total", labels + (("reason", f"http_{r.status}"),))
+            return data
         except Exception as e:
             logging.error(f"API error: {e}")
+            metrics.inc("bot_upstream_errors_total", labels + (("reason", type(e).__name__),))
             return None
+        finally:
+            metrics.observe("bot_upstream_seconds", time.perf_counter() - started, labels)
 
     @staticmethod
-    async def get_crypto_prices() -> dict[str, float]:
-        """Получить цены крипты в USD"""
-        if "crypto" in cache:
-            return cache["crypto"]
+    async def _single_flight(key: str, factory) -> Optional[dict]:
+        """Все одновременные вызовы с одним ключом ждут один и тот же запрос"""
+        task = CurrencyAPI._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            CurrencyAPI._inflight[key] = task
+
+            def _done(t: asyncio.Task):
+                if CurrencyAPI._inflight.get(key) is t:
+                    del CurrencyAPI._inflight[key]
+
+            task.add_done_callback(_done)
+        else:
+            CurrencyAPI.coalesced += 1
 
-        ids = ",".join(v[2] for v in CRYPTO.values())
-        data = await CurrencyAPI._fetch(f"{COINGECKO_API}/simple/price?ids={ids}&vs_currencies=usd")
+        # shield: отмена одного ожидающего не обрывает запрос для остальных
+        return await asyncio.shield(task)
 
-        if data:
-            result = {code: data[info[2]]["usd"] for code, info in CRYPTO.items() if info[2] in data}
-            cache["crypto"] = result
-            return result
-        return {}
+    @staticmethod
+    async def refresh(kind: str) -> Optional[dict[str, float]]:
+        """Запросить свежие курсы и положить в кэш"""
+        loader = catalog.load_prices if kind == "coins" else providers[kind].load
+        data = await CurrencyAPI._single_flight(kind, loader)
+        if data and (kind not in cache or cache[kind].data is not data):
+            cache[kind] = CachedRates(data=data, fetched_at=time.time())
+            rate_store.save(kind, cache[kind])
+            CurrencyAPI._rebuild_snapshot()
+        return data
 
     @staticmethod
-    async def get_fiat_rates() -> dict[str, float]:
-        """Получить курсы фиата к USD"""
-        if "fiat" in cache:
-            return cache["fiat"]
+    def load_saved():
+        """Тёплый старт: поднять последние сохранённые курсы до первого запроса к API"""
+        saved = rate_store.load()
+        for kind, entry in saved.items():
+            if kind in RATE_KINDS and kind not in cache:
+                cache[kind] = entry
+        if saved:
+            CurrencyAPI._rebuild_snapshot()
+            logging.info(f"Loaded saved rates: {', '.join(f'{k} ({fmt_age(e.age)})' for k, e in saved.items())}")
 
-        data = await CurrencyAPI._fetch(f"{FRANKFURTER_API}/latest?from=USD")
+    @staticmethod
+    def _rebuild_snapshot():
+        """Пересобрать срез после обновления любого из источников"""
+        entries = [cache[kind] for kind in RATE_KINDS if kind in cache]
+        if not entries:
+            return
+        # Возраст среза — по обязательным курсам: устаревшие или не пришедшие цены монет каталога
+        # не должны помечать устаревшей каждую конвертацию и будить обновление на каждом запросе
+        required = [cache[kind] for kind in REQUIRED_RATE_KINDS if kind in cache] or entries
+        version = CurrencyAPI.snapshot.version + 1 if CurrencyAPI.snapshot else 1
+        CurrencyAPI.snapshot = RateSnapshot.build(
+            version,
+            crypto=cache["crypto"].data if "crypto" in cache else {},
+            fiat=cache["fiat"].data if "fiat" in cache else {},
+            fetched_at=min(e.fetched_at for e in required),
+            coins=cache["coins"].data if "coins" in cache else None,
+        )
+        for listener in CurrencyAPI.listeners:
+            try:
+                listener(CurrencyAPI.snapshot)
+            except Exception as e:
+                logging.exception(f"Snapshot listener error: {e}")
 
-        if data and "rates" in data:
-            rates = data["rates"]
-            rates["USD"] = 1.0
-            cache["fiat"] = rates
-            return rates
-        return {}
+    @staticmethod
+    @traced("rates")
+    async def get_snapshot(*codes: str) -> Optional[RateSnapshot]:
+        """Текущий срез курсов; недостающие источники запрашиваются параллельно.
+
+        codes — нужные валюты: монеты каталога без цены в срезе подтягиваются сразу.
+        """
+        if CurrencyAPI.shared is not None:
+            return await CurrencyAPI.shared.get_snapshot(codes)
+        refresher.touch()
+        if codes:
+            await catalog.ensure(codes)
+        missing = [kind for kind in REQUIRED_RATE_KINDS if kind not in cache]
+
+        if missing:
+            metrics.inc("bot_rate_cache_total", (("result", "miss"),))
+            await asyncio.gather(*(CurrencyAPI.refresh(kind) for kind in missing))
+        elif CurrencyAPI.snapshot.age > RATES_TTL:
+            metrics.inc("bot_rate_cache_total", (("result", "stale"),))
+            refresher.kick()
+        else:
+            metrics.inc("bot_rate_cache_total", (("result", "hit"),))
+        return CurrencyAPI.snapshot
+
+
+class RateRefresher:
+    """Фоновое обновление курсов: интервал подстраивается под спрос и бюджет API"""
+
+    def __init__(self):
+        self.interval: float = REFRESH_MAX_INTERVAL
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._reads = 0
+        self._demand = 0.0  # Запросов курса в минуту (EWMA)
+        self._demand_ts = time.time()
+        self._last_attempt: dict[str, float] = {}
+
+    def touch(self, count: int = 1):
+        """Учесть обращения к курсам"""
+        self._reads += count
+
+    def kick(self):
+        """Курс устарел — обновить, не дожидаясь расписания"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _update_demand(self):
+        now = time.time()
+        elapsed = now - self._demand_ts
+        if elapsed < 10:
+            return
+        rate = self._reads * 60 / elapsed
+        self._demand = 0.7 * self._demand + 0.3 * rate
+        self._reads, self._demand_ts = 0, now
+
+        interval = REFRESH_MAX_INTERVAL / (1 + self._demand / DEMAND_SCALE)
+        self.interval = max(REFRESH_MIN_INTERVAL, min(REFRESH_MAX_INTERVAL, interval))
+
+    def _due_at(self, kind: str, urgent: bool) -> float:
+        """Момент, когда пора обновить курсы данного типа"""
+        spacing = 60 / API_CALLS_PER_MIN[kind]
+        allowed = self._last_attempt.get(kind, 0.0) + spacing
+
+        entry = cache.get(kind)
+        if entry is None:
+            return allowed
+        wanted = entry.fetched_at + (min(self.interval, RATES_TTL) if urgent else self.interval)
+        return max(allowed, wanted)
+
+    async def _run(self):
+        urgent = False
+        while True:
+            now = time.time()
+            due = [kind for kind in RATE_KINDS if self._due_at(kind, urgent) <= now]
+
+            if due:
+                for kind in due:
+                    self._last_attempt[kind] = now
+                self._wakeup.clear()
+                results = await asyncio.gather(*(CurrencyAPI.refresh(k) for k in due), return_exceptions=True)
+                for kind, res in zip(due, results):
+                    if isinstance(res, Exception):
+                        logging.error(f"Refresh {kind} failed: {res}")
+                urgent = False
+
+            self._update_demand()
+
+            delay = min(self._due_at(kind, urgent) for kind in RATE_KINDS) - time.time()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay, 1.0))
+                self._wakeup.clear()
+                urgent = True
+            except asyncio.TimeoutError:
+                pass
+
+
+refresher = RateRefresher()
+
+
+COIN_CODE_RE = re.compile(r"^[A-Z0-9]{2,10}$")  # Какие символы монет годятся в коды (и в callback-данные)
+
+
+class CoinCatalog:
+    """Каталог монет CoinGecko: индекс по символам и названиям, ленивые цены чанками"""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.names: dict[str, str] = {}                   # id -> название
+        self.by_symbol: dict[str, str] = {}               # код -> id основной монеты с этим символом
+        self.collisions: dict[str, tuple[str, ...]] = {}  # код -> все id с этим символом, основная первой
+        self.code_of: dict[str, str] = {}                 # id основной монеты -> код
+        self.popular: tuple[str, ...] = ()                # Коды по убыванию капитализации
+        self.loaded_at = 0.0
+        self.pinned: list = []                            # Функции -> коды, цены которых нужны всегда
+        self._top: list[str] = []
+        self._search = self._builtin_search()             # (название или символ в нижнем регистре, код)
+        self._tracked: OrderedDict[str, float] = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+
+    # ─── Индекс ───
 
     @staticmethod
-    async def convert(amount: float, from_code: str, to_code: str) -> Optional[ConversionResult]:
-        """Конвертировать валюту"""
-        from_code, to_code = from_code.upper(), to_code.upper()
+    def _builtin_search() -> list[tuple[str, str]]:
+        """Поиск по встроенным валютам и псевдонимам: работает и до загрузки каталога"""
+        search = [(code.lower(), code) for code in ALL_CURRENCIES]
+        search += [(name.lower(), code) for code, (name, _) in ALL_CURRENCIES.items()]
+        search += [(alias.lower(), code) for code, aliases in CURRENCY_ALIASES.items() for alias in aliases]
+        return sorted(set(search))
+
+    def _index(self, coins: list, top: list[str]):
+        """Построить индексы; при совпадении символов основной считается встроенная монета,
+        затем более крупная по капитализации, затем с самым коротким id"""
+        curated = {info[2]: code for code, info in CRYPTO.items()}
+        rank = {coin_id: i for i, coin_id in enumerate(top)}
+        names, groups = {}, {}
+
+        for coin_id, symbol, name in coins:
+            names[coin_id] = name
+            code = curated.get(coin_id) or symbol.upper()
+            if COIN_CODE_RE.match(code) and code not in FIAT:  # Фиат важнее одноимённых монет
+                groups.setdefault(code, []).append(coin_id)
+
+        by_symbol, collisions = {}, {}
+        for code, ids in groups.items():
+            ids.sort(key=lambda i: (i not in curated, rank.get(i, len(rank)), len(i), i))
+            by_symbol[code] = ids[0]
+            if len(ids) > 1:
+                collisions[code] = tuple(ids)
+        code_of = {coin_id: code for code, coin_id in by_symbol.items()}
+
+        search = self._builtin_search()
+        for coin_id, code in code_of.items():
+            search.append((code.lower(), code))
+            search.append((names[coin_id].lower(), code))
+
+        popular = tuple(code_of[i] for i in top if i in code_of)
+        self.names, self.by_symbol, self.collisions, self.code_of = names, by_symbol, collisions, code_of
+        self._top = list(top)
+        self._search = sorted(set(search))
+
+        # Кэши, зависящие от набора валют; клавиатуры дорогие — только если сменились популярные
+        tokenize_quick.cache_clear()
+        if popular != self.popular:
+            self.popular = popular
+            kb_currencies.cache_clear()
+            _prebuild_keyboards()
+
+    def code(self, word: str) -> Optional[str]:
+        """Код монеты по символу в любом регистре"""
+        code = word.upper()
+        return code if code in self.by_symbol else None
+
+    def name(self, code: str) -> Optional[str]:
+        coin_id = self.by_symbol.get(code)
+        return self.names.get(coin_id) if coin_id else None
+
+    def search(self, query: str, limit: int = COINS_SEARCH_LIMIT) -> list[str]:
+        """Коды валют, у которых символ или название начинается с query; крупные монеты первыми"""
+        q = query.strip().lower()
+        if not q:
+            return []
+        popularity = {code: i for i, code in enumerate(self.popular)}
+        found: dict[str, int] = {}
+        i = bisect.bisect_left(self._search, (q, ""))
+        while i < len(self._search) and self._search[i][0].startswith(q) and len(found) < limit * 20:
+            key, code = self._search[i]
+            # Точное совпадение и встроенные валюты выше, дальше по капитализации
+            score = (0 if key == q else 1) * 10**6 + (0 if code in ALL_CURRENCIES else popularity.get(code, 10**5))
+            found[code] = min(score, found.get(code, score))
+            i += 1
+        return sorted(found, key=found.get)[:limit]
+
+    # ─── Загрузка каталога ───
+
+    def open(self):
+        """Прочитать каталог с диска; обновлять его будет фоновая задача"""
+        self._apply(self._read())
+
+        # Монеты, которые спрашивали до перезапуска, обновляются и дальше
+        if "coins" in cache:
+            for code in cache["coins"].data:
+                if code in self.by_symbol and code not in self.popular:
+                    self._tracked[code] = time.time()
+
+    def _read(self) -> Optional[dict]:
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Coin catalog load error: {e}")
+            return None
 
-        crypto = await CurrencyAPI.get_crypto_prices()
-        fiat = await CurrencyAPI.get_fiat_rates()
+    def _apply(self, data: Optional[dict]):
+        if not data:
+            return
+        try:
+            self._index(data["coins"], data["top"])
+            self.loaded_at = data["saved_at"]
+            logging.info(f"Coin catalog loaded: {len(self.names)} coins ({fmt_age(time.time() - self.loaded_at)})")
+        except (KeyError, TypeError, ValueError) as e:
+            logging.error(f"Coin catalog load error: {e}")
+
+    async def follow(self, loaded_at: float):
+        """Воркер: координатор сохранил более новый каталог — перечитать файл (JSON разбирается в потоке)"""
+        if loaded_at <= self.loaded_at:
+            return
+        self.loaded_at = loaded_at  # Повторные вызовы до конца чтения ничего не делают
+        self._apply(await asyncio.get_running_loop().run_in_executor(None, self._read))
+
+    async def reload(self) -> bool:
+        """Скачать список монет и первую страницу рейтинга"""
+        coins, markets = await asyncio.gather(
+            CurrencyAPI._fetch(f"{COINGECKO_API}/coins/list"),
+            CurrencyAPI._fetch(self._markets_url()),
+        )
+        if not isinstance(coins, list):
+            return False
+
+        rows = [(c["id"], c["symbol"], c["name"]) for c in coins if c.get("id") and c.get("symbol")]
+        top = [m["id"] for m in markets] if isinstance(markets, list) else self._top
+        self._index(rows, top)
+        self.loaded_at = time.time()
+        logging.info(f"Coin catalog updated: {len(rows)} coins, {len(self.by_symbol)} codes, "
+                     f"{len(self.collisions)} shared symbols")
+
+        if self.path:
+            payload = {"saved_at": self.loaded_at, "top": top, "coins": rows}
+            await asyncio.get_running_loop().run_in_executor(None, self._write, payload)
+        return True
+
+    def _write(self, payload: dict):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.error(f"Coin catalog save error: {e}")
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            delay = COINS_TTL - (time.time() - self.loaded_at)
+            if delay <= 0:
+                delay = COINS_TTL if await self.reload() else 300  # Не вышло — повторить через 5 минут
+                refresher.kick()
+            await asyncio.sleep(delay)
+
+    # ─── Цены ───
+
+    def track(self, code: str):
+        """Запомнить, что монета нужна: её цена будет обновляться вместе с популярными"""
+        if code in self.by_symbol and code not in ALL_CURRENCIES:
+            self._tracked[code] = time.time()
+            self._tracked.move_to_end(code)
+            while len(self._tracked) > COINS_TRACKED_MAX:
+                self._tracked.popitem(last=False)
+
+    def _markets_url(self) -> str:
+        return f"{COINGECKO_API}/coins/markets?vs_currency=usd&order=market_cap_desc&per_page={COINS_TOP}&page=1"
 
-        def get_usd_price(code: str) -> Optional[float]:
-            if code in crypto:
-                return crypto[code]
-            if code == "USD":
-                return 1.0
-            if code in fiat:
-                return 1.0 / fiat[code]
+    @staticmethod
+    def _chunks(ids: list[str]) -> list[list[str]]:
+        """Разбить id на группы так, чтобы URL запроса не превышал COINS_URL_MAX"""
+        base = len(f"{COINGECKO_API}/simple/price?vs_currencies=usd&ids=")
+        chunks, current, length = [], [], base
+        for coin_id in ids:
+            if current and length + len(coin_id) + 1 > COINS_URL_MAX:
+                chunks.append(current)
+                current, length = [], base
+            current.append(coin_id)
+            length += len(coin_id) + 1
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def _fetch_ids(self, ids: list[str]) -> dict[str, float]:
+        """Цены монет по id: чанками, не больше COINS_FETCH_CONCURRENCY запросов одновременно"""
+        semaphore = asyncio.Semaphore(COINS_FETCH_CONCURRENCY)
+
+        async def fetch(chunk: list[str]) -> Optional[dict]:
+            async with semaphore:
+                return await CurrencyAPI._fetch(f"{COINGECKO_API}/simple/price?vs_currencies=usd&ids={','.join(chunk)}")
+
+        prices = {}
+        for data in await asyncio.gather(*(fetch(chunk) for chunk in self._chunks(ids))):
+            for coin_id, value in (data or {}).items():
+                code = self.code_of.get(coin_id)
+                if code and isinstance(value, dict) and value.get("usd"):
+                    prices[code] = float(value["usd"])
+        return prices
+
+    async def load_prices(self) -> Optional[dict[str, float]]:
+        """Цены популярных монет (одна страница рейтинга) и запрошенных (чанками по id)"""
+        if not self.by_symbol:
             return None
 
-        from_usd = get_usd_price(from_code)
-        to_usd = get_usd_price(to_code)
+        wanted = set(self._tracked)
+        for codes in self.pinned:
+            wanted.update(codes())
+        popular = set(self.popular)
+        ids = [self.by_symbol[c] for c in sorted(wanted) if c in self.by_symbol and c not in popular]
+
+        markets, extra = await asyncio.gather(CurrencyAPI._fetch(self._markets_url()), self._fetch_ids(ids))
+        prices = {}
+        if isinstance(markets, list):
+            for m in markets:
+                code = self.code_of.get(m.get("id"))
+                if code and m.get("current_price"):
+                    prices[code] = float(m["current_price"])
+        prices.update(extra)
+        prices = {code: p for code, p in prices.items() if code not in ALL_CURRENCIES}
+        return prices or None
+
+    async def ensure(self, codes) -> bool:
+        """Подтянуть цены монет каталога, которых ещё нет в срезе; True — срез обновился"""
+        snapshot = CurrencyAPI.snapshot
+        missing = []
+        for code in codes:
+            if code in ALL_CURRENCIES or code not in self.by_symbol:
+                continue
+            self.track(code)
+            if snapshot is None or code not in snapshot.index:
+                missing.append(code)
+        if not missing:
+            return False
+
+        ids = sorted(self.by_symbol[c] for c in missing)
+        prices = await CurrencyAPI._single_flight("coins:" + ",".join(ids), lambda: self._fetch_ids(ids))
+        if not prices:
+            return False
 
-        if from_usd is None or to_usd is None:
-            return None
+        entry = cache.get("coins")
+        if entry is None:
+            cache["coins"] = CachedRates(data=prices, fetched_at=time.time())
+        else:
+            cache["coins"] = CachedRates(data={**entry.data, **prices}, fetched_at=entry.fetched_at)
+        CurrencyAPI._rebuild_snapshot()
+        return True
 
-        rate = from_usd / to_usd
-        result = amount * rate
+    def stats(self) -> dict[str, int]:
+        return {"coins": len(self.names), "codes": len(self.by_symbol),
+                "shared_symbols": len(self.collisions), "tracked": len(self._tracked)}
 
-        return ConversionResult(
-            amount=amount,
-            from_code=from_code,
-            to_code=to_code,
-            result=result,
-            rate=rate,
-            from_usd=from_usd,
-            to_usd=to_usd
-        )
+
+catalog = CoinCatalog(COINS_FILE)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 #                              УТИЛИТЫ
 # ══════════════════════════════════════════════════════════════════════════════
 
+# Быстрый ввод целиком: [символ] сумма и до четырёх слов (множитель, валюты, связка) — один match
+QUICK_RE = re.compile(r"""
+    \s*(?P<prefix>[^\w\s])?\s*                # «$100»
+    (?P<num>\d(?:[\d'’_.,]|\s(?=\d{3}(?!\d)))*)  # сумма с разделителями разрядов и дробной части
+    \s*(?P<w1>[^\W\d_]+|->|[^\w\s])?
+    \s*(?P<w2>[^\W\d_]+|->|[^\w\s])?
+    \s*(?P<w3>[^\W\d_]+|->|[^\w\s])?
+    \s*(?P<w4>[^\W\d_]+|->|[^\w\s])?
+    \s*$
+""", re.VERBOSE)
+
+QUICK_MULTIPLIERS = {
+    "k": 1e3, "к": 1e3, "тыс": 1e3, "тысяч": 1e3, "тысячи": 1e3,
+    "m": 1e6, "м": 1e6, "kk": 1e6, "кк": 1e6, "млн": 1e6, "mln": 1e6,
+    "b": 1e9, "bn": 1e9, "млрд": 1e9,
+}
+QUICK_CONNECTORS = {"to", "in", "into", "в", "во", "на", "->", "→", "=", "/"}
+
+# Индекс: код или псевдоним в нижнем регистре -> код валюты
+CURRENCY_INDEX = {code.lower(): code for code in ALL_CURRENCIES}
+CURRENCY_INDEX.update({alias.lower(): code for code, aliases in CURRENCY_ALIASES.items() for alias in aliases})
+
+QUICK_ERRORS = {
+    "empty": "Пустой запрос",
+    "no_amount": "Не нашёл сумму",
+    "bad_amount": "Не понял сумму",
+    "no_currency": "Не указана валюта",
+    "unknown_currency": "Не знаю такую валюту",
+    "extra": "Лишнее в запросе",
+}
+
+_GROUP_SEPARATORS = r"\s'’_"  # Пробелы (в т.ч. неразрывные), апостроф, подчёркивание
+
+
+class QuickInput(NamedTuple):
+    """Разобранный быстрый ввод; при ошибке error — ключ QUICK_ERRORS, token — что не понято"""
+    amount: float = 0.0
+    from_code: Optional[str] = None
+    to_code: Optional[str] = None
+    error: Optional[str] = None
+    token: str = ""
+
+
+def parse_amount(raw: str) -> Optional[float]:
+    """Число с разделителями: «1 000», «1,000,000», «1.234,5», «0,5». None — не число.
+
+    Разделители разрядов допустимы только между группами по три цифры:
+    «12.05.2024» и «2 3» — не числа.
+    """
+    if raw.isdigit():
+        return float(raw)
+    s = raw.strip()
+    dots, commas = s.count("."), s.count(",")
+
+    decimal, group = ".", ""
+    if dots and commas:
+        # Дробная часть — после последнего разделителя, остальные отделяют разряды
+        decimal, group = (".", ",") if s.rfind(".") > s.rfind(",") else (",", ".")
+    elif dots > 1 or commas > 1:
+        decimal, group = "", "." if dots else ","
+    elif commas:
+        head, _, tail = s.partition(",")
+        # «1,000» — тысяча, «1,5» и «0,250» — дробь
+        decimal, group = ("", ",") if len(tail) == 3 and head.strip("0") else (",", "")
+
+    whole, _, frac = s.partition(decimal) if decimal else (s, "", "")
+    groups = re.split(f"[{_GROUP_SEPARATORS}{re.escape(group)}]", whole) if whole or not frac else ["0"]
+    if not all(g.isdigit() for g in groups) or frac and not frac.isdigit():
+        return None
+    if len(groups) > 1 and (len(groups[0]) > 3 or any(len(g) != 3 for g in groups[1:])):
+        return None
+    return float(f"{''.join(groups)}.{frac or 0}")
+
+
+@lru_cache(maxsize=4096)
+def tokenize_quick(text: str, any_case: bool = True) -> QuickInput:
+    """Разбор «сумма [множитель] валюта [в] [валюта]» одним проходом regexp.
+
+    Понимает «1.5k BTC», «2 млн руб в usd», «$100», «100usd to rub», «1 000,50 €».
+    any_case=False — тикеры монет каталога только заглавными: в группах «2 people»
+    и «5 new» — обычная речь, а не конвертация.
+    Не бросает исключений: ошибка возвращается в поле error.
+    """
+    m = QUICK_RE.match(text)
+    if m is None:
+        words = text.split(None, 1)
+        if not words:
+            return QuickInput(error="empty")
+        if not words[0][0].isdigit() and not CURRENCY_INDEX.get(words[0][0]):
+            return QuickInput(error="no_amount", token=words[0])
+        return QuickInput(error="extra", token=text.strip())
+
+    prefix, num, *words = m.groups()
+    amount = parse_amount(num)
+    if amount is None:
+        return QuickInput(error="bad_amount", token=num)
+
+    codes = []
+    if prefix is not None:
+        code = CURRENCY_INDEX.get(prefix)
+        if code is None:
+            return QuickInput(error="no_amount", token=prefix)
+        codes.append(code)  # «$100», «€ 50»
+
+    words = [w for w in words if w is not None]
+    if words and words[0].lower() in QUICK_MULTIPLIERS:
+        amount *= QUICK_MULTIPLIERS[words.pop(0).lower()]
+    if not 0 < amount < 1e15:
+        return QuickInput(error="bad_amount", token=num)
+
+    connected = False
+    for raw in words:
+        word = raw.lower()
+        if word in QUICK_CONNECTORS and not connected:
+            if not codes:
+                return QuickInput(amount=amount, error="no_currency", token=word)
+            connected = True
+            continue
+        code = CURRENCY_INDEX.get(word) or (catalog.code(word) if any_case or raw.isupper() else None)
+        if code is None:
+            return QuickInput(amount=amount, error="unknown_currency" if word.isalpha() else "extra", token=word)
+        if len(codes) == 2:
+            return QuickInput(amount=amount, error="extra", token=word)
+        codes.append(code)
+
+    if not codes:
+        return QuickInput(amount=amount, error="no_currency")
+    return QuickInput(amount=amount, from_code=codes[0], to_code=codes[1] if len(codes) > 1 else None)
+
+
+def parse_quick(text: str, any_case: bool = True) -> Optional[tuple[float, str, Optional[str]]]:
+    """Разбор быстрого ввода: «100 USD RUB» или «100 USD» -> (сумма, из, в); any_case — как в tokenize_quick"""
+    q = tokenize_quick(text, any_case)
+    if q.error:
+        return None
+    return q.amount, q.from_code, q.to_code
+
+
 def fmt_num(n: float) -> str:
     """Форматирование числа"""
     if n == 0:
@@ -177,12 +1541,32 @@ def fmt_num(n: float) -> str:
     return f"{n:.10f}".rstrip('0').rstrip('.')
 
 
+def fmt_num_batch(values: np.ndarray) -> list[str]:
+    """fmt_num для массива: ветка формата выбирается векторно, nan -> «—»"""
+    values = np.asarray(values, dtype=float)
+    out = ["—"] * len(values)
+
+    branches = (
+        (values == 0, lambda n: "0"),
+        (values >= 1_000_000, "{:,.2f}".format),
+        ((values >= 1) & (values < 1_000_000), lambda n: f"{n:,.4f}".rstrip('0').rstrip('.')),
+        ((values >= 0.0001) & (values < 1), lambda n: f"{n:.6f}".rstrip('0').rstrip('.')),
+        ((values != 0) & (values < 0.0001), lambda n: f"{n:.10f}".rstrip('0').rstrip('.')),
+    )
+    for mask, fmt in branches:
+        for i in np.flatnonzero(mask):
+            out[i] = fmt(values[i])
+    return out
+
+
 def get_emoji(code: str) -> str:
     """Получить эмодзи валюты"""
     if code in FIAT:
         return FIAT[code][1]
     if code in CRYPTO:
         return CRYPTO[code][1]
+    if code in catalog.by_symbol:
+        return "🪙"
     return "💰"
 
 
@@ -192,13 +1576,85 @@ def get_name(code: str) -> str:
         return FIAT[code][0]
     if code in CRYPTO:
         return CRYPTO[code][0]
-    return code
+    return catalog.name(code) or code
+
+
+def is_currency(code: str) -> bool:
+    """Встроенная валюта или монета из каталога"""
+    return code in ALL_CURRENCIES or code in catalog.by_symbol
+
+
+def fmt_freshness(age: float) -> str:
+    """Подпись о свежести курса; старые данные явно помечаются"""
+    if age > RATES_STALE_AFTER:
+        return f"⚠️ <i>Курс устарел: данные {fmt_age(age)} назад</i>"
+    return f"⏱ <i>Актуальный курс · {fmt_age(age)} назад</i>"
+
+
+def fmt_age(seconds: float) -> str:
+    """Возраст данных: <1 мин, 3 мин, 2 ч (грубо, чтобы текст не менялся каждую секунду)"""
+    seconds = max(int(seconds), 0)
+    if seconds < 60:
+        return "<1 мин"
+    if seconds < 3600:
+        return f"{seconds // 60} мин"
+    if seconds < 86400:
+        return f"{seconds // 3600} ч"
+    return f"{seconds // 86400} дн"
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 #                              КЛАВИАТУРЫ
 # ══════════════════════════════════════════════════════════════════════════════
 
+CB_VERSION = "x1"  # Версия формата callback-данных конвертации
+
+
+@dataclass(frozen=True)
+class ConvCallback:
+    """Callback-данные конвертации: действие, пара и (для «a») сумма"""
+    action: str                    # a — конвертировать, s — поменять местами, n — другая сумма, p — пара
+    from_code: str
+    to_code: str
+    amount: Optional[float] = None
+
+    def pack(self) -> str:
+        """x1:a:BTC:USD:100 (сумма без потери точности: «:g» округлил бы 1234567 до 1.23457e+06)"""
+        parts = [CB_VERSION, self.action, self.from_code, self.to_code]
+        if self.amount is not None:
+            parts.append(f"{self.amount:.15g}")
+        return ":".join(parts)
+
+    @staticmethod
+    def unpack(data: str) -> Optional["ConvCallback"]:
+        """Разобрать callback-данные (включая старые форматы swap:/amt:/p:)"""
+        parts = data.split(":")
+        legacy = {"swap": "s", "amt": "n", "p": "p"}
+
+        if parts[0] in legacy and len(parts) == 3:
+            parts = [CB_VERSION, legacy[parts[0]], parts[1], parts[2]]
+        if parts[0] != CB_VERSION or len(parts) not in (4, 5):
+            return None
+
+        _, action, from_code, to_code, *rest = parts
+        if not is_currency(from_code) or not is_currency(to_code):
+            return None
+
+        amount = None
+        if rest:
+            try:
+                amount = float(rest[0])
+            except ValueError:
+                return None
+            if not 0 < amount < float("inf"):
+                return None
+        return ConvCallback(action, from_code, to_code, amount)
+
+
+# Клавиатуры неизменяемы (aiogram-типы frozen), поэтому каждая собирается
+# один раз и дальше переиспользуется: статичные — при импорте, по парам — через LRU.
+
+@lru_cache(maxsize=None)
 def kb_main() -> InlineKeyboardMarkup:
     """Главное меню"""
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -210,364 +1666,1656 @@ def kb_main() -> InlineKeyboardMarkup:
     ])
 
 
-def kb_currencies(currencies: dict, action: str, switch_to: str) -> InlineKeyboardMarkup:
-    """Клавиатура выбора валют"""
+def currency_list(group: str) -> tuple[str, ...]:
+    """Валюты группы для клавиатуры: фиат, либо встроенная крипта и популярные монеты каталога"""
+    if group == "fiat":
+        return tuple(FIAT)
+    return tuple(CRYPTO) + tuple(code for code in catalog.popular if code not in CRYPTO)
+
+
+@lru_cache(maxsize=4096)
+def kb_currencies(group: str, action: str, from_code: str = "", page: int = 0) -> InlineKeyboardMarkup:
+    """Клавиатура выбора валют (group: fiat / crypto) по страницам; для action="to" кнопки несут from_code"""
     builder = InlineKeyboardBuilder()
+    suffix = f":{from_code}" if from_code else ""
 
-    for code in currencies:
+    codes = currency_list(group)
+    pages = max(1, -(-len(codes) // COINS_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    for code in codes[page * COINS_PAGE_SIZE:(page + 1) * COINS_PAGE_SIZE]:
         emoji = get_emoji(code)
-        builder.button(text=f"{emoji} {code}", callback_data=f"c:{action}:{code}")
+        builder.button(text=f"{emoji} {code}", callback_data=f"c:{action}{suffix}:{code}")
 
     builder.adjust(4)  # 4 кнопки в ряд
 
+    if pages > 1:
+        def nav(text: str, target: int) -> InlineKeyboardButton:
+            return InlineKeyboardButton(text=text, callback_data=f"pg:{action}:{group}:{target}{suffix}")
+        builder.row(nav("◀️", (page - 1) % pages),
+                    InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="noop"),
+                    nav("▶️", (page + 1) % pages))
+
+    switch_to = "fiat" if group == "crypto" else "crypto"
     switch_text = "🪙 Крипто" if switch_to == "crypto" else "💵 Фиат"
-    builder.row(InlineKeyboardButton(text=switch_text, callback_data=f"switch:{action}:{switch_to}"))
+    builder.row(InlineKeyboardButton(text=switch_text, callback_data=f"switch:{action}:{switch_to}{suffix}"),
+                InlineKeyboardButton(text="🔍 Поиск", callback_data=f"find:{action}{suffix}"))
     builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="menu"))
 
     return builder.as_markup()
 
 
-def kb_amounts() -> InlineKeyboardMarkup:
-    """Клавиатура сумм"""
+@lru_cache(maxsize=1024)
+def kb_search(action: str, from_code: str, codes: tuple[str, ...]) -> InlineKeyboardMarkup:
+    """Результаты поиска валюты: кнопки с названиями, дальше как в kb_currencies"""
+    builder = InlineKeyboardBuilder()
+    suffix = f":{from_code}" if from_code else ""
+    for code in codes:
+        builder.button(text=f"{get_emoji(code)} {code} · {get_name(code)}"[:40],
+                       callback_data=f"c:{action}{suffix}:{code}")
+    builder.adjust(2)
+    builder.row(InlineKeyboardButton(text="🔍 Искать ещё", callback_data=f"find:{action}{suffix}"),
+                InlineKeyboardButton(text="◀️ Назад", callback_data="menu"))
+    return builder.as_markup()
+
+
+@lru_cache(maxsize=1024)
+def kb_amounts(from_c: str, to_c: str) -> InlineKeyboardMarkup:
+    """Клавиатура сумм; пара зашита в кнопки, FSM для них не нужен"""
+    def btn(n: int) -> InlineKeyboardButton:
+        return InlineKeyboardButton(text=str(n), callback_data=ConvCallback("a", from_c, to_c, n).pack())
+
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=str(n), callback_data=f"a:{n}") for n in [1, 10, 100]],
-        [InlineKeyboardButton(text=str(n), callback_data=f"a:{n}") for n in [1000, 10000, 100000]],
+        [btn(n) for n in [1, 10, 100]],
+        [btn(n) for n in [1000, 10000, 100000]],
         [InlineKeyboardButton(text="◀️ Назад", callback_data="convert")],
     ])
 
 
+@lru_cache(maxsize=1024)
 def kb_result(from_c: str, to_c: str) -> InlineKeyboardMarkup:
     """Клавиатура результата"""
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Поменять местами", callback_data=f"swap:{from_c}:{to_c}")],
+        [InlineKeyboardButton(text="🔄 Поменять местами", callback_data=ConvCallback("s", from_c, to_c).pack())],
         [InlineKeyboardButton(text="💱 Новая конвертация", callback_data="convert"),
-         InlineKeyboardButton(text="🔢 Другая сумма", callback_data=f"amt:{from_c}:{to_c}")],
+         InlineKeyboardButton(text="🔢 Другая сумма", callback_data=ConvCallback("n", from_c, to_c).pack())],
         [InlineKeyboardButton(text="🏠 Меню", callback_data="menu")],
     ])
 
 
+@lru_cache(maxsize=None)
 def kb_popular() -> InlineKeyboardMarkup:
     """Популярные пары"""
-    pairs = [("BTC", "USD"), ("ETH", "USD"), ("USD", "RUB"), ("BTC", "RUB"),
-             ("EUR", "USD"), ("TON", "USD"), ("USD", "UAH"), ("SOL", "USD")]
-
     builder = InlineKeyboardBuilder()
-    for f, t in pairs:
-        builder.button(text=f"{get_emoji(f)} {f}→{t} {get_emoji(t)}", callback_data=f"p:{f}:{t}")
+    for f, t in POPULAR_PAIRS:
+        builder.button(text=f"{get_emoji(f)} {f}→{t} {get_emoji(t)}", callback_data=ConvCallback("p", f, t).pack())
     builder.adjust(2)
     builder.row(InlineKeyboardButton(text="🏠 Меню", callback_data="menu"))
     return builder.as_markup()
 
 
-# ══════════════════════════════════════════════════════════════════════════════
-#                              FSM СОСТОЯНИЯ
-# ══════════════════════════════════════════════════════════════════════════════
-
-class States(StatesGroup):
-    select_from = State()
-    select_to = State()
-    enter_amount = State()
-
-
-# ══════════════════════════════════════════════════════════════════════════════
-#                              ХЕНДЛЕРЫ
-# ══════════════════════════════════════════════════════════════════════════════
-
-router = Router()
+@lru_cache(maxsize=None)
+def kb_back() -> InlineKeyboardMarkup:
+    """Одна кнопка «Меню»"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🏠 Меню", callback_data="menu")]
+    ])
 
 
-# ─────────────────────────── Старт и меню ───────────────────────────
+@lru_cache(maxsize=None)
+def kb_rates(rates_data: str) -> InlineKeyboardMarkup:
+    """Таблица курсов: обновить / меню"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data=rates_data)],
+        [InlineKeyboardButton(text="🏠 Меню", callback_data="menu")]
+    ])
 
-@router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext):
-    await state.clear()
-    text = """
-✨ <b>Currency Converter Bot</b>
 
-Конвертация валют в реальном времени:
-• 💵 12 фиатных валют (USD, EUR, RUB...)
-• 🪙 12 криптовалют (BTC, ETH, TON...)
+@lru_cache(maxsize=None)
+def kb_rate_types() -> InlineKeyboardMarkup:
+    """Выбор типа курсов (/rates)"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📈 Крипто", callback_data="rates:crypto"),
+         InlineKeyboardButton(text="💵 Фиат", callback_data="rates:fiat")]
+    ])
 
-📡 Данные обновляются каждую минуту
-"""
-    await message.answer(text.strip(), reply_markup=kb_main())
 
+def _prebuild_keyboards():
+    """Собрать все статичные клавиатуры и результаты популярных пар заранее"""
+    kb_main(), kb_popular(), kb_back(), kb_rate_types()
+    for group in CURRENCY_GROUPS:
+        kb_currencies(group, "from")
+        for from_code in ALL_CURRENCIES:
+            kb_currencies(group, "to", from_code)
+    for rates_data in ("rates:crypto", "rates:fiat"):
+        kb_rates(rates_data)
+    for f, t in POPULAR_PAIRS:
+        for pair in ((f, t), (t, f)):
+            kb_result(*pair)
+            kb_amounts(*pair)
 
-@router.callback_query(F.data == "menu")
-async def cb_menu(callback: CallbackQuery, state: FSMContext):
-    await state.clear()
-    await callback.message.edit_text(
-        "✨ <b>Currency Converter</b>\n\nВыберите действие:",
-        reply_markup=kb_main()
-    )
 
+_prebuild_keyboards()
 
-@router.callback_query(F.data == "help")
-async def cb_help(callback: CallbackQuery):
-    text = """
-<b>❓ Как пользоваться</b>
 
-<b>Способ 1:</b> Через меню
-• Нажмите «💱 Конвертировать»
-• Выберите валюты
-• Введите сумму
+# ══════════════════════════════════════════════════════════════════════════════
+#                              ТЕКСТЫ
+# ══════════════════════════════════════════════════════════════════════════════
 
-<b>Способ 2:</b> Быстрый ввод
-Просто напишите:
-<code>100 USD RUB</code>
-<code>0.5 BTC EUR</code>
-<code>1000 RUB TON</code>
+render_cache = LRUCache(maxsize=RENDER_CACHE_SIZE)
+sent_texts = LRUCache(maxsize=SENT_CACHE_SIZE)  # (chat_id, message_id) -> (текст, клавиатура)
 
-<b>Команды:</b>
-/start — главное меню
-/btc /eth /ton — текущий курс
-"""
-    await callback.message.edit_text(
-        text.strip(),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🏠 Меню", callback_data="menu")]
-        ])
-    )
 
+@traced("render")
+def cached_render(view: str, params: tuple, snapshot: RateSnapshot, render) -> str:
+    """Текст из кэша; пересчитывается только при новой версии курсов"""
+    key = (view, params, snapshot.version)
+    text = render_cache.get(key)
+    if text is None:
+        text = render_cache[key] = render()
+    return text
 
-# ─────────────────────────── Курсы валют ───────────────────────────
 
-@router.callback_query(F.data.startswith("rates:"))
-async def cb_rates(callback: CallbackQuery):
-    rate_type = callback.data.split(":")[1]
-    await callback.answer("⏳ Загрузка...")
+def render_rates(rate_type: str, snapshot: RateSnapshot) -> Optional[str]:
+    """Таблица курсов крипты или фиата (без подписи о свежести)"""
+    lines = []
 
     if rate_type == "crypto":
-        prices = await CurrencyAPI.get_crypto_prices()
-        if not prices:
-            await callback.message.edit_text("❌ Ошибка загрузки", reply_markup=kb_main())
-            return
-
-        lines = ["<b>📈 Курсы криптовалют</b>\n"]
         for code, info in CRYPTO.items():
-            if code in prices:
-                p = prices[code]
+            p = snapshot.usd_price(code)
+            if p is not None:
                 formatted = f"${p:,.2f}" if p >= 1 else f"${p:.6f}"
                 lines.append(f"{info[1]} <b>{code}</b>: {formatted}")
+        title = "<b>📈 Курсы криптовалют</b>\n"
 
     else:
-        rates = await CurrencyAPI.get_fiat_rates()
-        if not rates:
-            await callback.message.edit_text("❌ Ошибка загрузки", reply_markup=kb_main())
-            return
-
-        lines = ["<b>💵 Курсы к USD</b>\n"]
         for code, info in FIAT.items():
-            if code in rates and code != "USD":
-                lines.append(f"{info[1]} <b>{code}</b>: {rates[code]:.4f}")
+            r = snapshot.convert(1, "USD", code)
+            if r is not None and code != "USD":
+                lines.append(f"{info[1]} <b>{code}</b>: {r.rate:.4f}")
+        title = "<b>💵 Курсы к USD</b>\n"
 
-    lines.append("\n<i>🔄 Обновлено сейчас</i>")
+    return "\n".join([title, *lines]) if lines else None
 
-    await callback.message.edit_text(
-        "\n".join(lines),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔄 Обновить", callback_data=callback.data)],
-            [InlineKeyboardButton(text="🏠 Меню", callback_data="menu")]
-        ])
-    )
 
+def render_conversion(result: ConversionResult) -> str:
+    """Карточка результата конвертации (без подписи о свежести)"""
+    from_code, to_code = result.from_code, result.to_code
+    text = f"""
+┏━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+┃      💱 <b>КОНВЕРТАЦИЯ</b>
+┗━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
 
-# ─────────────────────────── Конвертация ───────────────────────────
+  {get_emoji(from_code)}  <b>{fmt_num(result.amount)} {from_code}</b>
+              ⬇️
+  {get_emoji(to_code)}  <b>{fmt_num(result.result)} {to_code}</b>
 
-@router.callback_query(F.data == "convert")
+┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈
+
+📊 <b>Курс обмена:</b>
+   1 {from_code} = {fmt_num(result.rate)} {to_code}
+
+💵 <b>Цена в USD:</b>
+   1 {from_code} = ${fmt_num(result.from_usd)}
+   1 {to_code} = ${fmt_num(result.to_usd)}
+
+┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈
+"""
+    return text.strip()
+
+
+def render_all(amount: float, from_code: str, snapshot: RateSnapshot) -> Optional[str]:
+    """Сумма во всех валютах (без подписи о свежести)"""
+    values = snapshot.convert_all(amount, from_code)
+    if values is None:
+        return None
+
+    formatted = fmt_num_batch(values)
+    lines = [f"💱 {get_emoji(from_code)} <b>{fmt_num(amount)} {from_code}</b> =\n"]
+    for title, group in (("💵 <b>Фиат</b>", FIAT), ("🪙 <b>Крипто</b>", CRYPTO)):
+        lines.append(title)
+        for code in group:
+            if code != from_code:
+                lines.append(f"{get_emoji(code)} <code>{formatted[snapshot.index[code]]}</code> {code}")
+        lines.append("")
+    return "\n".join(lines).rstrip()
+
+
+async def edit_message(message: Message, text: str, reply_markup: InlineKeyboardMarkup) -> bool:
+    """Изменить сообщение; False — текст и клавиатура не изменились, запрос не отправлялся"""
+    key = (message.chat.id, message.message_id)
+    last = sent_texts.pop(key, None)
+    if last is not None and last[0] == text and last[1] is reply_markup:
+        sent_texts[key] = last
+        return False
+
+    # Все правки сообщений бота идут через эту функцию, иначе кэш разойдётся с сообщением
+    try:
+        await message.edit_text(text, reply_markup=reply_markup)
+        changed = True
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+        changed = False
+
+    sent_texts[key] = (text, reply_markup)
+    return changed
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              FSM СОСТОЯНИЯ
+# ══════════════════════════════════════════════════════════════════════════════
+
+class States(StatesGroup):
+    enter_amount = State()
+    search_currency = State()
+
+
+class FSMRecord:
+    """Состояние одного пользователя; пара валют хранится в слотах, остальное — в extra"""
+    __slots__ = ("state", "from_code", "to_code", "extra", "touched")
+
+    def __init__(self):
+        self.state: Optional[str] = None
+        self.from_code: Optional[str] = None
+        self.to_code: Optional[str] = None
+        self.extra: Optional[dict] = None
+        self.touched = 0.0
+
+    def get_data(self) -> dict:
+        data = dict(self.extra) if self.extra else {}
+        if self.from_code is not None:
+            data["from_code"] = self.from_code
+        if self.to_code is not None:
+            data["to_code"] = self.to_code
+        return data
+
+    def set_data(self, data: dict):
+        data = dict(data)
+        self.from_code = data.pop("from_code", None)
+        self.to_code = data.pop("to_code", None)
+        self.extra = data or None
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and self.from_code is None and self.to_code is None and not self.extra
+
+
+class TTLMemoryStorage(BaseStorage):
+    """FSM-хранилище в памяти: записи удаляются после простоя и при превышении лимита"""
+
+    def __init__(self, ttl: float = FSM_TTL, max_entries: int = FSM_MAX_ENTRIES,
+                 snapshot_path: Optional[str] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.snapshot_path = snapshot_path
+        self._records: OrderedDict[StorageKey, FSMRecord] = OrderedDict()  # Старые в начале
+        self.expired = 0   # Удалено по простою
+        self.evicted = 0   # Удалено из-за лимита
+
+    def stats(self) -> dict[str, int]:
+        return {"entries": len(self._records), "expired": self.expired, "evicted": self.evicted}
+
+    def _sweep(self, now: float):
+        """Удалить просроченные записи; они всегда в начале очереди"""
+        records = self._records
+        while records:
+            key, record = next(iter(records.items()))
+            if now - record.touched <= self.ttl:
+                break
+            del records[key]
+            self.expired += 1
+
+    def _record(self, key: StorageKey, create: bool) -> Optional[FSMRecord]:
+        now = time.monotonic()
+        self._sweep(now)
+
+        record = self._records.get(key)
+        if record is None:
+            if not create:
+                return None
+            record = self._records[key] = FSMRecord()
+            if len(self._records) > self.max_entries:
+                self._records.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._records.move_to_end(key)
+
+        record.touched = now
+        return record
+
+    def _drop_if_empty(self, key: StorageKey, record: FSMRecord):
+        if record.empty:
+            self._records.pop(key, None)
+
+    @traced("fsm")
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._record(key, create=state is not None)
+        if record is None:
+            return
+        record.state = state.state if isinstance(state, State) else state
+        self._drop_if_empty(key, record)
+
+    @traced("fsm")
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._record(key, create=False)
+        return record.state if record else None
+
+    @traced("fsm")
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        record = self._record(key, create=bool(data))
+        if record is None:
+            return
+        record.set_data(data)
+        self._drop_if_empty(key, record)
+
+    @traced("fsm")
+    async def get_data(self, key: StorageKey) -> dict:
+        record = self._record(key, create=False)
+        return record.get_data() if record else {}
+
+    def load(self):
+        """Поднять незавершённые диалоги из файла"""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                rows = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"FSM snapshot load error: {e}")
+            return
+
+        now = time.monotonic()
+        for row in sorted(rows, key=lambda r: -r["idle"]):
+            if row["idle"] > self.ttl:
+                continue
+            record = FSMRecord()
+            record.state = row["state"]
+            record.set_data(row["data"])
+            record.touched = now - row["idle"]
+            self._records[StorageKey(**row["key"])] = record
+        logging.info(f"FSM snapshot: restored {len(self._records)} entries")
+
+    def save(self):
+        """Сохранить незавершённые диалоги в файл"""
+        if not self.snapshot_path:
+            return
+        now = time.monotonic()
+        self._sweep(now)
+        rows = [{"key": asdict(key), "state": record.state, "data": record.get_data(),
+                 "idle": now - record.touched}
+                for key, record in self._records.items()]
+        tmp = self.snapshot_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(rows, f, separators=(",", ":"))
+            os.replace(tmp, self.snapshot_path)
+        except OSError as e:
+            logging.error(f"FSM snapshot save error: {e}")
+
+    async def close(self) -> None:
+        self.save()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              УВЕДОМЛЕНИЯ О КУРСЕ
+# ══════════════════════════════════════════════════════════════════════════════
+
+class Alert:
+    """Подписка «сообщить, когда base/quote пересечёт порог»"""
+    __slots__ = ("id", "user_id", "chat_id", "base", "quote", "above", "threshold", "armed")
+
+    def __init__(self, id: int, user_id: int, chat_id: int, base: str, quote: str,
+                 above: bool, threshold: float, armed: bool = True):
+        self.id = id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.base = base
+        self.quote = quote
+        self.above = above
+        self.threshold = threshold
+        self.armed = armed
+
+    def describe(self) -> str:
+        sign = ">" if self.above else "<"
+        return f"{self.base}/{self.quote} {sign} {fmt_num(self.threshold)}"
+
+
+class PairIndex:
+    """Пороги одной пары в отсортированных списках (ключ, id).
+
+    Взведённые пороги ждут срабатывания, сработавшие — повторного взведения,
+    когда курс отойдёт от порога на ALERT_HYSTERESIS. Каждый список хранится
+    так, чтобы подходящие записи были его хвостом: для «выше» и ожидающих
+    «ниже» ключ — порог со знаком минус. Проверка — бинарный поиск и срез
+    хвоста, её цена зависит от числа сработавших, а не от числа подписок.
+    """
+    __slots__ = ("armed_above", "armed_below", "fired_above", "fired_below")
+
+    def __init__(self):
+        self.armed_above: list[tuple[float, int]] = []  # (-порог, id): сработают пороги ниже курса
+        self.armed_below: list[tuple[float, int]] = []  # (порог, id): сработают пороги выше курса
+        self.fired_above: list[tuple[float, int]] = []  # (порог, id): взведутся, когда курс уйдёт вниз
+        self.fired_below: list[tuple[float, int]] = []  # (-порог, id): взведутся, когда курс уйдёт вверх
+
+    def _entry(self, alert: Alert) -> tuple[list, tuple[float, int]]:
+        if alert.above:
+            if alert.armed:
+                return self.armed_above, (-alert.threshold, alert.id)
+            return self.fired_above, (alert.threshold, alert.id)
+        if alert.armed:
+            return self.armed_below, (alert.threshold, alert.id)
+        return self.fired_below, (-alert.threshold, alert.id)
+
+    def add(self, alert: Alert):
+        items, entry = self._entry(alert)
+        bisect.insort(items, entry)
+
+    def remove(self, alert: Alert):
+        items, entry = self._entry(alert)
+        i = bisect.bisect_left(items, entry)
+        if i < len(items) and items[i] == entry:
+            del items[i]
+
+    def __len__(self) -> int:
+        return len(self.armed_above) + len(self.armed_below) + len(self.fired_above) + len(self.fired_below)
+
+    @staticmethod
+    def _tail(items: list, key: float) -> list[tuple[float, int]]:
+        """Снять с конца списка все записи с ключом строго больше key"""
+        n = bisect.bisect_right(items, (key, float("inf")))
+        tail = items[n:]
+        del items[n:]
+        return tail
+
+    def evaluate(self, rate: float, hysteresis: float) -> tuple[list[int], list[int]]:
+        """Вернуть (сработавшие id, снова взведённые id) и переложить их между списками"""
+        up = self._tail(self.armed_above, -rate)                              # порог < rate
+        down = self._tail(self.armed_below, rate)                             # порог > rate
+        rearm_up = self._tail(self.fired_above, rate / (1 - hysteresis))      # курс ушёл ниже порога
+        rearm_down = self._tail(self.fired_below, -rate / (1 + hysteresis))   # курс ушёл выше порога
+
+        # При переезде между списками знак ключа меняется
+        for items, target in ((up, self.fired_above), (down, self.fired_below),
+                              (rearm_up, self.armed_above), (rearm_down, self.armed_below)):
+            for key, alert_id in items:
+                bisect.insort(target, (-key, alert_id))
+
+        return [i for _, i in up + down], [i for _, i in rearm_up + rearm_down]
+
+
+class AlertEngine:
+    """Подписки на курс: индексы по парам, проверка на каждом новом срезе, SQLite.
+
+    Индекс в памяти держит только процесс, который проверяет пороги. Воркеры
+    работают с таблицей напрямую и отмечают изменённые id в alerts_log;
+    проверяющий процесс перед обращением к индексу досчитывает только их.
+    """
+
+    def __init__(self, path: str, hysteresis: float = ALERT_HYSTERESIS):
+        self.path = path
+        self.hysteresis = hysteresis
+        self.bot: Optional[Bot] = None
+        self._db: Optional[sqlite3.Connection] = None
+        self._alerts: dict[int, Alert] = {}
+        self._pairs: dict[tuple[str, str], PairIndex] = {}
+        self.triggered = 0
+        self.evaluate = True
+
+    def open(self, evaluate: bool = True):
+        """evaluate=False — только команды пользователей (воркер), проверкой занят координатор"""
+        self.evaluate = evaluate
+        self._db = sqlite3.connect(self.path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS alerts (id INTEGER PRIMARY KEY, user_id INTEGER, chat_id INTEGER, "
+            "base TEXT, quote TEXT, above INTEGER, threshold REAL, armed INTEGER)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS alerts_user ON alerts (user_id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS alerts_log (seq INTEGER PRIMARY KEY AUTOINCREMENT, alert_id INTEGER)")
+        self._db.commit()
+        if not evaluate:
+            return
+
+        # Всё, что записано в журнал до загрузки, уже есть в таблице
+        seen = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM alerts_log").fetchone()[0]
+        for row in self._db.execute("SELECT * FROM alerts"):
+            self._index(self._alert(row))
+        self._db.execute("DELETE FROM alerts_log WHERE seq <= ?", (seen,))
+        self._db.commit()
+        CurrencyAPI.listeners.append(self.on_snapshot)
+        catalog.pinned.append(self.codes)
+        logging.info(f"Alerts loaded: {len(self._alerts)}")
+
+    @staticmethod
+    def _alert(row: tuple) -> Alert:
+        return Alert(row[0], row[1], row[2], row[3], row[4], bool(row[5]), row[6], bool(row[7]))
+
+    def _sync(self):
+        """Применить к индексу подписки, изменённые воркерами: цена — по числу изменений"""
+        log = self._db.execute("SELECT seq, alert_id FROM alerts_log ORDER BY seq").fetchall()
+        if not log:
+            return
+        ids = {alert_id for _, alert_id in log}
+        for alert_id in ids:
+            if alert_id in self._alerts:
+                self._unindex(self._alerts[alert_id])
+        marks = ",".join("?" * len(ids))
+        for row in self._db.execute(f"SELECT * FROM alerts WHERE id IN ({marks})", tuple(ids)):
+            self._index(self._alert(row))
+        self._db.execute("DELETE FROM alerts_log WHERE seq <= ?", (log[-1][0],))
+        self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _index(self, alert: Alert):
+        self._alerts[alert.id] = alert
+        self._pairs.setdefault((alert.base, alert.quote), PairIndex()).add(alert)
+
+    def _unindex(self, alert: Alert):
+        index = self._pairs[(alert.base, alert.quote)]
+        index.remove(alert)
+        if not len(index):
+            del self._pairs[(alert.base, alert.quote)]
+        del self._alerts[alert.id]
+
+    def _changed(self, alert: Alert, removed: bool = False):
+        """Правка пользователя: в индекс сразу или в журнал для проверяющего процесса"""
+        if not self.evaluate:
+            self._db.execute("INSERT INTO alerts_log (alert_id) VALUES (?)", (alert.id,))
+        else:
+            if alert.id in self._alerts:
+                self._unindex(self._alerts[alert.id])
+            if not removed:
+                self._index(alert)
+        self._db.commit()
+
+    def codes(self) -> set[str]:
+        """Валюты, за которыми следят уведомления"""
+        return {code for pair in self._pairs for code in pair}
+
+    def user_alerts(self, user_id: int) -> list[Alert]:
+        rows = self._db.execute("SELECT * FROM alerts WHERE user_id = ? ORDER BY id", (user_id,))
+        return [self._alert(row) for row in rows]
+
+    def add(self, user_id: int, chat_id: int, base: str, quote: str, above: bool, threshold: float) -> Alert:
+        cur = self._db.execute(
+            "INSERT INTO alerts (user_id, chat_id, base, quote, above, threshold, armed) VALUES (?, ?, ?, ?, ?, ?, 1)",
+            (user_id, chat_id, base, quote, int(above), threshold)
+        )
+        alert = Alert(cur.lastrowid, user_id, chat_id, base, quote, above, threshold)
+        self._changed(alert)
+        return alert
+
+    def remove(self, user_id: int, alert_id: int) -> bool:
+        row = self._db.execute("SELECT * FROM alerts WHERE id = ? AND user_id = ?", (alert_id, user_id)).fetchone()
+        if row is None:
+            return False
+        self._db.execute("DELETE FROM alerts WHERE id = ?", (alert_id,))
+        self._changed(self._alert(row), removed=True)
+        return True
+
+    def on_snapshot(self, snapshot: RateSnapshot):
+        """Проверить все пары с подписками по новому срезу"""
+        self._sync()
+        fired, changed = [], []
+
+        for (base, quote), index in self._pairs.items():
+            rate = snapshot.rate(base, quote)
+            if rate is None:
+                continue
+
+            up, rearmed = index.evaluate(rate, self.hysteresis)
+            for alert_id in up:
+                alert = self._alerts[alert_id]
+                alert.armed = False
+                fired.append((alert, rate))
+                changed.append((0, alert_id))
+            for alert_id in rearmed:
+                self._alerts[alert_id].armed = True
+                changed.append((1, alert_id))
+
+        if changed:
+            self._db.executemany("UPDATE alerts SET armed = ? WHERE id = ?", changed)
+            self._db.commit()
+        if fired:
+            self.triggered += len(fired)
+            asyncio.get_running_loop().create_task(self._notify(fired))
+
+    async def _notify(self, fired: list[tuple[Alert, float]]):
+        if self.bot is None:
+            return
+        send_priority.set(PRIORITY_BROADCAST)
+
+        for alert, rate in fired:
+            direction = "выше" if alert.above else "ниже"
+            text = (f"🔔 <b>{alert.base}/{alert.quote}</b> {direction} {fmt_num(alert.threshold)}\n\n"
+                    f"Сейчас: 1 {alert.base} = <b>{fmt_num(rate)} {alert.quote}</b>")
+            try:
+                await self.bot.send_message(alert.chat_id, text)
+            except Exception as e:
+                logging.error(f"Alert {alert.id} delivery failed: {e}")
+
+
+alerts = AlertEngine(RATES_DB)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              ИСТОРИЯ КУРСОВ
+# ══════════════════════════════════════════════════════════════════════════════
+
+class RingTier:
+    """Кольцевой буфер одного уровня детализации: время + цены всех валют в USD"""
+    __slots__ = ("name", "step", "ts", "values", "head", "count", "bucket")
+
+    def __init__(self, name: str, step: int, capacity: int, n_codes: int):
+        self.name = name
+        self.step = step
+        self.ts = np.zeros(capacity, dtype=np.float64)
+        self.values = np.full((capacity, n_codes), np.nan, dtype=np.float32)
+        self.head = -1     # Индекс последней записанной точки
+        self.count = 0
+        self.bucket = -1   # Номер интервала последней точки
+
+    @property
+    def capacity(self) -> int:
+        return len(self.ts)
+
+    @property
+    def span(self) -> int:
+        return self.step * self.capacity
+
+    def record(self, now: float, usd: np.ndarray):
+        """Одна точка на интервал: в пределах интервала последняя цена перезаписывает прежнюю"""
+        bucket = int(now // self.step)
+        if bucket != self.bucket:
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self.bucket = bucket
+        self.ts[self.head] = now
+        self.values[self.head] = usd
+
+    def window(self, since: float) -> tuple[np.ndarray, np.ndarray]:
+        """Точки не старше since в хронологическом порядке"""
+        if not self.count:
+            return self.ts[:0], self.values[:0]
+        order = (np.arange(self.head - self.count + 1, self.head + 1)) % self.capacity
+        ts = self.ts[order]
+        mask = ts >= since
+        return ts[mask], self.values[order][mask]
+
+
+class HistoryStore:
+    """История курсов в памяти фиксированного размера, с сохранением на диск"""
+
+    def __init__(self, path: str, tiers=HISTORY_TIERS):
+        self.path = path
+        self.codes = tuple(ALL_CURRENCIES)
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        self.tiers = [RingTier(name, step, cap, len(self.codes)) for name, step, cap in tiers]
+        self._saved_at = time.time()
+        self.follow = False  # Воркер: историю пишет координатор, здесь — перечитывать его файл
+        self._mtime = 0.0
+        self._saving: Optional[asyncio.Future] = None  # Фоновая запись на диск
+
+    def open(self):
+        self.load()
+        CurrencyAPI.listeners.append(self.on_snapshot)
+
+    def on_snapshot(self, snapshot: RateSnapshot):
+        now = time.time()
+        for tier in self.tiers:
+            tier.record(now, snapshot.usd[:len(self.codes)])  # Монеты каталога в историю не попадают
+
+        # Пока предыдущая запись не закончилась, новую не начинать
+        if now - self._saved_at > HISTORY_SAVE_INTERVAL and (self._saving is None or self._saving.done()):
+            self._saved_at = now
+            self._saving = asyncio.get_running_loop().run_in_executor(None, self._write, self._arrays())
+            self._saving.add_done_callback(self._saved)
+
+    @staticmethod
+    def _saved(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"History save failed: {future.exception()!r}")
+
+    def _arrays(self) -> dict[str, np.ndarray]:
+        arrays = {"codes": np.array(self.codes)}
+        for tier in self.tiers:
+            arrays[f"{tier.name}_ts"] = tier.ts.copy()
+            arrays[f"{tier.name}_values"] = tier.values.copy()
+            arrays[f"{tier.name}_meta"] = np.array([tier.head, tier.count, tier.bucket])
+        return arrays
+
+    def _write(self, arrays: dict[str, np.ndarray]):
+        tmp = self.path + ".tmp.npz"
+        try:
+            np.savez(tmp, **arrays)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.error(f"History save error: {e}")
+
+    def save(self):
+        self._write(self._arrays())
+
+    async def close(self):
+        """Дождаться фоновой записи, чтобы она не перезаписала итоговую, и сохранить историю"""
+        if self._saving is not None:
+            await asyncio.wait([self._saving])
+            self._saving = None
+        self.save()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            self._mtime = os.path.getmtime(self.path)
+            with np.load(self.path) as data:
+                if tuple(data["codes"]) != self.codes:
+                    logging.warning("History file has a different currency set, starting empty")
+                    return
+                for tier in self.tiers:
+                    if f"{tier.name}_ts" not in data or len(data[f"{tier.name}_ts"]) != tier.capacity:
+                        continue
+                    tier.ts[:] = data[f"{tier.name}_ts"]
+                    tier.values[:] = data[f"{tier.name}_values"]
+                    tier.head, tier.count, tier.bucket = (int(x) for x in data[f"{tier.name}_meta"])
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"History load error: {e}")
+
+    def series(self, base: str, quote: str, seconds: int) -> tuple[np.ndarray, np.ndarray]:
+        """Курс base/quote за последние seconds секунд с самого подробного подходящего уровня"""
+        if self.follow and os.path.exists(self.path) and os.path.getmtime(self.path) != self._mtime:
+            self.load()
+        tier = next((t for t in self.tiers if t.span >= seconds), self.tiers[-1])
+        ts, values = tier.window(time.time() - seconds)
+        rate = values[:, self.index[base]].astype(np.float64) / values[:, self.index[quote]]
+        mask = ~np.isnan(rate)
+        return ts[mask], rate[mask]
+
+    def change(self, base: str, quote: str, seconds: int, rate: float) -> Optional[float]:
+        """Изменение курса в процентах за seconds секунд (None — истории по паре нет)"""
+        if base not in self.index or quote not in self.index:
+            return None
+        ts, rates = self.series(base, quote, seconds)
+        if len(rates) < 2:
+            return None
+        return (rate / float(rates[0]) - 1) * 100
+
+
+history = HistoryStore(HISTORY_FILE)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              СВОДКИ ПО РАСПИСАНИЮ
+# ══════════════════════════════════════════════════════════════════════════════
+
+def parse_pairs(args: list[str]) -> Optional[tuple[tuple[str, str], ...]]:
+    """BTC/USD USD/RUB TON -> пары; одиночный код — к USD. None — если что-то не распознано"""
+    pairs = []
+    for token in args:
+        base, _, quote = token.upper().partition("/")
+        quote = quote or ("USD" if base != "USD" else "EUR")
+        if not is_currency(base) or not is_currency(quote) or base == quote:
+            return None
+        if (base, quote) not in pairs:
+            pairs.append((base, quote))
+    return tuple(pairs) if 0 < len(pairs) <= DIGEST_MAX_PAIRS else None
+
+
+def format_pairs(pairs: tuple[tuple[str, str], ...]) -> str:
+    return " ".join(f"{base}/{quote}" for base, quote in pairs)
+
+
+def describe_period(period: str) -> str:
+    offset = DIGEST_PERIODS[period][1]
+    if period == "hourly":
+        return "каждый час"
+    return f"каждый день в {offset // 3600:02d}:{offset % 3600 // 60:02d} UTC"
+
+
+@traced("render")
+def render_digest(period: str, pairs: tuple[tuple[str, str], ...], snapshot: RateSnapshot) -> Optional[str]:
+    """Текст сводки: курс пары и изменение за период"""
+    seconds = DIGEST_PERIODS[period][0]
+    lines = []
+    for base, quote in pairs:
+        rate = snapshot.rate(base, quote)
+        if rate is None:
+            continue
+        line = f"{get_emoji(base)} <b>{base}/{quote}</b>: {fmt_num(rate)}"
+        change = history.change(base, quote, seconds, rate)
+        if change is not None:
+            line += f" {'📈' if change >= 0 else '📉'} {change:+.2f}%"
+        lines.append(line)
+
+    if not lines:
+        return None
+    title = "🕐 <b>Сводка за час</b>" if period == "hourly" else "📅 <b>Сводка за сутки</b>"
+    return "\n".join([title, "", *lines, "", fmt_freshness(snapshot.age), "Отписаться: /digest off"])
+
+
+class DigestScheduler:
+    """Сводки курсов по расписанию: подписки и ход рассылки в SQLite.
+
+    Подписчики с одинаковым набором пар получают один и тот же текст — он
+    собирается один раз из одного среза курсов. Рассылка идёт пачками по
+    возрастанию chat_id в темпе DIGEST_RATE с приоритетом рассылки, так что
+    ответы пользователям её обгоняют. После каждой пачки прогресс пишется в
+    базу: после перезапуска рассылка продолжится с места остановки, если её
+    срок ещё не вышел.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.bot: Optional[Bot] = None
+        self._db: Optional[sqlite3.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self.last_rate = 0.0  # Сообщений в секунду в последней рассылке
+
+    def open(self):
+        self._db = sqlite3.connect(self.path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS digests (chat_id INTEGER PRIMARY KEY, user_id INTEGER, "
+            "period TEXT, pairs TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS digests_period ON digests (period, chat_id)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS digest_runs (period TEXT PRIMARY KEY, slot REAL, last_chat INTEGER, "
+            "sent INTEGER, failed INTEGER, done INTEGER)"
+        )
+        self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    # ─── Подписки ───
+
+    def get(self, chat_id: int) -> Optional[tuple[str, tuple[tuple[str, str], ...]]]:
+        row = self._db.execute("SELECT period, pairs FROM digests WHERE chat_id = ?", (chat_id,)).fetchone()
+        return (row[0], self._pairs(row[1])) if row else None
+
+    def subscribe(self, chat_id: int, user_id: int, period: str, pairs: tuple[tuple[str, str], ...]):
+        self._db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+                         (chat_id, user_id, period, format_pairs(pairs)))
+        self._db.commit()
+
+    def unsubscribe(self, chat_id: int) -> bool:
+        cur = self._db.execute("DELETE FROM digests WHERE chat_id = ?", (chat_id,))
+        self._db.commit()
+        return cur.rowcount > 0
+
+    def stats(self) -> list[tuple[str, tuple, float]]:
+        rows = self._db.execute("SELECT period, COUNT(*) FROM digests GROUP BY period").fetchall()
+        counts = dict(rows)
+        return ([("bot_digest_subscribers", (("period", p),), counts.get(p, 0)) for p in DIGEST_PERIODS]
+                + [("bot_digest_rate", (), self.last_rate)])
+
+    def codes(self) -> set[str]:
+        """Валюты из всех подписок: монеты каталога должны быть в срезе к рассылке"""
+        return {code for (group,) in self._db.execute("SELECT DISTINCT pairs FROM digests")
+                for pair in self._pairs(group) for code in pair}
+
+    @staticmethod
+    def _pairs(text: str) -> tuple[tuple[str, str], ...]:
+        return tuple(tuple(pair.split("/", 1)) for pair in text.split())
+
+    # ─── Расписание ───
+
+    @staticmethod
+    def slot(period: str, now: float) -> float:
+        """Начало текущего интервала рассылки"""
+        step, offset, _ = DIGEST_PERIODS[period]
+        return (now - offset) // step * step + offset
+
+    async def start(self):
+        """Рассылка — только в одном процессе (координатор), воркеры лишь меняют подписки"""
+        if self._task is None:
+            catalog.pinned.append(self.codes)
+            metrics.gauges.append(self.stats)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            for period in DIGEST_PERIODS:
+                try:
+                    await self._check(period)
+                except Exception as e:
+                    logging.exception(f"Digest {period} failed: {e}")
+
+            now = time.time()
+            wake = min(self.slot(p, now) + DIGEST_PERIODS[p][0] for p in DIGEST_PERIODS)
+            await asyncio.sleep(min(max(wake - now, 1), 60))  # Раз в минуту — повтор после сбоя
+
+    async def _check(self, period: str):
+        """Начать, продолжить или пропустить рассылку текущего интервала"""
+        now = time.time()
+        slot = self.slot(period, now)
+        row = self._db.execute(
+            "SELECT slot, last_chat, sent, failed, done FROM digest_runs WHERE period = ?", (period,)
+        ).fetchone()
+        if row and row[0] == slot and row[4]:
+            return
+
+        if now > slot + DIGEST_PERIODS[period][2]:
+            # Срок вышел (бот был остановлен): сводка уже не актуальна, ждём следующую
+            if row and not row[4]:
+                logging.warning(f"Digest {period} abandoned at chat {row[1]}: {row[2]} sent, window expired")
+            self._db.execute("INSERT OR REPLACE INTO digest_runs VALUES (?, ?, 0, 0, 0, 1)", (period, slot))
+            self._db.commit()
+            return
+
+        if row and row[0] == slot:
+            last_chat, sent, failed = row[1], row[2], row[3]
+            logging.info(f"Digest {period}: resuming after chat {last_chat} ({sent} sent)")
+        else:
+            last_chat, sent, failed = -2 ** 63, 0, 0
+            self._db.execute("INSERT OR REPLACE INTO digest_runs VALUES (?, ?, ?, 0, 0, 0)", (period, slot, last_chat))
+            self._db.commit()
+        await self._deliver(period, last_chat, sent, failed)
+
+    async def _deliver(self, period: str, last_chat: int, sent: int, failed: int):
+        groups = [row[0] for row in self._db.execute(
+            "SELECT DISTINCT pairs FROM digests WHERE period = ? AND chat_id > ?", (period, last_chat))]
+        codes = {code for group in groups for pair in self._pairs(group) for code in pair}
+        snapshot = await CurrencyAPI.get_snapshot(*codes) if groups else None
+        if groups and snapshot is None:
+            logging.error(f"Digest {period}: no rates, will retry")
+            return
+
+        texts: dict[str, Optional[str]] = {}  # Набор пар -> текст: один рендер на группу подписчиков
+        send_priority.set(PRIORITY_BROADCAST)
+        started = logged = time.monotonic()
+        delivered = 0
+
+        while True:
+            batch = self._db.execute(
+                "SELECT chat_id, pairs FROM digests WHERE period = ? AND chat_id > ? ORDER BY chat_id LIMIT ?",
+                (period, last_chat, DIGEST_BATCH)
+            ).fetchall()
+            if not batch:
+                break
+
+            batch_started = time.monotonic()
+            for _, group in batch:
+                if group not in texts:
+                    texts[group] = render_digest(period, self._pairs(group), snapshot)
+            results = await asyncio.gather(*(self._send(chat_id, texts[group]) for chat_id, group in batch))
+            for result in results:
+                metrics.inc("bot_digest_messages_total", (("period", period), ("result", result)))
+            delivered += results.count("sent")
+            sent += results.count("sent")
+            failed += len(results) - results.count("sent")
+            last_chat = batch[-1][0]
+
+            self._db.execute("UPDATE digest_runs SET last_chat = ?, sent = ?, failed = ? WHERE period = ?",
+                             (last_chat, sent, failed, period))
+            self._db.commit()
+
+            now = time.monotonic()
+            if now - logged > DIGEST_LOG_EVERY:
+                logged = now
+                logging.info(f"Digest {period}: {sent} sent, {failed} failed, "
+                             f"{delivered / (now - started):.1f} msg/s")
+            pause = len(batch) / DIGEST_RATE - (now - batch_started)
+            if pause > 0:
+                await asyncio.sleep(pause)
+
+        self._db.execute("UPDATE digest_runs SET done = 1 WHERE period = ?", (period,))
+        self._db.commit()
+        elapsed = time.monotonic() - started
+        if delivered:
+            self.last_rate = delivered / elapsed
+        logging.info(f"Digest {period} done: {sent} sent, {failed} failed, {len(texts)} distinct texts, "
+                     f"{elapsed:.1f}s ({self.last_rate:.1f} msg/s)")
+
+    async def _send(self, chat_id: int, text: Optional[str]) -> str:
+        if text is None:
+            return "empty"  # Ни одной пары с курсом
+        try:
+            await self.bot.send_message(chat_id, text)
+            return "sent"
+        except TelegramForbiddenError:
+            self.unsubscribe(chat_id)  # Бота заблокировали
+            return "gone"
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e).lower():
+                self.unsubscribe(chat_id)
+                return "gone"
+            logging.error(f"Digest to {chat_id} failed: {e}")
+            return "failed"
+        except Exception as e:
+            logging.error(f"Digest to {chat_id} failed: {e}")
+            return "failed"
+
+
+digests = DigestScheduler(RATES_DB)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              ХЕНДЛЕРЫ
+# ══════════════════════════════════════════════════════════════════════════════
+
+router = Router()
+
+
+# ─────────────────────────── Старт и меню ───────────────────────────
+
+@router.message(CommandStart())
+async def cmd_start(message: Message, state: FSMContext):
+    await state.clear()
+    text = """
+✨ <b>Currency Converter Bot</b>
+
+Конвертация валют в реальном времени:
+• 💵 12 фиатных валют (USD, EUR, RUB...)
+• 🪙 12 криптовалют (BTC, ETH, TON...)
+
+📡 Данные обновляются каждую минуту
+"""
+    await message.answer(text.strip(), reply_markup=kb_main())
+
+
+@router.callback_query(F.data == "menu")
+async def cb_menu(callback: CallbackQuery, state: FSMContext):
+    await state.clear()
+    await edit_message(
+        callback.message,
+        "✨ <b>Currency Converter</b>\n\nВыберите действие:",
+        kb_main()
+    )
+
+
+@router.callback_query(F.data == "help")
+async def cb_help(callback: CallbackQuery):
+    text = """
+<b>❓ Как пользоваться</b>
+
+<b>Способ 1:</b> Через меню
+• Нажмите «💱 Конвертировать»
+• Выберите валюты (🔍 — поиск среди тысяч монет)
+• Введите сумму
+
+<b>Способ 2:</b> Быстрый ввод
+Просто напишите:
+<code>100 USD RUB</code>
+<code>0.5 BTC EUR</code>
+<code>1000 RUB TON</code>
+<code>1.5k руб в $</code>, <code>2 млн тенге to eur</code>
+Можно несколько строк в одном сообщении
+<code>100 USD</code> — сразу во все валюты
+
+<b>Способ 3:</b> В любом чате
+Наберите имя бота и запрос:
+<code>@бот 100 USD RUB</code>
+
+<b>Команды:</b>
+/start — главное меню
+/btc /eth /ton — текущий курс
+/all 100 USD — сумма во всех валютах
+/alert BTC &gt; 70000 — уведомить о курсе
+/history BTC 24h — история курса
+/digest daily BTC USD/RUB — сводка по расписанию
+"""
+    await edit_message(
+        callback.message,
+        text.strip(),
+        kb_back()
+    )
+
+
+# ─────────────────────────── Курсы валют ───────────────────────────
+
+@router.callback_query(F.data.startswith("rates:"), flags={"answers": True, "shed": True})
+async def cb_rates(callback: CallbackQuery):
+    rate_type = "crypto" if callback.data.split(":")[1] == "crypto" else "fiat"
+    snapshot = await CurrencyAPI.get_snapshot()
+    body = None
+    if snapshot:
+        body = cached_render("rates", (rate_type,), snapshot, lambda: render_rates(rate_type, snapshot))
+
+    if not body:
+        await callback.answer()
+        await edit_message(callback.message, "❌ Ошибка загрузки", kb_main())
+        return
+
+    changed = await edit_message(
+        callback.message,
+        f"{body}\n\n{fmt_freshness(snapshot.age)}",
+        kb_rates(f"rates:{rate_type}")
+    )
+    await callback.answer(None if changed else "✅ Курсы не изменились")
+
+
+# ─────────────────────────── Конвертация ───────────────────────────
+
+@router.callback_query(F.data == "convert")
 async def cb_convert(callback: CallbackQuery, state: FSMContext):
     await state.clear()
-    await state.set_state(States.select_from)
-    await callback.message.edit_text(
+    await edit_message(
+        callback.message,
         "💱 <b>Конвертация</b>\n\n"
         "<b>Шаг 1/3:</b> Выберите исходную валюту",
-        reply_markup=kb_currencies(FIAT, "from", "crypto")
+        kb_currencies("fiat", "from")
     )
 
 
-@router.callback_query(F.data.startswith("switch:"))
+@router.callback_query(F.data.startswith(("switch:", "pg:")), flags={"shed": True})
 async def cb_switch(callback: CallbackQuery):
-    _, action, to_type = callback.data.split(":")
-    currencies = CRYPTO if to_type == "crypto" else FIAT
-    switch_to = "fiat" if to_type == "crypto" else "crypto"
-    title = "🪙 Криптовалюты" if to_type == "crypto" else "💵 Фиатные валюты"
+    """Смена группы валют (switch:действие:группа[:из]) или страницы (pg:действие:группа:стр[:из])"""
+    parts = callback.data.split(":")
+    page = 0
+    if parts[0] == "pg":
+        page = int(parts.pop(3)) if len(parts) > 3 and parts[3].isdigit() else 0
+    _, action, to_type, *rest = parts
+    from_code = rest[0] if rest and is_currency(rest[0]) else ""
+    if action not in ("from", "to"):
+        return
+    group = "crypto" if to_type == "crypto" else "fiat"
+    title = "🪙 Криптовалюты" if group == "crypto" else "💵 Фиатные валюты"
 
-    await callback.message.edit_text(
+    await edit_message(
+        callback.message,
         f"💱 <b>Конвертация</b>\n\n{title}:",
-        reply_markup=kb_currencies(currencies, action, switch_to)
+        kb_currencies(group, action, from_code if action == "to" else "", page)
+    )
+
+
+@router.callback_query(F.data == "noop")
+async def cb_noop(callback: CallbackQuery):
+    """Индикатор страницы: нажатие только убирает часики (отвечает CallbackGuard)"""
+
+
+@router.callback_query(F.data.startswith("find:"))
+async def cb_find(callback: CallbackQuery, state: FSMContext):
+    """Поиск валюты по названию или тикеру: следующее сообщение — запрос"""
+    _, action, *rest = callback.data.split(":")
+    if action not in ("from", "to"):
+        return
+    await state.set_state(States.search_currency)
+    await state.update_data(search_action=action, search_from=rest[0] if rest else "")
+    await edit_message(
+        callback.message,
+        "🔍 <b>Поиск валюты</b>\n\nНапишите тикер или название: <code>pepe</code>, <code>solana</code>, <code>евро</code>",
+        kb_back()
     )
 
 
+@router.message(States.search_currency, F.text, ~F.text.startswith("/"))
+async def msg_search(message: Message, state: FSMContext):
+    if tokenize_quick(message.text).error is None:
+        raise SkipHandler()  # «100 USD RUB» — пусть обработает быстрый ввод
+
+    data = await state.get_data()
+    await state.set_state(None)
+    action, from_code = data.get("search_action", "from"), data.get("search_from", "")
+    codes = tuple(c for c in catalog.search(message.text) if c != from_code)
+
+    if not codes:
+        await message.answer("😕 Ничего не нашлось", reply_markup=kb_search(action, from_code, ()))
+        return
+    await message.answer(f"🔍 Найдено: {len(codes)}", reply_markup=kb_search(action, from_code, codes))
+
+
 @router.callback_query(F.data.startswith("c:from:"))
-async def cb_select_from(callback: CallbackQuery, state: FSMContext):
+async def cb_select_from(callback: CallbackQuery):
     code = callback.data.split(":")[2]
-    await state.update_data(from_code=code)
-    await state.set_state(States.select_to)
+    if not is_currency(code):
+        return
 
-    await callback.message.edit_text(
+    await edit_message(
+        callback.message,
         f"💱 <b>Конвертация</b>\n\n"
         f"✅ Из: {get_emoji(code)} <b>{code}</b>\n\n"
         f"<b>Шаг 2/3:</b> Выберите целевую валюту",
-        reply_markup=kb_currencies(FIAT, "to", "crypto")
+        kb_currencies("fiat", "to", code)
     )
 
 
-@router.callback_query(F.data.startswith("c:to:"))
+@router.callback_query(F.data.startswith("c:to:"), flags={"answers": True})
 async def cb_select_to(callback: CallbackQuery, state: FSMContext):
-    code = callback.data.split(":")[2]
-    data = await state.get_data()
-    from_code = data.get("from_code")
+    parts = callback.data.split(":")
+    if len(parts) == 4:
+        from_code, code = parts[2], parts[3]
+    else:
+        # Кнопки старого формата: исходная валюта лежит в FSM
+        from_code, code = (await state.get_data()).get("from_code"), parts[2]
 
+    if not is_currency(from_code) or not is_currency(code):
+        await callback.answer()
+        return
     if code == from_code:
         await callback.answer("❌ Выберите другую валюту!", show_alert=True)
         return
 
-    await state.update_data(to_code=code)
-    await state.set_state(States.enter_amount)
-
-    await callback.message.edit_text(
+    await callback.answer()
+    await remember_pair(state, from_code, code)
+    await edit_message(
+        callback.message,
         f"💱 <b>Конвертация</b>\n\n"
         f"{get_emoji(from_code)} <b>{from_code}</b> ➜ <b>{code}</b> {get_emoji(code)}\n\n"
         f"<b>Шаг 3/3:</b> Введите сумму или выберите:",
-        reply_markup=kb_amounts()
+        kb_amounts(from_code, code)
     )
 
 
-@router.callback_query(F.data.startswith("a:"))
-async def cb_amount(callback: CallbackQuery, state: FSMContext):
-    amount = float(callback.data.split(":")[1])
-    await process_conversion(callback.message, state, amount, edit=True)
+@router.callback_query(F.data.startswith(f"{CB_VERSION}:a:"), flags={"answers": True, "shed": True})
+async def cb_amount(callback: CallbackQuery):
+    cb = ConvCallback.unpack(callback.data)
+    if cb is None or cb.amount is None:
+        await callback.answer()
+        return
+    changed = await process_conversion(callback.message, cb.amount, cb.from_code, cb.to_code, edit=True)
+    await callback.answer(None if changed else "✅ Курс не изменился")
 
 
-@router.message(States.enter_amount)
-async def msg_amount(message: Message, state: FSMContext):
+@router.callback_query(F.data.startswith("a:"), flags={"answers": True, "shed": True})
+async def cb_amount_legacy(callback: CallbackQuery, state: FSMContext):
+    """Кнопки сумм старого формата: пара берётся из FSM"""
+    data = await state.get_data()
     try:
-        text = message.text.replace(",", ".").replace(" ", "")
-        amount = float(text)
-        if amount <= 0:
-            raise ValueError
-        await process_conversion(message, state, amount, edit=False)
+        amount = float(callback.data.split(":")[1])
     except ValueError:
-        await message.answer("❌ Введите корректное число\nПример: <code>100</code> или <code>0.5</code>")
+        await callback.answer()
+        return
+    changed = await process_conversion(callback.message, amount, data.get("from_code"), data.get("to_code"), edit=True)
+    await callback.answer(None if changed else "✅ Курс не изменился")
+
 
+@router.message(States.enter_amount, F.text, ~F.text.contains("\n"), ~F.text.startswith("/"))
+async def msg_amount(message: Message, state: FSMContext):
+    quick = tokenize_quick(message.text)
+    if quick.error in (None, "unknown_currency"):
+        raise SkipHandler()  # «100 USD RUB» — пусть обработает быстрый ввод
+    if quick.error != "no_currency":
+        await message.answer("❌ Введите корректное число\nПример: <code>100</code>, <code>0.5</code> или <code>1.5k</code>")
+        return
 
-async def process_conversion(message: Message, state: FSMContext, amount: float, edit: bool):
-    """Выполнение конвертации и вывод результата"""
     data = await state.get_data()
-    from_code = data.get("from_code")
-    to_code = data.get("to_code")
+    await process_conversion(message, quick.amount, data.get("from_code"), data.get("to_code"), edit=False)
+
+
+async def remember_pair(state: FSMContext, from_code: str, to_code: str):
+    """Запомнить пару для ввода суммы текстом: две записи в хранилище, без чтения"""
+    await state.set_data({"from_code": from_code, "to_code": to_code})
+    await state.set_state(States.enter_amount)
 
+
+async def conversion_reply(amount: float, from_code: str,
+                           to_code: str) -> tuple[str, InlineKeyboardMarkup, bool]:
+    """Конвейер конвертации: (сумма, из, в) -> (текст, клавиатура, успех), без FSM"""
+    snapshot = await CurrencyAPI.get_snapshot(from_code, to_code)
+    result = snapshot.convert(amount, from_code, to_code) if snapshot else None
+
+    if not result:
+        return "❌ Не удалось получить курс. Попробуйте позже.", kb_main(), False
+
+    # Красивый вывод результата
+    body = cached_render("conversion", (amount, from_code, to_code), snapshot,
+                         lambda: render_conversion(result))
+    return f"{body}\n{fmt_freshness(snapshot.age)}", kb_result(from_code, to_code), True
+
+
+async def process_conversion(message: Message, amount: float, from_code: Optional[str],
+                             to_code: Optional[str], edit: bool) -> bool:
+    """Выполнение конвертации и вывод результата; False — сообщение не менялось"""
     if not from_code or not to_code:
         await message.answer("❌ Ошибка. Начните заново /start")
+        return True
+
+    text, kb, _ = await conversion_reply(amount, from_code, to_code)
+
+    if edit:
+        return await edit_message(message, text, kb)
+    await message.answer(text, reply_markup=kb)
+    return True
+
+
+# ─────────────────────────── Доп. действия ───────────────────────────
+
+@router.callback_query(F.data.startswith((f"{CB_VERSION}:s:", f"{CB_VERSION}:n:", f"{CB_VERSION}:p:",
+                                          "swap:", "amt:", "p:")))
+async def cb_pair_action(callback: CallbackQuery, state: FSMContext):
+    """Поменять местами / другая сумма / популярная пара: показать выбор суммы"""
+    cb = ConvCallback.unpack(callback.data)
+    if cb is None:
         return
 
-    result = await CurrencyAPI.convert(amount, from_code, to_code)
+    if cb.action == "s":
+        from_c, to_c = cb.to_code, cb.from_code
+        title = "🔄 <b>Поменяли местами!</b>\n\n"
+        pair = f"{get_emoji(from_c)} <b>{from_c}</b> ➜ <b>{to_c}</b> {get_emoji(to_c)}"
+    elif cb.action == "n":
+        from_c, to_c = cb.from_code, cb.to_code
+        title, pair = "", f"💱 <b>{from_c} ➜ {to_c}</b>"
+    else:
+        from_c, to_c = cb.from_code, cb.to_code
+        title, pair = "", f"💱 {get_emoji(from_c)} <b>{from_c}</b> ➜ <b>{to_c}</b> {get_emoji(to_c)}"
+
+    await remember_pair(state, from_c, to_c)
+    await edit_message(
+        callback.message,
+        f"{title}{pair}\n\nВведите сумму:",
+        kb_amounts(from_c, to_c)
+    )
+
 
-    if not result:
-        text = "❌ Не удалось получить курс. Попробуйте позже."
-        if edit:
-            await message.edit_text(text, reply_markup=kb_main())
+@router.callback_query(F.data == "popular")
+async def cb_popular(callback: CallbackQuery):
+    await edit_message(
+        callback.message,
+        "⭐ <b>Популярные пары</b>\n\nВыберите для конвертации:",
+        kb_popular()
+    )
+
+
+# ─────────────────────────── Быстрый ввод ───────────────────────────
+
+async def quick_input(message: Message) -> Union[bool, dict]:
+    """Фильтр быстрого ввода (асинхронный: синхронные фильтры aiogram гоняет через поток)"""
+    if not message.text or "\n" in message.text:
+        return False
+    private = message.chat.type == "private"
+    quick = tokenize_quick(message.text, any_case=private)
+    # Неизвестная валюта после суммы — явно попытка конвертации, в личке стоит подсказать
+    if quick.error is None or (quick.error == "unknown_currency" and private):
+        return {"quick": quick}
+    return False
+
+
+@router.message(quick_input)
+async def quick_convert(message: Message, quick: QuickInput):
+    """Быстрая конвертация: 100 USD RUB, или 100 USD — во все валюты"""
+    if quick.error:
+        await message.answer(
+            f"❌ {QUICK_ERRORS[quick.error]}: <code>{html.escape(quick.token)}</code>\n"
+            "Пример: <code>100 USD RUB</code>, <code>1.5k руб в $</code>"
+        )
+    elif quick.to_code is None:
+        await send_all(message, quick.amount, quick.from_code)
+    else:
+        await process_conversion(message, quick.amount, quick.from_code, quick.to_code, edit=False)
+
+
+@router.message(Command("all"))
+async def cmd_all(message: Message, command: CommandObject):
+    """Сумма во всех валютах: /all 100 USD"""
+    parsed = parse_quick(command.args or "")
+    if parsed is None:
+        await message.answer("❌ Пример: <code>/all 100 USD</code>")
+        return
+    await send_all(message, parsed[0], parsed[1])
+
+
+async def send_all(message: Message, amount: float, from_code: str):
+    """Ответ таблицей «сумма во всех валютах»"""
+    snapshot = await CurrencyAPI.get_snapshot(from_code)
+    body = None
+    if snapshot:
+        body = cached_render("all", (amount, from_code), snapshot,
+                             lambda: render_all(amount, from_code, snapshot))
+
+    if not body:
+        await message.answer("❌ Не удалось получить курс. Попробуйте позже.", reply_markup=kb_main())
+        return
+    await message.answer(f"{body}\n\n{fmt_freshness(snapshot.age)}")
+
+
+@router.message(F.text.contains("\n"))
+async def batch_convert(message: Message):
+    """Пакетная конвертация: по строке «100 USD RUB» на каждую пару"""
+    lines = [line for line in message.text.splitlines() if line.strip()]
+    truncated = len(lines) > BATCH_MAX_LINES
+    lines = lines[:BATCH_MAX_LINES]
+
+    # В группах тикеры монет каталога — только заглавными, как и в быстром вводе
+    any_case = message.chat.type == "private"
+    parsed, bad = [], []
+    for n, line in enumerate(lines, 1):
+        item = parse_quick(line, any_case)
+        if item is None or item[2] is None:
+            bad.append(n)
         else:
-            await message.answer(text, reply_markup=kb_main())
+            parsed.append(item)
+
+    # Ничего похожего на конвертацию — не наше сообщение
+    if not parsed:
         return
 
-    # Красивый вывод результата
-    text = f"""
-┏━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-┃      💱 <b>КОНВЕРТАЦИЯ</b>
-┗━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+    amounts, from_codes, to_codes = zip(*parsed)
+    snapshot = await CurrencyAPI.get_snapshot(*from_codes, *to_codes)
+    if snapshot is None:
+        await message.answer("❌ Не удалось получить курс. Попробуйте позже.")
+        return
 
-  {get_emoji(from_code)}  <b>{fmt_num(result.amount)} {from_code}</b>
-              ⬇️
-  {get_emoji(to_code)}  <b>{fmt_num(result.result)} {to_code}</b>
+    results = snapshot.convert_many(np.array(amounts, dtype=float), list(from_codes), list(to_codes))
 
-┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈
+    rows = []
+    for amount, from_c, to_c, result in zip(amounts, from_codes, to_codes, results):
+        value = "—" if np.isnan(result) else fmt_num(float(result))
+        rows.append(f"{fmt_num(amount)} {from_c} = {value} {to_c}")
 
-📊 <b>Курс обмена:</b>
-   1 {from_code} = {fmt_num(result.rate)} {to_code}
+    text = [f"📋 <b>Конвертация ({len(rows)})</b>\n", "<pre>" + "\n".join(rows) + "</pre>"]
+    if bad:
+        text.append(f"\n❌ Не распознаны строки: {', '.join(map(str, bad))}")
+    if truncated:
+        text.append(f"\n✂️ Обработаны первые {BATCH_MAX_LINES} строк")
+    text.append("\n" + fmt_freshness(snapshot.age))
 
-💵 <b>Цена в USD:</b>
-   1 {from_code} = ${fmt_num(result.from_usd)}
-   1 {to_code} = ${fmt_num(result.to_usd)}
+    await message.answer("\n".join(text))
 
-┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈
-⏱ <i>Актуальный курс</i>
-"""
 
-    kb = kb_result(from_code, to_code)
+# ─────────────────────────── Inline-режим ───────────────────────────
 
-    if edit:
-        await message.edit_text(text.strip(), reply_markup=kb)
+inline_cache = LRUCache(maxsize=INLINE_CACHE_SIZE)
+
+
+def build_inline_results(amount: float, from_c: str, to_c: Optional[str],
+                         snapshot: RateSnapshot) -> list[InlineQueryResultArticle]:
+    """Карточки: запрошенная пара и популярные валюты"""
+    targets = [to_c] if to_c else []
+    targets += [t for t in INLINE_TARGETS if t not in (from_c, to_c)]
+    footer = fmt_freshness(snapshot.age)
+
+    results = []
+    for target in targets:
+        result = snapshot.convert(amount, from_c, target)
+        if result is None:
+            continue
+        body = cached_render("conversion", (amount, from_c, target), snapshot,
+                             lambda: render_conversion(result))
+        results.append(InlineQueryResultArticle(
+            id=f"{from_c}:{target}:{amount:.15g}",
+            title=f"{fmt_num(amount)} {from_c} = {fmt_num(result.result)} {target}",
+            description=f"1 {from_c} = {fmt_num(result.rate)} {target}",
+            input_message_content=InputTextMessageContent(message_text=f"{body}\n{footer}"),
+        ))
+    return results
+
+
+@router.inline_query(flags={"shed": True})
+async def inline_convert(query: InlineQuery):
+    """Inline-конвертация: @bot 100 USD RUB"""
+    parsed = parse_quick(query.query) if query.query else None
+    snapshot = await CurrencyAPI.get_snapshot(*parsed[1:]) if parsed else None
+
+    if snapshot is None:
+        await query.answer([], cache_time=INLINE_CACHE_TIME)
+        return
+
+    # Ключ: нормализованный запрос + версия курсов (+ подпись о свежести, она тоже в тексте)
+    key = (parsed, snapshot.version, fmt_freshness(snapshot.age))
+    results = inline_cache.get(key)
+    if results is None:
+        results = inline_cache[key] = build_inline_results(*parsed, snapshot)
+
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False)
+
+
+# ─────────────────────────── Уведомления ───────────────────────────
+
+ALERT_RE = re.compile(r"^([A-Za-z][A-Za-z0-9]{1,9})(?:[\s/]+([A-Za-z][A-Za-z0-9]{1,9}))?\s*([<>])\s*([\d\s.,]+)$")
+
+
+@router.message(Command("alert"))
+async def cmd_alert(message: Message, command: CommandObject):
+    """Создать уведомление: /alert BTC > 70000, /alert USD/RUB < 90"""
+    m = ALERT_RE.match((command.args or "").strip())
+    threshold = parse_amount(m[4].strip()) if m else None
+
+    base, quote = (m[1].upper(), (m[2] or "USD").upper()) if m else (None, None)
+    if not threshold or threshold <= 0 or not is_currency(base) or not is_currency(quote) or base == quote:
+        await message.answer(
+            "🔔 <b>Уведомление о курсе</b>\n\n"
+            "<code>/alert BTC &gt; 70000</code> — BTC дороже 70 000 USD\n"
+            "<code>/alert USD/RUB &lt; 90</code> — доллар дешевле 90 ₽\n\n"
+            "/alerts — мои уведомления"
+        )
+        return
+
+    if len(alerts.user_alerts(message.from_user.id)) >= ALERTS_PER_USER:
+        await message.answer(f"❌ Не больше {ALERTS_PER_USER} уведомлений. Удалите лишние: /alerts")
+        return
+
+    alert = alerts.add(message.from_user.id, message.chat.id, base, quote, m[3] == ">", threshold)
+    await CurrencyAPI.get_snapshot(base, quote)  # Монеты каталога начнут обновляться сразу
+    await message.answer(f"✅ Уведомление #{alert.id}: {html.escape(alert.describe())}")
+
+
+@router.message(Command("alerts"))
+async def cmd_alerts(message: Message):
+    """Список уведомлений пользователя"""
+    items = alerts.user_alerts(message.from_user.id)
+    if not items:
+        await message.answer("🔕 Уведомлений нет\n\nСоздать: <code>/alert BTC &gt; 70000</code>")
+        return
+
+    lines = ["🔔 <b>Мои уведомления</b>\n"]
+    for alert in items:
+        status = "" if alert.armed else " (сработало)"
+        lines.append(f"#{alert.id} {html.escape(alert.describe())}{status}")
+    lines.append("\nУдалить: <code>/delalert НОМЕР</code>")
+    await message.answer("\n".join(lines))
+
+
+@router.message(Command("delalert"))
+async def cmd_delalert(message: Message, command: CommandObject):
+    """Удалить уведомление: /delalert 12"""
+    arg = (command.args or "").strip().lstrip("#")
+    if arg.isdigit() and alerts.remove(message.from_user.id, int(arg)):
+        await message.answer(f"🗑 Уведомление #{arg} удалено")
     else:
-        await message.answer(text.strip(), reply_markup=kb)
+        await message.answer("❌ Нет такого уведомления. Список: /alerts")
 
 
-# ─────────────────────────── Доп. действия ───────────────────────────
+# ─────────────────────────── Сводки ───────────────────────────
 
-@router.callback_query(F.data.startswith("swap:"))
-async def cb_swap(callback: CallbackQuery, state: FSMContext):
-    _, from_c, to_c = callback.data.split(":")
-    await state.update_data(from_code=to_c, to_code=from_c)
-    await state.set_state(States.enter_amount)
+DIGEST_MODES = {"hourly": "hourly", "час": "hourly", "daily": "daily", "день": "daily"}
+DIGEST_DEFAULT_PAIRS = tuple(POPULAR_PAIRS[:4])
 
-    await callback.message.edit_text(
-        f"🔄 <b>Поменяли местами!</b>\n\n"
-        f"{get_emoji(to_c)} <b>{to_c}</b> ➜ <b>{from_c}</b> {get_emoji(from_c)}\n\n"
-        f"Введите сумму:",
-        reply_markup=kb_amounts()
-    )
 
+@router.message(Command("digest"))
+async def cmd_digest(message: Message, command: CommandObject):
+    """Сводка по расписанию: /digest daily BTC USD/RUB, /digest hourly, /digest off"""
+    args = (command.args or "").replace(",", " ").split()
+    current = digests.get(message.chat.id)
+    mode = args[0].lower() if args else ""
 
-@router.callback_query(F.data.startswith("amt:"))
-async def cb_new_amount(callback: CallbackQuery, state: FSMContext):
-    _, from_c, to_c = callback.data.split(":")
-    await state.update_data(from_code=from_c, to_code=to_c)
-    await state.set_state(States.enter_amount)
+    if mode in ("off", "stop", "выкл"):
+        if digests.unsubscribe(message.chat.id):
+            await message.answer("🔕 Сводка отключена")
+        else:
+            await message.answer("🔕 Подписки на сводку нет")
+        return
 
-    await callback.message.edit_text(
-        f"💱 <b>{from_c} ➜ {to_c}</b>\n\nВведите сумму:",
-        reply_markup=kb_amounts()
-    )
+    period = DIGEST_MODES.get(mode)
+    pairs = parse_pairs(args[1:]) if len(args) > 1 else (current[1] if current else DIGEST_DEFAULT_PAIRS)
+    if period is None or pairs is None:
+        status = (f"Сейчас: {describe_period(current[0])} — {format_pairs(current[1])}\n\n"
+                  if current else "")
+        await message.answer(
+            "📬 <b>Сводка курсов по расписанию</b>\n\n"
+            f"{status}"
+            "<code>/digest daily BTC USD/RUB</code> — раз в день\n"
+            "<code>/digest hourly</code> — каждый час\n"
+            "<code>/digest off</code> — отписаться\n\n"
+            f"До {DIGEST_MAX_PAIRS} пар; просто код — курс к USD"
+        )
+        return
 
+    digests.subscribe(message.chat.id, message.from_user.id, period, pairs)
+    snapshot = await CurrencyAPI.get_snapshot(*{code for pair in pairs for code in pair})
+    preview = render_digest(period, pairs, snapshot) if snapshot else None
+    text = f"✅ Сводка {describe_period(period)}: {format_pairs(pairs)}"
+    await message.answer(f"{text}\n\n{preview}" if preview else text)
 
-@router.callback_query(F.data == "popular")
-async def cb_popular(callback: CallbackQuery):
-    await callback.message.edit_text(
-        "⭐ <b>Популярные пары</b>\n\nВыберите для конвертации:",
-        reply_markup=kb_popular()
-    )
 
+# ─────────────────────────── История ───────────────────────────
 
-@router.callback_query(F.data.startswith("p:"))
-async def cb_pair(callback: CallbackQuery, state: FSMContext):
-    _, from_c, to_c = callback.data.split(":")
-    await state.update_data(from_code=from_c, to_code=to_c)
-    await state.set_state(States.enter_amount)
+PERIOD_RE = re.compile(r"^(\d+)\s*(m|min|h|d|w|м|мин|ч|д|н)$", re.I)
+PERIOD_UNITS = {"m": 60, "min": 60, "м": 60, "мин": 60, "h": 3600, "ч": 3600,
+                "d": 86400, "д": 86400, "w": 604800, "н": 604800}
+SPARK = "▁▂▃▄▅▆▇█"
 
-    await callback.message.edit_text(
-        f"💱 {get_emoji(from_c)} <b>{from_c}</b> ➜ <b>{to_c}</b> {get_emoji(to_c)}\n\n"
-        f"Введите сумму:",
-        reply_markup=kb_amounts()
-    )
 
+def parse_period(text: str) -> Optional[int]:
+    """24h, 7d, 30m -> секунды"""
+    m = PERIOD_RE.match(text)
+    return int(m[1]) * PERIOD_UNITS[m[2].lower()] if m else None
 
-# ─────────────────────────── Быстрый ввод ───────────────────────────
 
-@router.message(F.text.regexp(r"^[\d\s,\.]+\s+[A-Za-z]{2,6}\s+[A-Za-z]{2,6}$", flags=re.I))
-async def quick_convert(message: Message, state: FSMContext):
-    """Быстрая конвертация: 100 USD RUB"""
-    try:
-        parts = message.text.upper().split()
-        amount = float(parts[0].replace(",", ".").replace(" ", ""))
-        from_c, to_c = parts[1], parts[2]
+def sparkline(values: np.ndarray, width: int = 24) -> str:
+    """Мини-график из символов ▁..█"""
+    if len(values) > width:
+        values = values[np.linspace(0, len(values) - 1, width).astype(int)]
+    lo, hi = values.min(), values.max()
+    if hi == lo:
+        return SPARK[3] * len(values)
+    levels = ((values - lo) / (hi - lo) * (len(SPARK) - 1)).round().astype(int)
+    return "".join(SPARK[i] for i in levels)
 
-        if from_c not in ALL_CURRENCIES or to_c not in ALL_CURRENCIES:
-            return
 
-        await state.update_data(from_code=from_c, to_code=to_c)
-        await process_conversion(message, state, amount, edit=False)
-    except:
-        pass
+@router.message(Command("history"))
+async def cmd_history(message: Message, command: CommandObject):
+    """История курса: /history BTC 24h, /history USD RUB 7d"""
+    args = (command.args or "").upper().replace("/", " ").split()
+    seconds = parse_period(args[-1].lower()) if args else None
+    if seconds is not None:
+        args = args[:-1]
+    seconds = seconds or 86400
+
+    base, quote = (args + ["USD"])[:2] if args else (None, None)
+    if len(args) > 2 or base not in ALL_CURRENCIES or quote not in ALL_CURRENCIES or base == quote:
+        await message.answer("📈 Пример: <code>/history BTC 24h</code>, <code>/history USD RUB 7d</code>")
+        return
+
+    ts, rates = history.series(base, quote, seconds)
+    if len(rates) < 2:
+        await message.answer("⏳ Недостаточно данных: история копится с момента запуска бота")
+        return
+
+    first, last = rates[0], rates[-1]
+    change = (last / first - 1) * 100
+    await message.answer(
+        f"📈 <b>{base}/{quote}</b> за {fmt_age(seconds)}\n\n"
+        f"<code>{sparkline(rates)}</code>\n\n"
+        f"Сейчас: <b>{fmt_num(float(last))}</b>\n"
+        f"Мин: {fmt_num(float(rates.min()))}\n"
+        f"Макс: {fmt_num(float(rates.max()))}\n"
+        f"Изменение: {'📈' if change >= 0 else '📉'} {change:+.2f}%\n\n"
+        f"<i>{len(rates)} точек с {time.strftime('%d.%m %H:%M', time.localtime(ts[0]))}</i>"
+    )
 
 
 # ─────────────────────────── Быстрые команды ───────────────────────────
@@ -576,13 +3324,15 @@ async def quick_convert(message: Message, state: FSMContext):
 async def cmd_crypto_price(message: Message):
     """Быстрый курс крипты"""
     code = message.text[1:].upper()
-    prices = await CurrencyAPI.get_crypto_prices()
+    snapshot = await CurrencyAPI.get_snapshot()
+    p = snapshot.usd_price(code) if snapshot else None
 
-    if code in prices:
-        p = prices[code]
+    if p is not None:
         info = CRYPTO.get(code, (code, "🪙", ""))
         formatted = f"${p:,.2f}" if p >= 1 else f"${p:.6f}"
-        await message.answer(f"{info[1]} <b>{info[0]}</b>\n\n💵 {formatted}")
+        await message.answer(
+            f"{info[1]} <b>{info[0]}</b>\n\n💵 {formatted}\n\n{fmt_freshness(snapshot.age)}"
+        )
     else:
         await message.answer("❌ Не удалось получить курс")
 
@@ -591,17 +3341,1012 @@ async def cmd_crypto_price(message: Message):
 async def cmd_rates(message: Message):
     await message.answer(
         "📊 <b>Выберите тип:</b>",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📈 Крипто", callback_data="rates:crypto"),
-             InlineKeyboardButton(text="💵 Фиат", callback_data="rates:fiat")]
-        ])
+        reply_markup=kb_rate_types()
     )
 
 
+# ─────────────────────────── Диагностика ───────────────────────────
+
+@router.message(Command("profile"))
+async def cmd_profile(message: Message, command: CommandObject):
+    """Профилировать процесс N секунд: /profile 30 (только ADMIN_IDS)"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    arg = (command.args or "").strip()
+    seconds = min(max(int(arg), 1), PROFILE_MAX_SECONDS) if arg.isdigit() else PROFILE_SECONDS
+
+    async def report(path: str, top: str):
+        await message.answer(f"📊 <b>Профиль за {seconds} с</b>\n<code>{html.escape(path)}</code>\n\n"
+                             f"<pre>{html.escape(top[:3500], quote=False)}</pre>")
+
+    if profiler.start(seconds, report):
+        await message.answer(f"⏱ Профилирование {seconds} с, процесс {os.getpid()}…")
+    else:
+        await message.answer("⏳ Профилирование уже идёт")
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              MIDDLEWARE
+# ══════════════════════════════════════════════════════════════════════════════
+
+class ConcurrencyLimit(BaseMiddleware):
+    """Ограничение числа апдейтов, обрабатываемых одновременно"""
+
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self._semaphore:
+            return await handler(event, data)
+
+
+class LoopLagMonitor:
+    """Задержка цикла событий: насколько позже положенного просыпается таймер"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_SHED):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = 0.0
+        self.peak = 0.0          # Наибольшая задержка с последнего сброса (итог профилирования)
+        self.overloaded = False  # Выше порога; снимается, когда задержка упадёт вдвое ниже него
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - started - self.interval)
+            self.peak = max(self.peak, self.lag)
+            metrics.observe("bot_loop_lag_seconds", self.lag)
+            if self.lag > self.threshold:
+                if not self.overloaded:
+                    logging.warning(f"Event loop lag {self.lag * 1000:.0f} ms, shedding low-priority updates")
+                self.overloaded = True
+            elif self.lag < self.threshold / 2:
+                self.overloaded = False
+
+
+loop_lag = LoopLagMonitor()
+
+
+class TracingDispatcher(Dispatcher):
+    """Dispatcher с трассировкой: апдейт дольше SLOW_UPDATE пишется в лог по этапам.
+
+    Замер начинается до мидлварей самого aiogram, поэтому в него попадают и
+    чтение состояния FSM, и ожидание блокировки пользователя. Этапы
+    отмечают @traced и таймеры запросов к Telegram; «other» — всё, что не
+    попало ни в один этап (код хендлера, фильтры, ожидание цикла событий).
+    """
+
+    slow = SLOW_UPDATE
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs):
+        trace = UpdateTrace()
+        token = update_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            return await super().feed_update(bot, update, **kwargs)
+        finally:
+            update_trace.reset(token)
+            elapsed = time.perf_counter() - started
+            if elapsed > self.slow:
+                self._report(update, trace, elapsed)
+
+    @staticmethod
+    def _report(update: Update, trace: UpdateTrace, elapsed: float):
+        metrics.inc("bot_slow_updates_total", (("handler", trace.handler or "none"),))
+        stages = sorted(trace.stages.items(), key=lambda item: -item[1])
+        other = max(elapsed - sum(trace.stages.values()), 0.0)
+        breakdown = ", ".join(f"{name} {seconds * 1000:.0f}" for name, seconds in stages + [("other", other)])
+        logging.warning(f"Slow update {update.update_id} ({update.event_type}, {trace.handler or 'no handler'}): "
+                        f"{elapsed * 1000:.0f} ms [{breakdown}], loop lag {loop_lag.lag * 1000:.0f} ms")
+
+
+class Profiler:
+    """cProfile всего процесса на N секунд по /profile или SIGUSR1.
+
+    Профилируется поток цикла событий — все хендлеры, мидлвари и запросы
+    сразу. Итог: .prof для snakeviz / pstats и текстовая сводка рядом, в
+    PROFILE_DIR.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR):
+        self.directory = directory
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, seconds: float, report=None) -> bool:
+        """Запустить в фоне; report(путь, сводка) получит итог. False — профилирование уже идёт"""
+        if self._task is not None:
+            return False
+        self._task = asyncio.get_running_loop().create_task(self._run(seconds, report))
+        self._task.add_done_callback(self._finished)
+        return True
+
+    def _finished(self, task: asyncio.Task):
+        self._task = None
+        if not task.cancelled() and task.exception():
+            logging.error(f"Profiling failed: {task.exception()}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self, seconds: float, report):
+        logging.warning(f"Profiling for {seconds}s")
+        profile = cProfile.Profile()
+        loop_lag.peak = 0.0
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+        path, top = await asyncio.get_running_loop().run_in_executor(
+            None, self._dump, profile, seconds, loop_lag.peak)
+        logging.warning(f"Profile saved: {path}")
+        if report is not None:
+            await report(path, top)
+
+    def _dump(self, profile: cProfile.Profile, seconds: float, lag: float) -> tuple[str, str]:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof")
+        profile.dump_stats(path)
+
+        out = io.StringIO()
+        out.write(f"{seconds}s, pid {os.getpid()}, loop lag peak {lag * 1000:.0f} ms\n")
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats("tottime").print_stats(40)
+        stats.sort_stats("cumulative").print_stats(40)
+        with open(path[:-len(".prof")] + ".txt", "w", encoding="utf-8") as f:
+            f.write(out.getvalue())
+
+        # Короткая сводка для чата: собственное время функции и вместе с вложенными
+        rows = sorted(stats.stats.items(), key=lambda item: -item[1][2])[:PROFILE_TOP]
+        lines = [f"loop lag peak {lag * 1000:.0f} ms", "own ms  total ms  calls  function"]
+        for (file, line, func), (_, calls, own, total, _) in rows:
+            lines.append(f"{own * 1000:6.1f} {total * 1000:9.1f} {calls:6d}  {func} {os.path.basename(file)}:{line}")
+        return path, "\n".join(lines)
+
+
+profiler = Profiler()
+
+
+class CallbackGuard(BaseMiddleware):
+    """Защита от шквала нажатий и перегрузки.
+
+    Снаружи, на всех апдейтах: повторное нажатие той же кнопки на том же
+    сообщении в течение CALLBACK_DEBOUNCE отбрасывается сразу, ещё до
+    фильтров, и запоминается последнее нажатие на каждом сообщении. Перед
+    хендлером: нажатие, которое ждало очереди, пока на том же сообщении
+    нажали что-то ещё, отбрасывается — сообщение всё равно перерисует более
+    новое. При задержке цикла событий отбрасываются хендлеры с флагом shed.
+    На callback бот отвечает сразу, не дожидаясь хендлера; хендлеры с флагом
+    answers отвечают сами (текстом или alert).
+    """
+
+    def __init__(self, window: float = CALLBACK_DEBOUNCE):
+        self._recent = TTLCache(maxsize=100_000, ttl=window)  # (пользователь, сообщение, data)
+        self._latest: dict[tuple, int] = {}                   # сообщение -> update_id последнего нажатия
+        self._tasks: set[asyncio.Task] = set()
+
+    @staticmethod
+    def _message_key(callback: CallbackQuery) -> tuple:
+        if callback.inline_message_id:
+            return (callback.inline_message_id,)
+        if callback.message:
+            return (callback.message.chat.id, callback.message.message_id)
+        return (callback.id,)
+
+    async def __call__(self, handler, event, data):
+        if isinstance(event, Update):
+            return await self._outer(handler, event, data)
+        return await self._inner(handler, event, data)
+
+    async def _outer(self, handler, update: Update, data):
+        callback = update.callback_query
+        if callback is None:
+            return await handler(update, data)
+
+        message = self._message_key(callback)
+        pressed = (callback.from_user.id, message, callback.data)
+        if pressed in self._recent:
+            self._drop("debounce", callback)
+            return None
+        self._recent[pressed] = True
+        self._latest[message] = update.update_id
+
+        try:
+            result = await handler(update, data)
+            if result is UNHANDLED:
+                self._answer(callback)  # Кнопка без хендлера: хотя бы убрать часики
+            return result
+        finally:
+            if self._latest.get(message) == update.update_id:
+                del self._latest[message]
+
+    async def _inner(self, handler, event, data):
+        if isinstance(event, CallbackQuery):
+            update = data.get("event_update")
+            if update is not None and self._latest.get(self._message_key(event), update.update_id) != update.update_id:
+                self._drop("superseded", event)
+                return None
+        if loop_lag.overloaded and get_flag(data, "shed"):
+            self._drop("shed", event, "⏳ Бот перегружен, попробуйте через пару секунд")
+            return None
+        if isinstance(event, CallbackQuery) and not get_flag(data, "answers"):
+            self._answer(event)
+        return await handler(event, data)
+
+    def _drop(self, reason: str, event, text: Optional[str] = None):
+        kind = "callback_query" if isinstance(event, CallbackQuery) else "inline_query"
+        metrics.inc("bot_updates_dropped_total", (("reason", reason), ("event", kind)))
+        if isinstance(event, CallbackQuery):
+            self._answer(event, text)
+
+    def _answer(self, callback: CallbackQuery, text: Optional[str] = None):
+        """Ответить на callback в фоне: хендлер не ждёт этого запроса"""
+        task = asyncio.create_task(self._send_answer(callback, text))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _send_answer(callback: CallbackQuery, text: Optional[str]):
+        try:
+            await callback.answer(text)
+        except TelegramBadRequest as e:
+            logging.debug(f"Callback answer failed: {e}")  # Запрос устарел, пока ждал очереди
+
+
+callback_guard = CallbackGuard()
+
+
+class HandlerTimer(BaseMiddleware):
+    """Гистограмма времени работы каждого хендлера"""
+
+    async def __call__(self, handler, event, data):
+        handler_obj = data.get("handler")
+        name = handler_obj.callback.__name__ if handler_obj else "unknown"
+        trace = update_trace.get()
+        if trace is not None:
+            trace.handler = name
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, (("handler", name),))
+
+
+class TelegramTimer(BaseRequestMiddleware):
+    """Время и ошибки запросов к Bot API (без ожидания в очереди отправки)"""
+
+    async def __call__(self, make_request, bot, method):
+        labels = (("method", type(method).__name__),)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("bot_telegram_errors_total", labels + (("error", type(e).__name__),))
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe("bot_telegram_seconds", elapsed, labels)
+            trace = update_trace.get()
+            if trace is not None:
+                trace.add("telegram", elapsed)
+
+
+router.callback_query.middleware(callback_guard)
+router.inline_query.middleware(callback_guard)
+for _observer in (router.message, router.callback_query, router.inline_query):
+    _observer.middleware(HandlerTimer())
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              ОТПРАВКА В TELEGRAM
+# ══════════════════════════════════════════════════════════════════════════════
+
+PRIORITY_REPLY = 0       # Ответы пользователю
+PRIORITY_BROADCAST = 1   # Рассылки: пропускают ответы вперёд
+
+send_priority: ContextVar[int] = ContextVar("send_priority", default=PRIORITY_REPLY)
+
+
+class TokenBucket:
+    """Ведро токенов с резервированием: вызывающий сразу узнаёт, сколько ждать"""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Занять токен; вернуть задержку до момента, когда им можно воспользоваться"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait_time(self) -> float:
+        """Сколько ждать до свободного токена (без резервирования)"""
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (после 429 от Telegram).
+
+        К концу паузы накопится ровно один токен — его и займёт следующий
+        reserve(), так что ждать придётся seconds, а не seconds + 1/rate.
+        """
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 1.0 - seconds * self.rate)
+
+
+class SendQueue(BaseRequestMiddleware):
+    """Планировщик исходящих запросов к Bot API.
+
+    Сначала запрос ждёт своей очереди в ведре чата (1 сообщение/с в личку,
+    20/мин в группу), затем — общий лимит бота в порядке приоритета: ответы
+    раньше рассылок. 429 Retry-After соблюдается автоматически: паузу берут и
+    ведро чата, и общий лимит бота. Из нескольких
+    ожидающих правок одного сообщения уходит только последняя.
+    """
+
+    def __init__(self, global_rate: float = TG_GLOBAL_RATE, chat_rate: float = TG_CHAT_RATE,
+                 group_rate: float = TG_GROUP_RATE, chat_burst: float = TG_CHAT_BURST,
+                 max_retries: int = TG_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = LRUCache(maxsize=100_000)  # chat_id -> TokenBucket
+        self._heap: list = []                    # (приоритет, номер, future)
+        self._seq = 0
+        self._latest_edit: dict[tuple, int] = {}  # (chat_id, message_id) -> номер последней правки
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    def stats(self) -> dict[str, int]:
+        return {"queued": len(self._heap), "sent": self.sent,
+                "coalesced": self.coalesced, "retried": self.retried}
+
+    def set_global_rate(self, rate: float):
+        """Общий лимит бота, когда его делят несколько процессов"""
+        self._global = TokenBucket(rate, max(rate, 1.0))
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            private = isinstance(chat_id, int) and chat_id > 0
+            bucket = TokenBucket(self.chat_rate if private else self.group_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _global_slot(self, priority: int):
+        """Дождаться токена общего лимита в порядке приоритета"""
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._grant_loop())
+
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._heap, (priority, self._seq, future))
+        self._wakeup.set()
+        await future
+
+    async def _grant_loop(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self._global.wait_time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, future = heapq.heappop(self._heap)
+            if not future.done():
+                self._global.take()
+                future.set_result(None)
+
+    def _superseded(self, edit_key: Optional[tuple], seq: int) -> bool:
+        return edit_key is not None and self._latest_edit.get(edit_key) != seq
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        name = type(method).__name__
+        if chat_id is None or not name.startswith(("Send", "Edit", "Copy", "Forward")):
+            return await make_request(bot, method)
+
+        edit_key, my_seq = None, 0
+        if isinstance(method, (EditMessageText, EditMessageReplyMarkup)) and method.message_id:
+            self._seq += 1
+            edit_key, my_seq = (chat_id, method.message_id), self._seq
+            self._latest_edit[edit_key] = my_seq
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                queued = time.perf_counter()
+                bucket = self._chat_bucket(chat_id)
+                delay = bucket.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                if self._superseded(edit_key, my_seq):
+                    bucket.refund()
+                    self.coalesced += 1
+                    return True  # Как для правки, которую Telegram принял
+
+                await self._global_slot(send_priority.get())
+                trace = update_trace.get()
+                if trace is not None:
+                    trace.add("send_queue", time.perf_counter() - queued)
+
+                try:
+                    response = await make_request(bot, method)
+                    self.sent += 1
+                    return response
+                except TelegramRetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.retried += 1
+                    logging.warning(f"Telegram flood control: chat {chat_id}, retry after {e.retry_after}s")
+                    bucket.pause(e.retry_after)
+                    self._global.pause(e.retry_after)  # Флуд-контроль может быть и на весь бот
+        finally:
+            if edit_key is not None and self._latest_edit.get(edit_key) == my_seq:
+                del self._latest_edit[edit_key]
+
+
+send_queue = SendQueue()
+
+
+def _runtime_gauges() -> list[tuple[str, tuple, float]]:
+    """Состояние кэшей и очередей на момент сбора метрик"""
+    samples = [(f"bot_send_queue_{k}", (), v) for k, v in send_queue.stats().items()]
+    samples.append(("bot_upstream_coalesced", (), CurrencyAPI.coalesced))
+    samples.append(("bot_refresh_interval_seconds", (), refresher.interval))
+    samples.append(("bot_alerts_triggered", (), alerts.triggered))
+    for pool in providers.values():
+        samples.extend(pool.stats())
+    samples.extend((f"bot_catalog_{k}", (), v) for k, v in catalog.stats().items())
+    if CurrencyAPI.snapshot:
+        samples.append(("bot_rates_age_seconds", (), CurrencyAPI.snapshot.age))
+        samples.append(("bot_rates_version", (), CurrencyAPI.snapshot.version))
+    return samples
+
+
+metrics.gauges.append(_runtime_gauges)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#                              НЕСКОЛЬКО ПРОЦЕССОВ
+# ══════════════════════════════════════════════════════════════════════════════
+
+class SharedRates:
+    """Срез курсов в разделяемой памяти: пишет координатор, воркеры читают без сообщений между процессами.
+
+    Запись идёт под seqlock: счётчик нечётный, пока цены переписываются, и
+    читатель повторяет чтение, если застал запись или счётчик сменился за время
+    чтения. Пока версия среза прежняя, воркер читает только заголовок; список
+    кодов перечитывается лишь при смене его версии. У каждого воркера свой слот
+    счётчиков спроса, по которым координатор подстраивает частоту обновлений.
+    """
+
+    SEQ, VERSION, COUNT, CODES_LEN, CODES_VERSION = range(5)
+    FETCHED_AT, CATALOG_AT = 5, 6  # float64 в следующих ячейках заголовка
+    HEADER = 64
+    READ_ATTEMPTS = 100
+
+    def __init__(self, shm: SharedMemory, slots: int):
+        self.shm = shm
+        self.slots = slots
+        self.slot = 0          # Слот счётчиков воркера
+        self.requests = None   # Очередь запросов монет к координатору
+        buf = shm.buf
+        # Заголовок и счётчики — через memoryview: доступ к одному числу дешевле, чем через numpy
+        self._header = buf[:self.HEADER].cast("Q")
+        self._times = buf[:self.HEADER].cast("d")
+        offset = self.HEADER
+        self._usd = np.ndarray((SHARED_RATES_CAPACITY,), np.float64, buf, offset)
+        offset += SHARED_RATES_CAPACITY * 8
+        self._codes = np.ndarray((SHARED_CODES_BYTES,), np.uint8, buf, offset)
+        offset += SHARED_CODES_BYTES
+        self._demand = buf[offset:offset + slots * 16].cast("Q")  # По воркеру: обращения, просьбы обновить
+        self._collected = np.zeros((slots, 2), np.uint64)
+        self._published: tuple[str, ...] = ()
+        self._codes_version = 0
+        self._codes_cache: tuple[str, ...] = ()
+        self._requested: dict[str, float] = {}
+        self._unpriced = TTLCache(maxsize=COINS_TRACKED_MAX, ttl=SHARED_MISS_TTL)  # Монеты без цены у источников
+        self._follow: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def size(slots: int) -> int:
+        return SharedRates.HEADER + SHARED_RATES_CAPACITY * 8 + SHARED_CODES_BYTES + slots * 16
+
+    @classmethod
+    def create(cls, slots: int) -> "SharedRates":
+        return cls(SharedMemory(create=True, size=cls.size(slots)), slots)
+
+    @classmethod
+    def attach(cls, name: str, slots: int) -> "SharedRates":
+        return cls(SharedMemory(name=name), slots)
+
+    def close(self, unlink: bool = False):
+        # Пока живы представления буфера, его не отпустить
+        for view in (self._header, self._times, self._demand):
+            view.release()
+        del self._usd, self._codes
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+    # ─── Координатор ───
+
+    def publish(self, snapshot: RateSnapshot):
+        """Слушатель CurrencyAPI: выложить новый срез"""
+        codes = snapshot.codes[:SHARED_RATES_CAPACITY]
+        if len(codes) < len(snapshot.codes):
+            logging.warning(f"Shared rates hold {len(codes)} of {len(snapshot.codes)} codes")
+        n = len(codes)
+
+        seq = self._header[self.SEQ]
+        self._header[self.SEQ] = seq + 1  # Нечётный: идёт запись
+        if codes != self._published:
+            data = "\n".join(codes).encode()
+            self._codes[:len(data)] = np.frombuffer(data, np.uint8)
+            self._header[self.CODES_LEN] = len(data)
+            self._header[self.CODES_VERSION] += 1
+            self._published = codes
+        self._usd[:n] = snapshot.usd[:n]
+        self._times[self.FETCHED_AT] = snapshot.fetched_at
+        self._times[self.CATALOG_AT] = catalog.loaded_at
+        self._header[self.COUNT] = n
+        self._header[self.VERSION] = snapshot.version
+        self._header[self.SEQ] = seq + 2
+
+    def collect(self) -> tuple[int, int]:
+        """Обращения к курсам и просьбы обновить от всех воркеров с прошлого вызова"""
+        current = np.array(self._demand, dtype=np.uint64).reshape(self.slots, 2)
+        reads, kicks = (current - self._collected).sum(axis=0)
+        self._collected = current
+        return int(reads), int(kicks)
+
+    # ─── Воркер ───
+
+    def read(self) -> Optional[RateSnapshot]:
+        """Срез из общей памяти, если он новее текущего"""
+        current = CurrencyAPI.snapshot
+        header = self._header
+        for _ in range(self.READ_ATTEMPTS):
+            version = header[self.VERSION]
+            if not version or (current is not None and current.version == version):
+                return None
+            seq = header[self.SEQ]
+            if seq & 1:
+                continue
+
+            version = header[self.VERSION]  # Заново: до seq могла закончиться ещё одна запись
+            codes_version = header[self.CODES_VERSION]
+            codes = self._codes_cache
+            if codes_version != self._codes_version:
+                codes = tuple(bytes(self._codes[:header[self.CODES_LEN]]).decode().split("\n"))
+            count = header[self.COUNT]
+            usd = self._usd[:count].copy()
+            fetched_at, catalog_at = self._times[self.FETCHED_AT], self._times[self.CATALOG_AT]
+            if header[self.SEQ] != seq or len(codes) != count:
+                continue  # Застали запись — перечитать
+
+            self._codes_version, self._codes_cache = codes_version, codes
+            if catalog_at > catalog.loaded_at:
+                self._follow = asyncio.get_running_loop().create_task(catalog.follow(catalog_at))
+            return RateSnapshot.from_usd(version, fetched_at, codes, usd)
+        return None
+
+    def _sync(self):
+        snapshot = self.read()
+        if snapshot is not None:
+            CurrencyAPI.snapshot = snapshot
+
+    @staticmethod
+    def _missing(codes) -> list[str]:
+        """Монеты каталога, которых нет в текущем срезе"""
+        snapshot = CurrencyAPI.snapshot
+        return [code for code in codes
+                if code not in ALL_CURRENCIES and code in catalog.by_symbol
+                and (snapshot is None or code not in snapshot.index)]
+
+    async def get_snapshot(self, codes) -> Optional[RateSnapshot]:
+        """CurrencyAPI.get_snapshot в воркере: курсы обновляет координатор, к API воркер не ходит"""
+        self._demand[self.slot * 2] += 1
+        self._sync()
+        snapshot = CurrencyAPI.snapshot
+        missing = [code for code in self._missing(codes) if code not in self._unpriced]
+
+        if snapshot is None or missing:
+            metrics.inc("bot_rate_cache_total", (("result", "miss"),))
+            await self._wait(missing)
+        elif snapshot.age > RATES_TTL:
+            metrics.inc("bot_rate_cache_total", (("result", "stale"),))
+            self._demand[self.slot * 2 + 1] += 1
+        else:
+            metrics.inc("bot_rate_cache_total", (("result", "hit"),))
+        return CurrencyAPI.snapshot
+
+    async def _wait(self, missing: list[str]):
+        """Попросить координатора о недостающих монетах и дождаться среза с ними"""
+        now = time.time()
+        ask = tuple(code for code in missing if now - self._requested.get(code, 0.0) > SHARED_WAIT)
+        if ask:
+            if len(self._requested) > COINS_TRACKED_MAX:
+                self._requested.clear()
+            self._requested.update(dict.fromkeys(ask, now))
+            self.requests.put(ask)
+
+        deadline = now + SHARED_WAIT
+        while time.time() < deadline:
+            await asyncio.sleep(0.05)
+            self._sync()
+            if CurrencyAPI.snapshot is not None and not self._missing(missing):
+                return
+        # Не дождались: следующие запросы этих монет не ждут, цена попадёт в срез, если появится
+        self._unpriced.update(dict.fromkeys(self._missing(missing), True))
+
+
+def update_chat(update: dict) -> int:
+    """Чат апдейта, а без чата — пользователь: апдейты одного диалога попадают в один воркер"""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        user = event.get("from") or event.get("user")
+        return (chat or user or {}).get("id", 0)
+    return 0
+
+
+class WorkerPool:
+    """Координатор процессов-воркеров.
+
+    Сам принимает апдейты (polling или вебхук) и раскладывает их по воркерам
+    по чату: FSM-состояние и лимиты чата остаются в одном процессе. Курсы,
+    каталог монет, проверка уведомлений и запись истории живут только здесь,
+    воркеры получают срез через SharedRates и к API курсов не обращаются.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.shared: Optional[SharedRates] = None
+        self.routed = [0] * size
+        self.restarts = 0
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queues: list = []
+        self._requests = None
+        self._procs: list = []
+        self._tasks: set[asyncio.Task] = set()
+        self._supervisor: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.shared = SharedRates.create(self.size)
+        CurrencyAPI.listeners.append(self.shared.publish)
+        if CurrencyAPI.snapshot is not None:
+            self.shared.publish(CurrencyAPI.snapshot)
+
+        self._requests = self._ctx.Queue()
+        self._queues = [self._ctx.Queue() for _ in range(self.size)]
+        self._procs = [self._spawn(i) for i in range(self.size)]
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=self._listen, args=(loop,), name="coin-requests", daemon=True).start()
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    def _spawn(self, index: int):
+        process = self._ctx.Process(
+            target=worker_main, name=f"worker-{index}", daemon=True,
+            args=(index, self.size, self.shared.shm.name, self._queues[index], self._requests),
+        )
+        process.start()
+        return process
+
+    def _listen(self, loop: asyncio.AbstractEventLoop):
+        """Поток: запросы монет от воркеров -> catalog.ensure в цикле событий"""
+        while True:
+            codes = self._requests.get()
+            if codes is None:
+                return
+            loop.call_soon_threadsafe(self._ensure, codes)
+
+    def _ensure(self, codes: tuple[str, ...]):
+        task = asyncio.create_task(catalog.ensure(codes))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _supervise(self):
+        """Раз в секунду: спрос воркеров -> RateRefresher; упавшие воркеры перезапустить"""
+        while True:
+            await asyncio.sleep(1)
+            reads, kicks = self.shared.collect()
+            refresher.touch(reads)
+            if kicks:
+                refresher.kick()
+            for i, process in enumerate(self._procs):
+                if not process.is_alive():
+                    logging.error(f"Worker {i} exited with code {process.exitcode}, restarting")
+                    self.restarts += 1
+                    self._procs[i] = self._spawn(i)
+
+    def route(self, update: dict, body: bytes):
+        worker = update_chat(update) % self.size
+        self._queues[worker].put(body)
+        self.routed[worker] += 1
+
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        """Вебхук: проверить секрет и отдать апдейт воркеру, не разбирая его в модели aiogram"""
+        if not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        self.route(update, body)
+        return web.Response()
+
+    async def poll(self, bot: Bot, allowed_updates: list[str]):
+        """Long polling в сыром JSON: разбор апдейта в модели — уже в воркере"""
+        url = bot.session.api.api_url(bot.token, "getUpdates")
+        timeout = aiohttp.ClientTimeout(total=POLL_TIMEOUT + HTTP_READ_TIMEOUT)
+        offset = 0
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                payload = {"offset": offset, "timeout": POLL_TIMEOUT, "allowed_updates": allowed_updates}
+                try:
+                    async with session.post(url, json=payload) as r:
+                        data = await r.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logging.error(f"getUpdates failed: {e!r}")
+                    await asyncio.sleep(1)
+                    continue
+                if not data.get("ok"):
+                    logging.error(f"getUpdates error: {data.get('description')}")
+                    await asyncio.sleep((data.get("parameters") or {}).get("retry_after", 5))
+                    continue
+                for update in data["result"]:
+                    offset = update["update_id"] + 1
+                    self.route(update, json.dumps(update, ensure_ascii=False).encode())
+
+    async def stop(self):
+        if self._supervisor:
+            self._supervisor.cancel()
+        for q in self._queues:
+            q.put(None)
+        if self._requests is not None:
+            self._requests.put(None)
+
+        loop = asyncio.get_running_loop()
+        for process in self._procs:
+            await loop.run_in_executor(None, process.join, WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logging.warning(f"{process.name} did not stop in time, terminating")
+                process.terminate()
+
+        if self.shared is not None:
+            CurrencyAPI.listeners.remove(self.shared.publish)
+            self.shared.close(unlink=True)
+            self.shared = None
+
+    def stats(self) -> list[tuple[str, tuple, float]]:
+        samples = [("bot_workers_alive", (), sum(p.is_alive() for p in self._procs)),
+                   ("bot_worker_restarts", (), self.restarts)]
+        samples += [("bot_worker_updates_routed", (("worker", str(i)),), n) for i, n in enumerate(self.routed)]
+        return samples
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 #                              ЗАПУСК
 # ══════════════════════════════════════════════════════════════════════════════
 
+def webhook_app(bot: Bot, dp: Dispatcher) -> web.Application:
+    """aiohttp-приложение вебхука: апдейты без верного секрета отклоняются с 401"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=True,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Приём апдейтов через вебхук.
+
+    Экземпляр на бота один: FSM-состояние, антидребезг и лимиты чатов живут
+    в памяти процесса. Больше ядер — BOT_WORKERS, координатор раскладывает
+    апдейты по воркерам по чату.
+    """
+    dp.update.outer_middleware(ConcurrencyLimit(WEBHOOK_WORKERS))
+    app = webhook_app(bot, dp)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await set_webhook(bot, dp.resolve_used_update_types())
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def set_webhook(bot: Bot, allowed_updates: list[str]):
+    """Ставим вебхук, только если он ещё не указывает на нас: перезапуск не трогает очередь апдейтов"""
+    url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+    info = await bot.get_webhook_info()
+    if info.url != url:
+        await bot.set_webhook(
+            url,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    print(f"🌐 Вебхук: {url} (слушаю {WEBHOOK_HOST}:{WEBHOOK_PORT})")
+
+
+def install_profile_signal():
+    """kill -USR1 <pid> — профилировать процесс PROFILE_SECONDS секунд (не на Windows)"""
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.start, PROFILE_SECONDS)
+
+
+async def run_workers(bot: Bot, dp: Dispatcher):
+    """Координатор: апдейты и курсы здесь, обработка апдейтов — в BOT_WORKERS процессах"""
+    pool = WorkerPool(BOT_WORKERS)
+    send_queue.set_global_rate(TG_GLOBAL_RATE / (BOT_WORKERS + 1))  # Лимит бота делят воркеры и рассылки
+    metrics.gauges.append(pool.stats)
+    allowed_updates = dp.resolve_used_update_types()
+    pool.start()
+    print(f"⚙️ Воркеров: {BOT_WORKERS}")
+
+    try:
+        if BOT_MODE == "webhook":
+            app = web.Application()
+            app.router.add_post(WEBHOOK_PATH, pool.handle_webhook)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            await set_webhook(bot, allowed_updates)
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await runner.cleanup()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await pool.poll(bot, allowed_updates)
+    finally:
+        await pool.stop()
+
+
+def worker_main(index: int, size: int, shm_name: str, updates, requests):
+    """Точка входа процесса-воркера"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Останавливает координатор, а не Ctrl+C
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s | %(levelname)s | worker-{index} | %(message)s")
+    asyncio.run(run_worker(index, size, shm_name, updates, requests))
+
+
+async def run_worker(index: int, size: int, shm_name: str, updates, requests):
+    """Обработка апдейтов, которые раздаёт координатор; курсы — из общей памяти"""
+    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    send_queue.set_global_rate(TG_GLOBAL_RATE / (size + 1))
+    bot.session.middleware(send_queue)
+    bot.session.middleware(TelegramTimer())
+
+    snapshot_path = None
+    if FSM_SNAPSHOT:
+        root, ext = os.path.splitext(FSM_SNAPSHOT)
+        snapshot_path = f"{root}.{index}{ext}"  # Чат попадает в тот же воркер, пока их число прежнее
+    storage = TTLMemoryStorage(snapshot_path=snapshot_path)
+    storage.load()
+    metrics.gauges.append(lambda: [(f"bot_fsm_{k}", (), v) for k, v in storage.stats().items()])
+    dp = TracingDispatcher(storage=storage)
+    dp.include_router(router)
+    dp.update.outer_middleware(callback_guard)
+    dp.update.outer_middleware(ConcurrencyLimit(WEBHOOK_WORKERS))
+
+    shared = SharedRates.attach(shm_name, size)
+    shared.slot, shared.requests = index, requests
+    CurrencyAPI.shared = shared
+    catalog.open()
+    alerts.open(evaluate=False)
+    digests.open()
+    history.follow = True
+    history.load()
+    metrics_runner = await start_metrics_server(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    await loop_lag.start()
+    install_profile_signal()
+
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    tasks: set[asyncio.Task] = set()
+
+    async def process(body: bytes):
+        try:
+            await dp.feed_update(bot, Update.model_validate_json(body, context={"bot": bot}))
+        except Exception as e:
+            logging.exception(f"Update failed: {e}")
+
+    def feed(batch: list):
+        for body in batch:
+            if body is None:
+                stopped.set()
+                return
+            task = loop.create_task(process(body))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    def pump():
+        """Поток: забирать апдейты пачками, чтобы не будить цикл событий на каждый"""
+        while True:
+            batch = [updates.get()]
+            try:
+                while len(batch) < WORKER_BATCH and batch[-1] is not None:
+                    batch.append(updates.get_nowait())
+            except queue.Empty:
+                pass
+            loop.call_soon_threadsafe(feed, batch)
+            if batch[-1] is None:
+                return
+
+    threading.Thread(target=pump, name="updates", daemon=True).start()
+    try:
+        await stopped.wait()
+        if tasks:
+            await asyncio.wait(tasks, timeout=WORKER_STOP_TIMEOUT)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await profiler.stop()
+        await loop_lag.stop()
+        CurrencyAPI.shared = None
+        shared.close()
+        alerts.close()
+        digests.close()
+        await storage.close()
+        await bot.session.close()
+
+
 async def main():
     logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 
@@ -610,17 +4355,60 @@ async def main():
         print("   Получить токен: @BotFather в Telegram")
         return
 
+    if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+        print("❌ Для режима webhook задайте WEBHOOK_URL и WEBHOOK_SECRET!")
+        return
+
     bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher()
+    bot.session.middleware(send_queue)
+    bot.session.middleware(TelegramTimer())
+    storage = TTLMemoryStorage(snapshot_path=FSM_SNAPSHOT)
+    storage.load()
+    metrics.gauges.append(lambda: [(f"bot_fsm_{k}", (), v) for k, v in storage.stats().items()])
+    dp = TracingDispatcher(storage=storage)
     dp.include_router(router)
+    dp.update.outer_middleware(callback_guard)
 
     print("✅ Бот запущен!")
     print("📡 API: CoinGecko (крипто) + Frankfurter (фиат)")
 
+    rate_store.open()
+    CurrencyAPI.load_saved()
+    catalog.open()
+    alerts.bot = bot
+    alerts.open()
+    history.open()
+    digests.bot = bot
+    digests.open()
+    CurrencyAPI.session()
+    await refresher.start()
+    await catalog.start()
+    await digests.start()
+    await loop_lag.start()
+    install_profile_signal()
+    metrics_runner = await start_metrics_server()
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot)
+        if BOT_WORKERS > 1:
+            await run_workers(bot, dp)
+        elif BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
     finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await profiler.stop()
+        await loop_lag.stop()
+        await digests.stop()
+        await catalog.stop()
+        await refresher.stop()
+        await CurrencyAPI.close()
+        rate_store.close()
+        alerts.close()
+        digests.close()
+        await history.close()
+        await storage.close()
         await bot.session.close()
 
 
@@ -0,0 +1,65 @@
+"""Общие заглушки тестов: Bot API без сети и курсы без источников"""
+import os
+import sys
+import time
+from datetime import datetime
+
+import pytest
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.methods import EditMessageText, SendMessage
+from aiogram.types import Chat, Message
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot_tg  # noqa: E402
+
+
+class RecordingSession(BaseSession):
+    """Сессия Bot API без сети: запоминает запросы и отвечает сразу"""
+
+    def __init__(self):
+        super().__init__()
+        self.requests: list = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append(method)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message(message_id=getattr(method, "message_id", None) or len(self.requests),
+                           date=datetime.now(), chat=Chat(id=method.chat_id, type="private"), text=method.text)
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def sent(self, method_type) -> list:
+        return [m for m in self.requests if isinstance(m, method_type)]
+
+
+@pytest.fixture
+def bot() -> Bot:
+    return Bot("42:TEST", session=RecordingSession(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+
+@pytest.fixture(scope="session")
+def dp() -> bot_tg.TracingDispatcher:
+    """Dispatcher с роутером бота: роутер подключается только к одному Dispatcher, он общий на все тесты"""
+    dispatcher = bot_tg.TracingDispatcher(storage=bot_tg.TTLMemoryStorage())
+    dispatcher.include_router(bot_tg.router)
+    return dispatcher
+
+
+@pytest.fixture
+def rates():
+    """Свежие курсы в кэше, без обращений к источникам"""
+    now = time.time()
+    bot_tg.cache["crypto"] = bot_tg.CachedRates({"BTC": 60000.0, "ETH": 3000.0, "TON": 5.0, "USDT": 1.0}, now)
+    bot_tg.cache["fiat"] = bot_tg.CachedRates({"USD": 1.0, "RUB": 90.0, "EUR": 0.9}, now)
+    bot_tg.CurrencyAPI._rebuild_snapshot()
+    yield bot_tg.CurrencyAPI.snapshot
+    bot_tg.cache.clear()
@@ -0,0 +1,67 @@
+"""Уведомления: воркеры пишут в SQLite, координатор досчитывает только изменения"""
+import asyncio
+import time
+
+import pytest
+
+import bot_tg
+
+
+@pytest.fixture
+def engines(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_tg.CurrencyAPI, "listeners", [])
+    monkeypatch.setattr(bot_tg.catalog, "pinned", [])
+    path = str(tmp_path / "alerts.db")
+    worker, coordinator = bot_tg.AlertEngine(path), bot_tg.AlertEngine(path)
+    worker.open(evaluate=False)
+    coordinator.open()
+    yield worker, coordinator
+    worker.close()
+    coordinator.close()
+
+
+def snapshot(btc: float) -> bot_tg.RateSnapshot:
+    return bot_tg.RateSnapshot.build(1, {"BTC": btc}, {"USD": 1.0}, time.time())
+
+
+def test_worker_keeps_no_index(engines):
+    worker, _ = engines
+    alert = worker.add(1, 1, "BTC", "USD", True, 70000.0)
+    assert worker._alerts == {} and worker._pairs == {}
+    assert [a.id for a in worker.user_alerts(1)] == [alert.id]
+    assert worker.user_alerts(2) == []
+
+
+def test_coordinator_applies_worker_changes(engines):
+    worker, coordinator = engines
+    kept = worker.add(1, 1, "BTC", "USD", True, 70000.0)
+    dropped = worker.add(2, 2, "BTC", "USD", True, 65000.0)
+    assert worker.remove(2, dropped.id)
+    assert not worker.remove(1, dropped.id)
+
+    async def scenario():
+        coordinator.on_snapshot(snapshot(71000.0))  # Без бота уведомления не отправляются
+
+    asyncio.run(scenario())
+    assert coordinator.triggered == 1
+    assert set(coordinator._alerts) == {kept.id}
+    assert coordinator._db.execute("SELECT COUNT(*) FROM alerts_log").fetchone()[0] == 0
+    assert [a.armed for a in worker.user_alerts(1)] == [False]  # Сработавшее видно воркеру
+
+
+def test_coordinator_loads_existing_alerts(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_tg.CurrencyAPI, "listeners", [])
+    monkeypatch.setattr(bot_tg.catalog, "pinned", [])
+    path = str(tmp_path / "alerts.db")
+    worker = bot_tg.AlertEngine(path)
+    worker.open(evaluate=False)
+    alert = worker.add(1, 1, "ETH", "USD", False, 2000.0)
+
+    coordinator = bot_tg.AlertEngine(path)
+    coordinator.open()
+    assert coordinator.codes() == {"ETH", "USD"}
+    assert coordinator._db.execute("SELECT COUNT(*) FROM alerts_log").fetchone()[0] == 0
+    coordinator._sync()
+    assert list(coordinator._alerts) == [alert.id]
+    worker.close()
+    coordinator.close()
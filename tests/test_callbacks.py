@@ -0,0 +1,24 @@
+"""Callback-данные: сумма переживает упаковку без округления"""
+import pytest
+
+import bot_tg
+
+
+@pytest.mark.parametrize("amount", [1.0, 100.0, 1234567.0, 98765.4321, 0.000123456789, 123456789012345.0])
+def test_conv_callback_keeps_amount(amount):
+    data = bot_tg.ConvCallback("a", "BTC", "USD", amount).pack()
+    assert bot_tg.ConvCallback.unpack(data).amount == amount
+
+
+def test_conv_callback_fits_telegram_limit(monkeypatch):
+    monkeypatch.setitem(bot_tg.catalog.by_symbol, "ABCDEFGHIJ", "long")
+    monkeypatch.setitem(bot_tg.catalog.by_symbol, "KLMNOPQRST", "long-2")
+    data = bot_tg.ConvCallback("a", "ABCDEFGHIJ", "KLMNOPQRST", 1 / 3 * 1e14).pack()
+    assert len(data.encode()) <= 64
+    assert bot_tg.ConvCallback.unpack(data).amount == pytest.approx(1 / 3 * 1e14, rel=1e-14)
+
+
+def test_inline_result_ids_differ_for_close_amounts(rates):
+    first, second = (bot_tg.build_inline_results(amount, "USD", "RUB", rates)[0] for amount in (1234567.0, 1234568.0))
+    assert first.id == "USD:RUB:1234567"
+    assert second.id != first.id
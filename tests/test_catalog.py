@@ -0,0 +1,108 @@
+"""Каталог монет: индекс символов, поиск, чанки запросов цен"""
+import pytest
+
+import bot_tg
+
+# (id, символ, название) — как строки /coins/list
+COINS = [
+    ("bitcoin", "btc", "Bitcoin"),
+    ("batcat", "btc", "Batcat"),               # Символ встроенной монеты
+    ("fake-dollar", "usd", "Fake Dollar"),     # Символ фиата
+    ("pepe", "pepe", "Pepe"),
+    ("pepe-2", "pepe", "Pepe 2"),
+    ("pepe-classic", "pepe", "Pepe Classic"),  # Крупнее одноимённых
+    ("aaa-token", "aaa", "AAA Token"),
+    ("aaa", "aaa", "Triple A"),                # Самый короткий id
+    ("solaris", "slr", "Solaris"),
+    ("sol-meme", "solx", "Sol Meme"),
+    ("dash-coin", "x-y", "Bad Symbol"),        # Символ не годится в код
+]
+TOP = ["bitcoin", "pepe-classic", "sol-meme"]
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    """Каталог из списка в памяти вместо глобального"""
+    fresh = bot_tg.CoinCatalog(None)
+    monkeypatch.setattr(bot_tg, "catalog", fresh)
+    yield fresh
+    bot_tg.kb_currencies.cache_clear()  # Клавиатуры собраны по тестовому каталогу
+    bot_tg.tokenize_quick.cache_clear()
+
+
+def test_search_builtin_before_catalog_loads(catalog):
+    assert catalog.search("eth") == ["ETH"]
+    assert catalog.search("евро") == ["EUR"]
+    assert catalog.search("бакс") == ["USD"]
+
+
+def test_symbol_collisions(catalog):
+    catalog._index(COINS, TOP)
+
+    assert catalog.by_symbol["BTC"] == "bitcoin"          # Встроенная монета важнее
+    assert catalog.by_symbol["PEPE"] == "pepe-classic"    # Затем капитализация
+    assert catalog.by_symbol["AAA"] == "aaa"              # Затем самый короткий id
+    assert "USD" not in catalog.by_symbol                 # Фиат важнее одноимённых монет
+    assert "X-Y" not in catalog.by_symbol
+
+    assert catalog.collisions == {
+        "BTC": ("bitcoin", "batcat"),
+        "PEPE": ("pepe-classic", "pepe", "pepe-2"),
+        "AAA": ("aaa", "aaa-token"),
+    }
+    assert catalog.code_of["pepe-classic"] == "PEPE" and "pepe" not in catalog.code_of
+    assert catalog.popular == ("BTC", "PEPE", "SOLX")
+    assert catalog.code("pepe") == "PEPE"
+
+
+def test_prefix_search(catalog):
+    catalog._index(COINS, TOP)
+
+    assert catalog.search("pepe") == ["PEPE"]
+    assert catalog.search("pepe cl") == ["PEPE"]        # По названию основной монеты
+    assert catalog.search("pepe 2") == []                # Не основная монета не ищется
+    assert catalog.search("sol")[:3] == ["SOL", "SOLX", "SLR"]  # Точное, затем популярные
+    assert catalog.search("triple") == ["AAA"]
+    assert catalog.search("  ") == []
+    assert len(catalog.search("s", limit=2)) == 2
+
+
+def test_chunks_respect_url_limit(monkeypatch):
+    monkeypatch.setattr(bot_tg, "COINS_URL_MAX", 200)
+    ids = [f"coin-{i:04d}-{'x' * (i % 17)}" for i in range(300)]
+
+    chunks = bot_tg.CoinCatalog._chunks(ids)
+    assert [coin_id for chunk in chunks for coin_id in chunk] == ids
+    assert len(chunks) > 1
+    for chunk in chunks:
+        url = f"{bot_tg.COINGECKO_API}/simple/price?vs_currencies=usd&ids={','.join(chunk)}"
+        assert len(url) <= bot_tg.COINS_URL_MAX
+
+
+def buttons(markup) -> list:
+    return [button for row in markup.inline_keyboard for button in row]
+
+
+def test_kb_currencies_pages(catalog):
+    extra = 2 * bot_tg.COINS_PAGE_SIZE
+    coins = [(f"coin-{i}", f"c{i:03d}", f"Coin {i}") for i in range(extra)]
+    catalog._index(coins, [coin_id for coin_id, _, _ in coins])
+
+    codes = bot_tg.currency_list("crypto")
+    assert len(codes) == len(bot_tg.CRYPTO) + extra
+    pages = -(-len(codes) // bot_tg.COINS_PAGE_SIZE)
+
+    shown = []
+    for page in range(pages):
+        markup = bot_tg.kb_currencies("crypto", "to", "USD", page)
+        picks = [b.callback_data for b in buttons(markup) if b.callback_data.startswith("c:to:USD:")]
+        assert len(picks) <= bot_tg.COINS_PAGE_SIZE
+        shown += [data.rsplit(":", 1)[1] for data in picks]
+        nav = [b for b in buttons(markup) if b.callback_data == "noop"]
+        assert nav[0].text == f"{page + 1}/{pages}"
+    assert tuple(shown) == codes
+
+    first = [b.callback_data for b in buttons(bot_tg.kb_currencies("crypto", "to", "USD", 0))]
+    assert f"pg:to:crypto:{pages - 1}:USD" in first and "pg:to:crypto:1:USD" in first  # По кругу
+    assert bot_tg.kb_currencies("crypto", "to", "USD", 99) == bot_tg.kb_currencies("crypto", "to", "USD", pages - 1)
+    assert not [b for b in buttons(bot_tg.kb_currencies("fiat", "from")) if b.callback_data == "noop"]
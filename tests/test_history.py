@@ -0,0 +1,70 @@
+"""История курсов: фоновая запись на диск не теряет ошибок и не пересекается с итоговой"""
+import asyncio
+import logging
+import threading
+import time
+
+import bot_tg
+
+
+def snapshot() -> bot_tg.RateSnapshot:
+    return bot_tg.RateSnapshot.build(1, {"BTC": 60000.0}, {"USD": 1.0, "RUB": 90.0}, time.time())
+
+
+def test_background_save_does_not_overlap(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_tg, "HISTORY_SAVE_INTERVAL", -1)
+    store = bot_tg.HistoryStore(str(tmp_path / "history.npz"))
+    release, writes = threading.Event(), []
+
+    def slow_write(arrays):
+        writes.append("start")
+        release.wait(5)
+        writes.append("done")
+
+    monkeypatch.setattr(store, "_write", slow_write)
+
+    async def scenario():
+        store.on_snapshot(snapshot())
+        await asyncio.sleep(0.05)
+        store.on_snapshot(snapshot())  # Первая запись ещё идёт
+        assert writes == ["start"]
+
+        closing = asyncio.create_task(store.close())
+        await asyncio.sleep(0.05)
+        assert not closing.done()  # Ждёт фоновую запись
+        release.set()
+        await closing
+
+    asyncio.run(scenario())
+    assert writes == ["start", "done", "start", "done"]
+
+
+def test_background_save_error_is_logged(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(bot_tg, "HISTORY_SAVE_INTERVAL", -1)
+    store = bot_tg.HistoryStore(str(tmp_path / "history.npz"))
+
+    def broken_write(arrays):
+        raise ValueError("disk says no")
+
+    monkeypatch.setattr(store, "_write", broken_write)
+
+    async def scenario():
+        store.on_snapshot(snapshot())
+        await asyncio.wait([store._saving])
+        await asyncio.sleep(0)  # Колбэк завершения
+
+    with caplog.at_level(logging.ERROR):
+        asyncio.run(scenario())
+    assert "History save failed" in caplog.text
+    assert "disk says no" in caplog.text
+
+
+def test_close_writes_final_history(tmp_path):
+    path = str(tmp_path / "history.npz")
+    store = bot_tg.HistoryStore(path)
+    store.on_snapshot(snapshot())
+    asyncio.run(store.close())
+
+    restored = bot_tg.HistoryStore(path)
+    restored.load()
+    assert restored.tiers[0].count == 1
@@ -0,0 +1,226 @@
+"""Источники курсов против локальных заглушек: хеджирование, размыкатели, сверка"""
+import asyncio
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import bot_tg
+
+CRYPTO_NAMES = ("coingecko", "cryptocompare", "binance")
+
+
+class Upstream:
+    """Заглушки всех источников: задержка, код ответа, тело и цены задаются для каждого отдельно"""
+
+    def __init__(self):
+        self.delay: dict[str, float] = {}
+        self.status: dict[str, int] = {}
+        self.body: dict[str, object] = {}
+        self.prices: dict[str, dict[str, float]] = {}  # Источник -> подменённые цены
+        self.hits = Counter()
+        self.crypto = {code: 100.0 + i for i, code in enumerate(bot_tg.CRYPTO)}
+        self.fiat = {code: 1.0 + i for i, code in enumerate(bot_tg.FIAT)}
+        self.fiat["USD"] = 1.0
+
+    def price(self, name: str, code: str) -> float:
+        return self.prices.get(name, {}).get(code, self.crypto.get(code) or self.fiat.get(code))
+
+    def bodies(self) -> dict:
+        crypto = bot_tg.CRYPTO
+        return {
+            "coingecko": lambda: {info[2]: {"usd": self.price("coingecko", code)} for code, info in crypto.items()},
+            "cryptocompare": lambda: {code: {"USD": self.price("cryptocompare", code)} for code in crypto},
+            "binance": lambda: [{"symbol": f"{code}USDT", "price": str(self.price("binance", code))}
+                                for code in crypto if code not in bot_tg.BinanceProvider.SKIP],
+            "frankfurter": lambda: {"base": "USD", "rates": {c: self.price("frankfurter", c) for c in self.fiat}},
+            "open_er_api": lambda: {"result": "success", "rates": {c: self.price("open_er_api", c) for c in self.fiat}},
+        }
+
+    def app(self) -> web.Application:
+        paths = {"coingecko": "/coingecko/simple/price", "cryptocompare": "/cryptocompare/pricemulti",
+                 "binance": "/binance/ticker/price", "frankfurter": "/frankfurter/latest",
+                 "open_er_api": "/open_er_api/latest/USD"}
+        app = web.Application()
+        for name, build in self.bodies().items():
+            app.router.add_get(paths[name], self._handler(name, build))
+        return app
+
+    def _handler(self, name: str, build):
+        async def handler(request: web.Request) -> web.Response:
+            self.hits[name] += 1
+            await asyncio.sleep(self.delay.get(name, 0))
+            if self.status.get(name, 200) != 200:
+                return web.Response(status=self.status[name])
+            return web.json_response(self.body[name] if name in self.body else build())
+        return handler
+
+
+@asynccontextmanager
+async def serve(upstream: Upstream, monkeypatch):
+    server = TestServer(upstream.app())
+    await server.start_server()
+    base = str(server.make_url("")).rstrip("/")
+    for attr, name in (("COINGECKO_API", "coingecko"), ("CRYPTOCOMPARE_API", "cryptocompare"),
+                       ("BINANCE_API", "binance"), ("FRANKFURTER_API", "frankfurter"),
+                       ("OPEN_ER_API", "open_er_api")):
+        monkeypatch.setattr(bot_tg, attr, f"{base}/{name}")
+    try:
+        yield
+    finally:
+        await bot_tg.CurrencyAPI.close()  # Сессия привязана к циклу событий теста
+        await server.close()
+
+
+@pytest.fixture
+def upstream() -> Upstream:
+    return Upstream()
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(bot_tg, "metrics", bot_tg.Metrics())
+
+
+def counter(name: str, labels: tuple) -> float:
+    return bot_tg.metrics._counters.get((name, labels), 0)
+
+
+# ─────────────────────────── Хеджирование ───────────────────────────
+
+def test_hedge_fires_after_hedge_delay(upstream, monkeypatch):
+    monkeypatch.setattr(bot_tg, "HEDGE_DEFAULT_DELAY", 0.1)
+    upstream.delay["coingecko"] = 1.0
+    pool = bot_tg.ProviderPool("crypto", CRYPTO_NAMES)
+
+    async def scenario():
+        async with serve(upstream, monkeypatch):
+            started = time.perf_counter()
+            winner, data = await pool._hedged(pool.providers)
+            return winner, data, time.perf_counter() - started
+
+    winner, data, elapsed = asyncio.run(scenario())
+    assert winner.name == "cryptocompare"
+    assert data["BTC"] == upstream.crypto["BTC"]
+    assert 0.1 <= elapsed < 0.5  # Не ждали медленный основной источник
+    assert upstream.hits["binance"] == 0
+    assert counter("bot_upstream_hedges_total", (("kind", "crypto"), ("reason", "slow"))) == 1
+    assert pool.providers[0].breaker.failures == 0  # Проигравший запрос — не ошибка
+
+
+def test_no_hedge_when_primary_is_fast(upstream, monkeypatch):
+    monkeypatch.setattr(bot_tg, "HEDGE_DEFAULT_DELAY", 0.3)
+    upstream.delay["coingecko"] = 0.02
+    pool = bot_tg.ProviderPool("crypto", CRYPTO_NAMES)
+
+    async def scenario():
+        async with serve(upstream, monkeypatch):
+            return await pool._hedged(pool.providers)
+
+    winner, _ = asyncio.run(scenario())
+    assert winner.name == "coingecko"
+    assert upstream.hits["cryptocompare"] == 0
+
+
+def test_failover_on_malformed_response(upstream, monkeypatch):
+    upstream.status["frankfurter"] = 500
+    upstream.body["open_er_api"] = ["not", "a", "dict"]  # parse падает с AttributeError
+    pool = bot_tg.ProviderPool("fiat", ("frankfurter", "open_er_api"))
+
+    async def scenario():
+        async with serve(upstream, monkeypatch):
+            return await pool.load()
+
+    assert asyncio.run(scenario()) is None
+    assert [p.breaker.failures for p in pool.providers] == [1, 1]
+
+
+# ─────────────────────────── Размыкатели ───────────────────────────
+
+def test_breaker_opens_after_failures(upstream, monkeypatch):
+    upstream.status["coingecko"] = 500
+    pool = bot_tg.ProviderPool("crypto", CRYPTO_NAMES)
+    primary = pool.providers[0]
+
+    async def scenario():
+        async with serve(upstream, monkeypatch):
+            for _ in range(bot_tg.BREAKER_FAILURES):
+                assert (await pool._hedged([p for p in pool.providers if p.breaker.allow()]))[0].name == "cryptocompare"
+            assert primary.breaker.state == "open"
+            hits = upstream.hits["coingecko"]
+            await pool._hedged([p for p in pool.providers if p.breaker.allow()])
+            return hits
+
+    hits = asyncio.run(scenario())
+    assert hits == bot_tg.BREAKER_FAILURES
+    assert upstream.hits["coingecko"] == hits  # Разомкнутый источник больше не спрашивают
+
+
+def test_half_open_probe_doubles_cooldown_then_recovers(upstream, monkeypatch):
+    upstream.status["coingecko"] = 500
+    pool = bot_tg.ProviderPool("crypto", CRYPTO_NAMES)
+    breaker = pool.providers[0].breaker
+
+    async def round_():
+        return await pool._hedged([p for p in pool.providers if p.breaker.allow()])
+
+    async def scenario():
+        async with serve(upstream, monkeypatch):
+            for _ in range(bot_tg.BREAKER_FAILURES):
+                await round_()
+            assert breaker.state == "open"
+
+            breaker.opened_at -= breaker.cooldown  # Время отдыха вышло
+            hits = upstream.hits["coingecko"]
+            await round_()
+            assert upstream.hits["coingecko"] == hits + 1  # Ровно одна пробная попытка
+            assert breaker.state == "open"
+            assert breaker.cooldown == 2 * bot_tg.BREAKER_COOLDOWN
+
+            await round_()
+            assert upstream.hits["coingecko"] == hits + 1  # Отдыхает заново, вдвое дольше
+
+            upstream.status["coingecko"] = 200
+            breaker.opened_at -= breaker.cooldown
+            winner, _ = await round_()
+            assert winner.name == "coingecko"
+            assert breaker.state == "closed"
+            assert breaker.cooldown == bot_tg.BREAKER_COOLDOWN
+
+    asyncio.run(scenario())
+
+
+# ─────────────────────────── Сверка ───────────────────────────
+
+def test_outlier_replaced_by_median(upstream, monkeypatch):
+    monkeypatch.setattr(bot_tg, "SANITY_EVERY", 1)  # Каждый раунд опрашивает все источники
+    upstream.prices["coingecko"] = {"BTC": upstream.crypto["BTC"] * 10}
+    upstream.prices["binance"] = {"BTC": upstream.crypto["BTC"] * 1.01}
+    pool = bot_tg.ProviderPool("crypto", CRYPTO_NAMES)
+
+    async def scenario():
+        async with serve(upstream, monkeypatch):
+            return await pool.load()
+
+    data = asyncio.run(scenario())
+    assert data["BTC"] == pytest.approx(upstream.crypto["BTC"] * 1.01)  # Медиана трёх: ответ binance
+    assert data["ETH"] == upstream.crypto["ETH"]
+    assert counter("bot_upstream_outliers_total", (("provider", "coingecko"),)) == 1
+
+
+def test_sanity_check_ignores_previous_result_and_stale_sources(monkeypatch):
+    pool = bot_tg.ProviderPool("fiat", ("frankfurter", "open_er_api"))
+    winner, other = pool.providers
+    monkeypatch.setitem(bot_tg.cache, "fiat", bot_tg.CachedRates({"EUR": 5.0, "RUB": 90.0}, time.time()))
+
+    # Прошлый результат пула не голосует и не дописывает пропавшие коды
+    assert pool._sanity_check(winner, {"USD": 1.0, "EUR": 0.9}) == {"USD": 1.0, "EUR": 0.9}
+
+    # Коды дописываются только из свежих ответов других источников
+    other.last = bot_tg.CachedRates({"USD": 1.0, "EUR": 0.9, "GEL": 2.7}, time.time() - bot_tg.SOURCE_MAX_AGE - 1)
+    assert "GEL" not in pool._sanity_check(winner, {"USD": 1.0, "EUR": 0.9})
+    other.last = bot_tg.CachedRates({"USD": 1.0, "EUR": 0.9, "GEL": 2.7}, time.time())
+    assert pool._sanity_check(winner, {"USD": 1.0, "EUR": 0.9})["GEL"] == 2.7
@@ -0,0 +1,118 @@
+"""Быстрый ввод: разбор суммы и валют, апдейты без текста"""
+import asyncio
+from datetime import datetime
+
+import pytest
+from aiogram.methods import SendMessage
+from aiogram.types import Chat, Message, Update
+
+import bot_tg
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("1 000", 1000.0),
+    ("1 000", 1000.0),
+    ("1,000,000", 1000000.0),
+    ("1.000.000", 1000000.0),
+    ("1.234,5", 1234.5),
+    ("1 000,50", 1000.5),
+    ("1'000.5", 1000.5),
+    ("0,5", 0.5),
+    ("0,250", 0.25),
+    ("1,000", 1000.0),
+    ("1.5", 1.5),
+])
+def test_parse_amount(raw, expected):
+    assert bot_tg.parse_amount(raw) == expected
+
+
+@pytest.mark.parametrize("raw", ["12.05.2024", "2 3", "1 0000", "10,00,000", "1,2.3,4", "1.2.3"])
+def test_parse_amount_rejects_broken_groups(raw):
+    assert bot_tg.parse_amount(raw) is None
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("1 000 usd", (1000.0, "USD", None)),
+    ("1.5k BTC", (1500.0, "BTC", None)),
+    ("1 000,50 €", (1000.5, "EUR", None)),
+    ("2 млн руб в usd", (2e6, "RUB", "USD")),
+])
+def test_tokenize_quick(text, expected):
+    q = bot_tg.tokenize_quick(text)
+    assert q.error is None
+    assert (q.amount, q.from_code, q.to_code) == expected
+
+
+@pytest.mark.parametrize("text", ["2 3 usd", "12.05.2024 usd"])
+def test_tokenize_quick_does_not_glue_numbers(text):
+    assert bot_tg.tokenize_quick(text).error is not None
+
+
+@pytest.fixture
+def coins(monkeypatch):
+    """Монеты каталога, чьи тикеры совпадают с обычными словами"""
+    for code in ("PEOPLE", "CAT", "PEPE"):
+        monkeypatch.setitem(bot_tg.catalog.by_symbol, code, code.lower())
+    bot_tg.tokenize_quick.cache_clear()
+    yield
+    bot_tg.tokenize_quick.cache_clear()
+
+
+def quick(text: str, chat_type: str):
+    message = Message(message_id=1, date=datetime.now(), chat=Chat(id=7, type=chat_type), text=text)
+    return asyncio.run(bot_tg.quick_input(message))
+
+
+@pytest.mark.parametrize("text", ["2 people", "3 cat", "5 pepe"])
+def test_group_ignores_lowercase_catalog_tickers(coins, text):
+    assert quick(text, "group") is False
+    assert quick(text, "private")["quick"].error is None
+
+
+def test_group_accepts_uppercase_catalog_tickers(coins):
+    assert quick("5 PEPE", "supergroup")["quick"].from_code == "PEPE"
+    assert quick("5 usd", "group")["quick"].from_code == "USD"
+
+
+def batch(bot, text: str, chat_type: str) -> list[str]:
+    message = Message(message_id=1, date=datetime.now(), chat=Chat(id=7, type=chat_type), text=text).as_(bot)
+    asyncio.run(bot_tg.batch_convert(message))
+    return [m.text for m in bot.session.sent(SendMessage)]
+
+
+def test_group_batch_ignores_lowercase_catalog_tickers(bot, rates, coins):
+    assert batch(bot, "2 people usd\n3 cat rub", "group") == []
+
+    reply, = batch(bot, "100 USD RUB\n2 people usd", "group")
+    assert "100 USD = 9,000 RUB" in reply
+    assert "Не распознаны строки: 2" in reply
+
+
+def test_private_batch_accepts_lowercase_catalog_tickers(bot, rates, coins, monkeypatch):
+    async def no_prices(codes):
+        return False
+
+    monkeypatch.setattr(bot_tg.catalog, "ensure", no_prices)  # Цены монет не запрашивать
+    reply, = batch(bot, "100 USD RUB\n2 people usd", "private")
+    assert "Не распознаны" not in reply
+    assert "2 PEOPLE = — USD" in reply
+
+
+def test_sticker_while_entering_amount(bot, dp):
+    """Стикер в состоянии ввода суммы не доходит до разбора текста"""
+    sticker = {
+        "update_id": 1,
+        "message": {
+            "message_id": 1, "date": 1700000000,
+            "chat": {"id": 7, "type": "private"},
+            "from": {"id": 7, "is_bot": False, "first_name": "u"},
+            "sticker": {"file_id": "s", "file_unique_id": "s", "type": "regular",
+                        "width": 512, "height": 512, "is_animated": False, "is_video": False},
+        },
+    }
+
+    async def scenario():
+        await dp.fsm.get_context(bot, chat_id=7, user_id=7).set_state(bot_tg.States.enter_amount)
+        await dp.feed_update(bot, Update.model_validate(sticker, context={"bot": bot}))
+
+    asyncio.run(scenario())
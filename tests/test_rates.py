@@ -0,0 +1,61 @@
+"""Срез курсов: возраст, кросс-курсы монет каталога"""
+import asyncio
+import queue
+import time
+
+import numpy as np
+import pytest
+
+import bot_tg
+
+
+@pytest.fixture(autouse=True)
+def clean_cache():
+    yield
+    bot_tg.cache.clear()
+
+
+def test_stale_coins_do_not_age_snapshot(rates):
+    day_ago = time.time() - 86400
+    bot_tg.cache["coins"] = bot_tg.CachedRates({"PEPE": 0.00001}, day_ago)
+    bot_tg.CurrencyAPI._rebuild_snapshot()
+
+    snapshot = bot_tg.CurrencyAPI.snapshot
+    assert snapshot.age < bot_tg.RATES_TTL
+    assert snapshot.usd_price("PEPE") == 0.00001
+
+
+def test_matrix_covers_builtin_currencies_only():
+    coins = {f"COIN{i}": 0.5 + i for i in range(1000)}
+    snapshot = bot_tg.RateSnapshot.build(1, {"BTC": 60000.0}, {"USD": 1.0, "RUB": 90.0}, time.time(), coins)
+
+    n = len(bot_tg.ALL_CURRENCIES)
+    assert snapshot.matrix.shape == (n, n)
+    assert snapshot.rate("BTC", "RUB") == pytest.approx(60000.0 * 90.0)
+    assert snapshot.rate("COIN1", "COIN3") == pytest.approx(1.5 / 3.5)
+    assert snapshot.rate("COIN0", "RUB") == pytest.approx(45.0)
+    assert snapshot.rate("EUR", "COIN0") is None  # Курса EUR нет
+    assert snapshot.convert(2, "COIN1", "BTC").result == pytest.approx(2 * 1.5 / 60000.0)
+
+    converted = snapshot.convert_many(np.array([2.0, 1.0]), ["COIN1", "BTC"], ["BTC", "NOPE"])
+    assert converted[0] == snapshot.convert(2, "COIN1", "BTC").result
+    assert np.isnan(converted[1])
+
+
+def test_shared_rates_remember_unpriced_coins(rates, monkeypatch):
+    monkeypatch.setattr(bot_tg, "SHARED_WAIT", 0.2)
+    monkeypatch.setitem(bot_tg.catalog.by_symbol, "NOPRICE", "no-price")
+    shared = bot_tg.SharedRates.create(1)
+    shared.slot, shared.requests = 0, queue.Queue()
+
+    async def timed():
+        started = time.perf_counter()
+        await shared.get_snapshot(("NOPRICE",))
+        return time.perf_counter() - started
+
+    try:
+        assert asyncio.run(timed()) >= 0.2  # Первый раз ждём координатора
+        assert asyncio.run(timed()) < 0.05  # Потом не ждём, пока помним промах
+        assert shared.requests.qsize() == 1
+    finally:
+        shared.close(unlink=True)
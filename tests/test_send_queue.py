@@ -0,0 +1,114 @@
+"""Очередь отправки против заглушки Bot API: темп чата, склейка правок, 429, приоритеты"""
+import asyncio
+import time
+
+import pytest
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendMessage
+
+import bot_tg
+from conftest import RecordingSession
+
+
+class TimedSession(RecordingSession):
+    """Запоминает время каждого запроса; на первые запросы в chat из flood отвечает 429"""
+
+    def __init__(self):
+        super().__init__()
+        self.times: list[float] = []
+        self.flood: dict[int, float] = {}  # chat_id -> retry_after для следующего запроса
+
+    async def make_request(self, bot, method, timeout=None):
+        retry_after = self.flood.pop(getattr(method, "chat_id", None), None)
+        if retry_after is not None:
+            self.times.append(time.monotonic())
+            self.requests.append(method)
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=retry_after)
+        self.times.append(time.monotonic())
+        return await super().make_request(bot, method, timeout)
+
+
+@pytest.fixture
+def make_bot():
+    def factory(queue: bot_tg.SendQueue) -> Bot:
+        session = TimedSession()
+        session.middleware(queue)
+        return Bot("42:TEST", session=session)
+    return factory
+
+
+def chats(session: TimedSession) -> list[int]:
+    return [m.chat_id for m in session.requests]
+
+
+def test_chat_pacing(make_bot):
+    queue = bot_tg.SendQueue(global_rate=1000, chat_rate=10, group_rate=5, chat_burst=1)
+    bot = make_bot(queue)
+
+    async def scenario():
+        await asyncio.gather(*(bot.send_message(1, f"m{i}") for i in range(3)), bot.send_message(2, "other"))
+
+    asyncio.run(scenario())
+    session = bot.session
+    own = [t for m, t in zip(session.requests, session.times) if m.chat_id == 1]
+    other = [t for m, t in zip(session.requests, session.times) if m.chat_id == 2]
+    assert len(own) == 3 and len(other) == 1
+    assert own[1] - own[0] >= 0.09 and own[2] - own[1] >= 0.09  # 10 сообщений/с в чат
+    assert other[0] - own[0] < 0.05  # Другой чат не ждёт
+
+
+def test_pending_edits_coalesce(make_bot):
+    queue = bot_tg.SendQueue(global_rate=1000, chat_rate=10, group_rate=5, chat_burst=1)
+    bot = make_bot(queue)
+
+    async def scenario():
+        await bot.send_message(1, "start")  # Выбирает запас чата: правки встают в очередь
+        return await asyncio.gather(*(bot.edit_message_text(f"v{i}", chat_id=1, message_id=5) for i in range(3)))
+
+    results = asyncio.run(scenario())
+    edits = bot.session.sent(EditMessageText)
+    assert [e.text for e in edits] == ["v2"]
+    assert results[:2] == [True, True]
+    assert queue.coalesced == 2
+
+
+def test_retry_after_pauses_chat_and_global_budget(make_bot):
+    queue = bot_tg.SendQueue(global_rate=1000, chat_rate=1, group_rate=1, chat_burst=3)
+    bot = make_bot(queue)
+    bot.session.flood[1] = 0.3
+
+    async def scenario():
+        first = asyncio.create_task(bot.send_message(1, "hello"))
+        await asyncio.sleep(0.05)
+        await bot.send_message(2, "meanwhile")  # Общий лимит тоже на паузе
+        await first
+
+    asyncio.run(scenario())
+    session = bot.session
+    assert chats(session) == [1, 2, 1]
+    flood_at, other_at, retry_at = session.times
+    assert 0.3 <= retry_at - flood_at < 0.45  # Ровно retry_after, без лишнего 1/rate
+    assert other_at - flood_at >= 0.25
+    assert queue.retried == 1 and queue.sent == 2
+
+
+def test_replies_overtake_broadcasts(make_bot):
+    queue = bot_tg.SendQueue(global_rate=20, chat_rate=1000, group_rate=1000, chat_burst=1000)
+    bot = make_bot(queue)
+
+    async def broadcast(chat_id: int):
+        bot_tg.send_priority.set(bot_tg.PRIORITY_BROADCAST)
+        await bot.send_message(chat_id, "digest")
+
+    async def scenario():
+        await asyncio.gather(*(bot.send_message(1000 + i, "warmup") for i in range(20)))  # Общий запас выбран
+        broadcasts = [asyncio.create_task(broadcast(100 + i)) for i in range(5)]
+        await asyncio.sleep(0.01)
+        await bot.send_message(7, "reply")
+        await asyncio.gather(*broadcasts)
+
+    asyncio.run(scenario())
+    order = [c for c in chats(bot.session) if c < 1000]
+    assert order[0] == 7  # Ответ обогнал рассылки, вставшие в очередь раньше
+    assert len(bot.session.sent(SendMessage)) == 26
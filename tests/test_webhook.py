@@ -0,0 +1,85 @@
+"""Вебхук: апдейт с верным секретом обрабатывается, без него — 401"""
+import asyncio
+import json
+import queue
+
+import pytest
+from aiogram.methods import SendMessage
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot_tg
+
+SECRET = "s3cret"
+
+
+def update(update_id: int, text: str, chat_id: int = 7) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "u"},
+            "text": text,
+        },
+    }
+
+
+async def post(client: TestClient, body: dict, secret=None):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret is not None else {}
+    return await client.post(bot_tg.WEBHOOK_PATH, json=body, headers=headers)
+
+
+@pytest.fixture(autouse=True)
+def secret(monkeypatch):
+    monkeypatch.setattr(bot_tg, "WEBHOOK_SECRET", SECRET)
+
+
+def test_webhook_processes_update_with_secret(bot, dp, rates):
+    async def scenario():
+        async with TestClient(TestServer(bot_tg.webhook_app(bot, dp))) as client:
+            resp = await post(client, update(1, "100 USD RUB"), SECRET)
+            assert resp.status == 200
+            for _ in range(100):  # Апдейт обрабатывается в фоне
+                if bot.session.sent(SendMessage):
+                    break
+                await asyncio.sleep(0.01)
+
+        replies = bot.session.sent(SendMessage)
+        assert len(replies) == 1
+        assert replies[0].chat_id == 7
+        assert "RUB" in replies[0].text
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("header", [None, "", "wrong"])
+def test_webhook_rejects_bad_secret(bot, dp, header):
+    async def scenario():
+        async with TestClient(TestServer(bot_tg.webhook_app(bot, dp))) as client:
+            resp = await post(client, update(1, "/start"), header)
+            assert resp.status == 401
+        assert bot.session.requests == []
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("header, status", [(SECRET, 200), (None, 401), ("wrong", 401)])
+def test_worker_pool_webhook_checks_secret(header, status):
+    async def scenario():
+        pool = bot_tg.WorkerPool(2)
+        pool._queues = [queue.Queue(), queue.Queue()]
+        app = bot_tg.web.Application()
+        app.router.add_post(bot_tg.WEBHOOK_PATH, pool.handle_webhook)
+        async with TestClient(TestServer(app)) as client:
+            resp = await post(client, update(5, "/start", chat_id=11), header)
+            assert resp.status == status
+        return pool
+
+    pool = asyncio.run(scenario())
+    routed = [json.loads(q.get_nowait()) for q in pool._queues if not q.empty()]
+    if status == 200:
+        assert routed == [update(5, "/start", chat_id=11)]
+        assert pool.routed[11 % 2] == 1  # Воркер, который отвечает за чат
+    else:
+        assert routed == []